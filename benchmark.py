@@ -0,0 +1,306 @@
+# Benchmark of the upload and query methods on synthetic data of a configurable size.
+#
+#   python benchmark.py --entities 100000 --output results.json
+#   python benchmark.py --compare before.json after.json
+#
+# The data (IIIF collections, annotations and metadata) is generated in a folder and
+# uploaded with the three processors, then every method of GenericQueryProcessor is called
+# repeatedly. The graph database is the embedded store (a file) unless --endpoint is given.
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from os.path import abspath, dirname, join
+from types import GeneratorType
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows: peak RSS is not reported
+    resource = None
+
+from impl import AnnotationProcessor, MetadataProcessor, CollectionProcessor
+from impl import RelationalQueryProcessor, TriplestoreQueryProcessor, GenericQueryProcessor
+
+BASE = "https://example.org/iiif"
+
+_NAMES = ["Alighieri, Dante", "Petrarca, Francesco", "Boccaccio, Giovanni", "Doe, John", "Doe, Jane",
+          "Ariosto, Ludovico", "Tasso, Torquato", "Leopardi, Giacomo", "Manzoni, Alessandro", "Foscolo, Ugo"]
+_WORDS = ["Opere", "Canzoniere", "Commedia", "Rime", "Lettere", "Trattato", "Decameron", "Poesie",
+          "Codice", "Frammenti", "Carteggio", "Diario", "Novelle", "Dialoghi", "Sonetti", "Orlando"]
+
+########### Data ###########
+
+def generateData(folder, entities, manifestsPerCollection=10, canvasesPerManifest=20, seed=0):
+    # Writes about the given number of entities: one collection-NNNNNN.json file per
+    # collection, annotations.csv (a painting annotation with its image for every canvas, a
+    # describing annotation for every manifest and collection) and metadata.csv (a title and
+    # one or two creators for every collection and manifest). Canvases, annotations and
+    # images are each about a third of the entities.
+    rng = random.Random(seed)
+    canvases = max(1, entities // 3)
+    manifests = max(1, -(-canvases // canvasesPerManifest))
+    collections = max(1, -(-manifests // manifestsPerCollection))
+    samples = {"collection": [], "manifest": [], "canvas": [], "image": [], "creator": [], "title": [], "label": []}
+    counts = {"collections": 0, "manifests": 0, "canvases": 0, "annotations": 0, "images": 0}
+
+    annotationsPath = join(folder, "annotations.csv")
+    metadataPath = join(folder, "metadata.csv")
+    with open(annotationsPath, "w", newline="", encoding="utf-8") as annotationsFile, \
+            open(metadataPath, "w", newline="", encoding="utf-8") as metadataFile:
+        annotations = csv.writer(annotationsFile)
+        annotations.writerow(["id", "body", "target", "motivation"])
+        metadata = csv.writer(metadataFile)
+        metadata.writerow(["id", "title", "creator"])
+        canvasesLeft = canvases
+        manifestsLeft = manifests
+        for c in range(collections):
+            collectionId = f"{BASE}/{c}/collection"
+            collection = {"@context": "http://iiif.io/api/presentation/3/context.json", "id": collectionId,
+                          "type": "Collection", "label": {"none": [f"Collection {c}"]}, "items": []}
+            _addMetadata(metadata, annotations, collectionId, rng, samples, counts)
+            counts["collections"] += 1
+            for m in range(min(manifestsPerCollection, manifestsLeft)):
+                manifestId = f"{BASE}/{c}/{m}/manifest"
+                manifest = {"id": manifestId, "type": "Manifest", "label": {"none": [f"Manifest {c}.{m}"]}, "items": []}
+                _addMetadata(metadata, annotations, manifestId, rng, samples, counts)
+                counts["manifests"] += 1
+                for p in range(min(canvasesPerManifest, canvasesLeft)):
+                    canvasId = f"{BASE}/{c}/{m}/canvas/p{p + 1}"
+                    # page labels repeat in every manifest, as in real collections
+                    manifest["items"].append({"id": canvasId, "type": "Canvas", "label": {"none": [f"p. {p + 1}"]}})
+                    imageId = f"{BASE}/image/{c}-{m}-{p + 1}/full/max/0/default.jpg"
+                    annotations.writerow([f"{BASE}/{c}/{m}/annotation/p{p + 1}-image", imageId, canvasId, "painting"])
+                    counts["canvases"] += 1
+                    counts["annotations"] += 1
+                    counts["images"] += 1
+                    _sample(samples["canvas"], canvasId, rng, counts["canvases"])
+                    _sample(samples["image"], imageId, rng, counts["images"])
+                    _sample(samples["label"], f"p. {p + 1}", rng, counts["canvases"])
+                canvasesLeft -= len(manifest["items"])
+                collection["items"].append(manifest)
+                _sample(samples["manifest"], manifestId, rng, counts["manifests"])
+            manifestsLeft -= len(collection["items"])
+            _sample(samples["collection"], collectionId, rng, counts["collections"])
+            with open(join(folder, f"collection-{c:06d}.json"), "w", encoding="utf-8") as f:
+                json.dump(collection, f)
+
+    counts["entities"] = sum(counts.values())
+    return {"annotations": annotationsPath, "metadata": metadataPath,
+            "collections": join(folder, "collection-*.json"), "counts": counts, "samples": samples}
+
+def _addMetadata(metadata, annotations, entityId, rng, samples, counts):
+    title = " ".join(rng.sample(_WORDS, 2))
+    creators = rng.sample(_NAMES, rng.randint(1, 2))
+    metadata.writerow([entityId, title, "; ".join(creators)])
+    annotations.writerow([entityId.rsplit("/", 1)[0] + "/annotation/describing", entityId + "/description",
+                          entityId, "describing"])
+    counts["annotations"] += 1
+    _sample(samples["title"], title, rng, counts["collections"] + counts["manifests"] + 1)
+    _sample(samples["creator"], creators[0], rng, counts["collections"] + counts["manifests"] + 1)
+
+def _sample(sample, value, rng, seen, size=100):
+    # Reservoir sampling: at most size values, each of the seen ones equally likely
+    if len(sample) < size:
+        sample.append(value)
+    else:
+        position = rng.randrange(seen)
+        if position < size:
+            sample[position] = value
+
+########### Measurements ###########
+
+def _peakRssMb():
+    # Peak resident set size of the process so far (ru_maxrss is in KiB on Linux, bytes on macOS)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def timeUpload(name, processor, path, entities):
+    started = time.perf_counter()
+    if not processor.uploadData(path):
+        raise RuntimeError(f"{name} failed")
+    seconds = time.perf_counter() - started
+    return {"name": name, "kind": "upload", "entities": entities, "seconds": round(seconds, 6),
+            "throughput": round(entities / seconds, 1), "peakRssMb": _peakRssMb()}
+
+def timeQuery(name, method, arguments, repeat):
+    # Calls method repeat times, with the argument tuples in turn; iterators are consumed.
+    # Latencies are in milliseconds, throughput in returned rows (entities) per second.
+    latencies = []
+    rows = 0
+    for call in range(repeat):
+        started = time.perf_counter()
+        result = method(*arguments[call % len(arguments)])
+        if isinstance(result, GeneratorType):
+            result = list(result)
+        latencies.append((time.perf_counter() - started) * 1000)
+        rows += len(result) if hasattr(result, "__len__") else int(result is not None)
+    seconds = sum(latencies) / 1000
+    return {"name": name, "kind": "query", "calls": repeat, "rows": rows, "seconds": round(seconds, 6),
+            "throughput": round(rows / seconds, 1) if seconds else None,
+            "p50Ms": round(_percentile(latencies, 50), 3), "p99Ms": round(_percentile(latencies, 99), 3),
+            "peakRssMb": _peakRssMb()}
+
+def _queries(generic, samples):
+    # (name, method, argument tuples) for every query method of GenericQueryProcessor
+    def one(values):
+        return [(value,) for value in values] or [("",)]
+    collections, manifests, canvases = one(samples["collection"]), one(samples["manifest"]), one(samples["canvas"])
+    return [
+        ("getAllAnnotations", generic.getAllAnnotations, [()]),
+        ("getAllCanvas", generic.getAllCanvas, [()]),
+        ("getAllCollections", generic.getAllCollections, [()]),
+        ("getAllImages", generic.getAllImages, [()]),
+        ("getAllManifests", generic.getAllManifests, [()]),
+        ("getAllCanvas(limit=100)", lambda: generic.getAllCanvas(limit=100), [()]),
+        ("iterAllAnnotations", generic.iterAllAnnotations, [()]),
+        ("iterAllCanvas", generic.iterAllCanvas, [()]),
+        ("getAnnotationsToCanvas", generic.getAnnotationsToCanvas, canvases),
+        ("getAnnotationsToCollection", generic.getAnnotationsToCollection, collections),
+        ("getAnnotationsToManifest", generic.getAnnotationsToManifest, manifests),
+        ("getAnnotationsWithBody", generic.getAnnotationsWithBody, one(samples["image"])),
+        ("getAnnotationsWithBodyAndTarget", generic.getAnnotationsWithBodyAndTarget,
+         [(image, canvas) for (image,), (canvas,) in zip(one(samples["image"]), canvases)]),
+        ("getAnnotationsWithTarget", generic.getAnnotationsWithTarget, canvases),
+        ("getCanvasesInCollection", generic.getCanvasesInCollection, collections),
+        ("getCanvasesInManifest", generic.getCanvasesInManifest, manifests),
+        ("getEntitiesWithCreator", generic.getEntitiesWithCreator, one(samples["creator"])),
+        ("getEntitiesWithLabel", generic.getEntitiesWithLabel, one(samples["label"])),
+        ("getEntitiesWithTitle", generic.getEntitiesWithTitle, one(samples["title"])),
+        ("searchEntities", generic.searchEntities, [(title.split()[0],) for (title,) in one(samples["title"])]),
+        ("getEntityById", generic.getEntityById, manifests + canvases),
+        ("getEntitiesByIds", generic.getEntitiesByIds, [([value for (value,) in manifests + canvases],)]),
+        ("getImagesAnnotatingCanvas", generic.getImagesAnnotatingCanvas, canvases),
+        ("getManifestsInCollection", generic.getManifestsInCollection, collections),
+    ]
+
+def _environment():
+    import numpy
+    import pandas
+    import rdflib
+    environment = {"python": platform.python_version(), "platform": platform.platform(),
+                   "processor": platform.processor() or platform.machine(), "cpus": os.cpu_count(),
+                   "pandas": pandas.__version__, "numpy": numpy.__version__, "rdflib": rdflib.__version__}
+    try:
+        environment["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd=dirname(abspath(__file__)),
+                                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        environment["commit"] = None
+    return environment
+
+def runBenchmark(entities, folder, repeat=10, methods=None, endpoint=None,
+                 manifestsPerCollection=10, canvasesPerManifest=20, seed=0):
+    # Generates the data in folder, uploads it and times every query method (or only the
+    # ones whose name contains one of the strings in methods); returns the results document
+    started = time.perf_counter()
+    data = generateData(folder, entities, manifestsPerCollection, canvasesPerManifest, seed)
+    counts = data["counts"]
+    results = [{"name": "generateData", "kind": "generate", "entities": counts["entities"],
+                "seconds": round(time.perf_counter() - started, 6), "peakRssMb": _peakRssMb()}]
+
+    relational = join(folder, "relational.db")
+    graph = endpoint or join(folder, "graph.nt")
+    processors = [("AnnotationProcessor.uploadData", AnnotationProcessor(), relational, data["annotations"],
+                   counts["annotations"] + counts["images"]),
+                  ("MetadataProcessor.uploadData", MetadataProcessor(), relational, data["metadata"],
+                   counts["collections"] + counts["manifests"]),
+                  ("CollectionProcessor.uploadData", CollectionProcessor(), graph, data["collections"],
+                   counts["collections"] + counts["manifests"] + counts["canvases"])]
+    for name, processor, dbPathOrUrl, path, uploaded in processors:
+        processor.setDbPathOrUrl(dbPathOrUrl)
+        results.append(timeUpload(name, processor, path, uploaded))
+
+    rel_qp = RelationalQueryProcessor()
+    rel_qp.setDbPathOrUrl(relational)
+    grp_qp = TriplestoreQueryProcessor()
+    grp_qp.setDbPathOrUrl(graph)
+    generic = GenericQueryProcessor()
+    generic.addQueryProcessor(rel_qp)
+    generic.addQueryProcessor(grp_qp)
+
+    # the first query loads the embedded store (or opens the connections): timed on its own
+    results.append(dict(timeQuery("firstQuery", generic.getAllCollections, [()], 1), kind="load"))
+    for name, method, arguments in _queries(generic, data["samples"]):
+        if methods and not any(method_ in name for method_ in methods):
+            continue
+        results.append(timeQuery(name, method, arguments, repeat))
+
+    return {"created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "parameters": {"entities": entities, "repeat": repeat, "endpoint": endpoint,
+                           "manifestsPerCollection": manifestsPerCollection,
+                           "canvasesPerManifest": canvasesPerManifest, "seed": seed},
+            "counts": counts, "environment": _environment(), "results": results}
+
+########### Reports ###########
+
+def printResults(document, out=sys.stdout):
+    counts = document["counts"]
+    out.write(f"{counts['entities']} entities ({counts['collections']} collections, {counts['manifests']} manifests, "
+              f"{counts['canvases']} canvases, {counts['annotations']} annotations)\n")
+    out.write(f"{'name':<34} {'seconds':>10} {'throughput/s':>14} {'p50 ms':>10} {'p99 ms':>10} {'peak RSS MB':>12}\n")
+    for result in document["results"]:
+        cells = [result.get("seconds"), result.get("throughput"), result.get("p50Ms"), result.get("p99Ms"), result.get("peakRssMb")]
+        out.write(f"{result['name']:<34} " + " ".join(f"{'-' if cell is None else cell:>{width}}"
+                                                     for cell, width in zip(cells, (10, 14, 10, 10, 12))) + "\n")
+
+def compareResults(before, after, out=sys.stdout):
+    # The p50 latency (for queries) or the time (for the rest) of every measurement found
+    # in both documents, with the ratio after / before
+    previous = {result["name"]: result for result in before["results"]}
+    out.write(f"{'name':<34} {'before':>12} {'after':>12} {'ratio':>8}\n")
+    for result in after["results"]:
+        old = previous.get(result["name"])
+        if old is None:
+            continue
+        metric = "p50Ms" if result["kind"] == "query" else "seconds"
+        ratio = result[metric] / old[metric] if old[metric] else float("nan")
+        out.write(f"{result['name']:<34} {old[metric]:>12} {result[metric]:>12} {ratio:>8.2f}\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of uploadData and of the query methods on synthetic data")
+    parser.add_argument("--entities", type=int, default=1000, help="about how many entities to generate (default 1000)")
+    parser.add_argument("--repeat", type=int, default=10, help="calls of every query method (default 10)")
+    parser.add_argument("--methods", nargs="*", help="only the methods whose name contains one of these strings")
+    parser.add_argument("--endpoint", help="URL of a SPARQL endpoint to use instead of the embedded store")
+    parser.add_argument("--folder", help="folder for the data and the databases (default: a temporary one)")
+    parser.add_argument("--manifests-per-collection", type=int, default=10)
+    parser.add_argument("--canvases-per-manifest", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0], encoding="utf-8") as before, open(args.compare[1], encoding="utf-8") as after:
+            compareResults(json.load(before), json.load(after))
+        return 0
+
+    with tempfile.TemporaryDirectory() as temporary:
+        folder = args.folder or temporary
+        os.makedirs(folder, exist_ok=True)
+        document = runBenchmark(args.entities, folder, args.repeat, args.methods, args.endpoint,
+                                args.manifests_per_collection, args.canvases_per_manifest, args.seed)
+    printResults(document)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(document, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
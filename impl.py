@@ -1,16 +1,28 @@
-import csv
+import gzip
 import json
+import logging
+import os
+import re
+import time
+import threading
+import weakref
+import numpy as np
 import pandas as pd
-import sparql_dataframe
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial, wraps
+from glob import glob
+from io import BytesIO
 from pandas import read_csv, read_sql, Series, DataFrame
 from sqlite3 import connect
-from rdflib import Graph, Namespace, Literal, URIRef
-from rdflib.namespace import RDF
-from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
-from sparql_dataframe import get
-from typing import List
+from typing import Iterator, List
+from urllib.parse import quote, urlencode, urlsplit
 
 class IdentifiableEntity(object):
+    # Slots instead of a __dict__ per instance: queries may create millions of entities
+    __slots__ = ("id",)
+
     def __init__(self, id):
         self.id = id
 
@@ -22,9 +34,11 @@ class IdentifiableEntity(object):
         return f"id: {self.id}"
 
 class Image(IdentifiableEntity):
-    pass
+    __slots__ = ()
 
 class Annotation(IdentifiableEntity):
+    __slots__ = ("body", "target", "motivation")
+
     def __init__(self, id, body, target, motivation):
         self.body = body
         self.target = target
@@ -56,6 +70,8 @@ class Annotation(IdentifiableEntity):
     
     
 class EntityWithMetadata(IdentifiableEntity):
+    __slots__ = ("title", "creators", "label")
+
     def __init__(self, id, label="", creators = "", title = ""):
         self.title = title
         self.creators = creators
@@ -85,9 +101,11 @@ class EntityWithMetadata(IdentifiableEntity):
         return output
 
 class Canvas(EntityWithMetadata):
-    pass
+    __slots__ = ()
 
 class Manifest(EntityWithMetadata):
+    __slots__ = ("items",)
+
     def __init__(self, id, label, items="", creators="", title=""):
         self.items = items
 
@@ -99,6 +117,8 @@ class Manifest(EntityWithMetadata):
         return self.items
 
 class Collection(EntityWithMetadata):
+    __slots__ = ("items",)
+
     def __init__(self, id, label, items="", creators="", title=""):
         self.items = items
 
@@ -111,256 +131,1838 @@ class Collection(EntityWithMetadata):
 
 ########### Processors ###########
 
-class Processor(object):
+def _expandPaths(pathOrPaths):
+    # uploadData accepts a path, a glob pattern (e.g. "data/collection-*.json") or a list of them
+    if isinstance(pathOrPaths, str):
+        pathOrPaths = [pathOrPaths]
+    paths = []
+    for path in pathOrPaths:
+        if any(char in path for char in "*?["):
+            matches = sorted(glob(path))
+            if not matches:
+                raise FileNotFoundError(f"No file matches {path}")
+            paths.extend(matches)
+        else:
+            paths.append(path)
+    return paths
+
+def _parallelMap(function, items, workers):
+    # Like ProcessPoolExecutor.map, but with at most two tasks per worker in flight, so
+    # that parsed files waiting for the (single) writer do not pile up
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# Below this many bytes of input, starting a pool of processes costs more than parsing the
+# files in the uploading process
+_PARALLEL_MIN_BYTES = 16 * 1024 * 1024
+
+def _workersFor(paths, workers):
+    if workers is None:
+        if sum(os.path.getsize(path) for path in paths if os.path.exists(path)) < _PARALLEL_MIN_BYTES:
+            return 1
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, len(paths)))
+
+def _spillChunks(path, fileChunks, folder):
+    # Runs in a worker process: writes the chunks of one file to files in folder, one at a
+    # time, and returns their paths, so neither process holds the whole file in memory
+    import pickle
+    import tempfile
+    spilled = []
+    for chunk in fileChunks(path):
+        handle, spill = tempfile.mkstemp(dir=folder, suffix=".pickle")
+        with os.fdopen(handle, "wb") as f:
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+        spilled.append(spill)
+    return spilled
+
+def _fileChunks(paths, fileChunks, workers):
+    # The chunks of every file, in order. With one worker the files are streamed in this
+    # process; otherwise a pool of processes parses them and spills their chunks to
+    # temporary files, which are read back (and deleted) one chunk at a time.
+    import pickle
+    import tempfile
+    if workers == 1:
+        for path in paths:
+            yield from fileChunks(path)
+        return
+    with tempfile.TemporaryDirectory(prefix="iiif-upload-") as folder:
+        for spilled in _parallelMap(partial(_spillChunks, fileChunks=fileChunks, folder=folder), paths, workers):
+            for spill in spilled:
+                with open(spill, "rb") as f:
+                    chunk = pickle.load(f)
+                os.remove(spill)
+                yield chunk
+
+def _csvFileChunks(path, dtype, chunkSize):
+    with pd.read_csv(path, keep_default_na=False, chunksize=chunkSize, dtype=dtype) as chunks:
+        yield from chunks
+
+def _csvChunks(paths, dtype, chunkSize, workers):
+    # The files are read in chunks of chunkSize rows and handed over, in order, to the
+    # process writing to the database
+    return _fileChunks(paths, partial(_csvFileChunks, dtype=dtype, chunkSize=chunkSize), workers)
+
+
+# Generation of every database written in this process, bumped by each uploadData call:
+# results computed at an older generation of their database are out of date
+_storeGenerations = {}
+_storeGenerationsLock = threading.Lock()
+
+def _storeKey(dbPathOrUrl):
+    return dbPathOrUrl if dbPathOrUrl.startswith(("http://", "https://")) else os.path.abspath(dbPathOrUrl)
+
+def _storeGeneration(dbPathOrUrl):
+    with _storeGenerationsLock:
+        return _storeGenerations.get(_storeKey(dbPathOrUrl), 0)
+
+def _bumpStoreGeneration(dbPathOrUrl):
+    key = _storeKey(dbPathOrUrl)
+    with _storeGenerationsLock:
+        _storeGenerations[key] = _storeGenerations.get(key, 0) + 1
+
+# Instrumentation of the calls of the processors, off unless enabled on a processor (see
+# _Instrumented). Every instrumented call becomes an event: a dictionary with the class of
+# the processor, the method, its arguments, the time it started, how long it took in total
+# and in each phase ("backend": the database, "decode": turning its answer into a data
+# frame, "materialize": building the entities), the number of rows (or entities) returned,
+# the text of the queries sent to the database and the error it raised, if any.
+# Slow calls are reported as warnings of the "impl" logger
+_logger = logging.getLogger("impl")
+
+_calls = threading.local()
+
+class _PhaseTimer(object):
+    __slots__ = ("phases", "name", "started")
+
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.phases[self.name] = self.phases.get(self.name, 0.0) + time.perf_counter() - self.started
+
+class _NoPhaseTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_NO_PHASE_TIMER = _NoPhaseTimer()
+
+def _phase(name):
+    # Times the with block as the given phase of the instrumented call running in this
+    # thread; does nothing (at the cost of an attribute lookup) when there is none
+    stack = getattr(_calls, "stack", None)
+    if not stack or stack[-1] is None:
+        return _NO_PHASE_TIMER
+    return _PhaseTimer(stack[-1]["phases"], name)
+
+def _recordQuery(text):
+    stack = getattr(_calls, "stack", None)
+    if stack and stack[-1] is not None:
+        stack[-1]["queries"].append(text)
+
+@contextmanager
+def _callBarrier():
+    # The calls made in the with block belong to other processors: unless they are
+    # instrumented themselves, their phases and queries are not recorded on the event of
+    # the instrumented call running in this thread
+    stack = getattr(_calls, "stack", None)
+    if not stack:
+        yield
+        return
+    stack.append(None)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+class _MetricsRegistry(object):
+    # Totals of the events of every processor class and method since the last reset, with
+    # a histogram of the durations
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, event):
+        key = (event["processor"], event["method"])
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {"calls": 0, "errors": 0, "slowCalls": 0, "rows": 0, "seconds": 0.0,
+                                             "maxSeconds": 0.0, "phases": {}, "buckets": [0] * len(self.BUCKETS)}
+            series["calls"] += 1
+            series["errors"] += event["error"] is not None
+            series["slowCalls"] += event["slow"]
+            series["rows"] += event["rows"] or 0
+            series["seconds"] += event["seconds"]
+            series["maxSeconds"] = max(series["maxSeconds"], event["seconds"])
+            for phase, seconds in event["phases"].items():
+                series["phases"][phase] = series["phases"].get(phase, 0.0) + seconds
+            for position, bound in enumerate(self.BUCKETS):
+                if event["seconds"] <= bound:
+                    series["buckets"][position] += 1
+                    break
+
+    def snapshot(self):
+        with self.lock:
+            return {f"{processor}.{method}": dict(series, phases=dict(series["phases"]), buckets=list(series["buckets"]))
+                    for (processor, method), series in self.series.items()}
+
+    def text(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            items = sorted(self.series.items())
+            for name, kind, help in (("calls", "counter", "Instrumented calls"),
+                                     ("errors", "counter", "Instrumented calls that raised an error"),
+                                     ("slow_calls", "counter", "Calls slower than the slow query threshold"),
+                                     ("rows", "counter", "Rows returned by the instrumented calls"),
+                                     ("phase_seconds", "counter", "Seconds spent in each phase"),
+                                     ("call_seconds", "histogram", "Duration of the instrumented calls")):
+                lines.append(f"# HELP iiif_{name}{'_total' if kind == 'counter' else ''} {help}")
+                lines.append(f"# TYPE iiif_{name}{'_total' if kind == 'counter' else ''} {kind}")
+                for (processor, method), series in items:
+                    labels = f'processor="{processor}",method="{method}"'
+                    if name == "phase_seconds":
+                        for phase, seconds in sorted(series["phases"].items()):
+                            lines.append(f'iiif_phase_seconds_total{{{labels},phase="{phase}"}} {seconds!r}')
+                    elif name == "call_seconds":
+                        count = 0
+                        for bound, hits in zip(self.BUCKETS, series["buckets"]):
+                            count += hits
+                            lines.append(f'iiif_call_seconds_bucket{{{labels},le="{bound!r}"}} {count}')
+                        lines.append(f'iiif_call_seconds_bucket{{{labels},le="+Inf"}} {series["calls"]}')
+                        lines.append(f'iiif_call_seconds_sum{{{labels}}} {series["seconds"]!r}')
+                        lines.append(f'iiif_call_seconds_count{{{labels}}} {series["calls"]}')
+                    else:
+                        value = series["slowCalls" if name == "slow_calls" else name]
+                        lines.append(f"iiif_{name}_total{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+_metrics = _MetricsRegistry()
+
+def getMetrics():
+    # Totals per "Class.method" of the calls of all the instrumented processors
+    return _metrics.snapshot()
+
+def getMetricsText():
+    # The same totals in the Prometheus text format, to be served to a scraper
+    return _metrics.text()
+
+def resetMetrics():
+    _metrics.reset()
+    return True
+
+class _Instrumentation(object):
+    # The hooks and the slow query log of one processor
+    def __init__(self, slowQueryThreshold=None, slowQueryLogSize=100):
+        self.hooks = []
+        self.slowQueryThreshold = slowQueryThreshold
+        self.slowQueries = deque(maxlen=slowQueryLogSize)
+
+    def call(self, processor, name, method, args, kwargs):
+        event = {"processor": type(processor).__name__, "method": name, "arguments": args, "keywordArguments": kwargs,
+                 "started": time.time(), "seconds": 0.0, "phases": {}, "rows": None, "queries": [], "error": None}
+        stack = _calls.__dict__.setdefault("stack", [])
+        stack.append(event)
+        started = time.perf_counter()
+        try:
+            result = method(processor, *args, **kwargs)
+            if name == "uploadData":
+                report = processor.getUploadReport()
+                event["rows"] = report.get("rows", report.get("triples"))
+                if result is False:
+                    event["error"] = "upload failed"
+            elif hasattr(result, "__len__"):
+                event["rows"] = len(result)
+            else:
+                # a single entity (or None)
+                event["rows"] = int(result is not None)
+            return result
+        except Exception as e:
+            event["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            event["seconds"] = time.perf_counter() - started
+            stack.pop()
+            self.record(event)
+
+    def record(self, event):
+        event["slow"] = self.slowQueryThreshold is not None and event["seconds"] >= self.slowQueryThreshold
+        if event["slow"]:
+            self.slowQueries.append(event)
+            _logger.warning("Slow query: %s.%s took %.1f ms (%s rows)",
+                            event["processor"], event["method"], event["seconds"] * 1000, event["rows"])
+        _metrics.observe(event)
+        for hook in list(self.hooks):
+            try:
+                hook(event)
+            except Exception as e:
+                print(f"Error in instrumentation hook: {e}")
+
+def _instrumented(method):
+    # Records the call when instrumentation is enabled on the processor; otherwise the only
+    # cost is reading one attribute
+    name = method.__name__
+
+    @wraps(method)
+    def instrumentedMethod(self, *args, **kwargs):
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return method(self, *args, **kwargs)
+        return instrumentation.call(self, name, method, args, kwargs)
+    return instrumentedMethod
+
+class _Instrumented(object):
+    # Instrumentation methods shared by the processors and GenericQueryProcessor
+    instrumentation = None
+
+    def enableInstrumentation(self, slowQueryThreshold: float = None, slowQueryLogSize: int = 100):
+        # Calls taking at least slowQueryThreshold seconds go to the slow query log (the
+        # last slowQueryLogSize of them, see getSlowQueries)
+        hooks = self.instrumentation.hooks if self.instrumentation is not None else []
+        self.instrumentation = _Instrumentation(slowQueryThreshold, slowQueryLogSize)
+        self.instrumentation.hooks = hooks
+        return True
+
+    def disableInstrumentation(self):
+        self.instrumentation = None
+        return True
+
+    def addInstrumentationHook(self, hook):
+        # hook(event) is called after every instrumented call (instrumentation is enabled
+        # if it was not)
+        if self.instrumentation is None:
+            self.enableInstrumentation()
+        self.instrumentation.hooks.append(hook)
+        return True
+
+    def removeInstrumentationHook(self, hook):
+        if self.instrumentation is not None and hook in self.instrumentation.hooks:
+            self.instrumentation.hooks.remove(hook)
+        return True
+
+    def getSlowQueries(self):
+        if self.instrumentation is None:
+            return []
+        return list(self.instrumentation.slowQueries)
+
+class Processor(_Instrumented):
     def __init__(self, dbPathOrUrl=""):
         self.dbPathOrUrl = dbPathOrUrl
+        self.uploadReport = {}
 
     def getDbPathOrUrl(self):
         return self.dbPathOrUrl
 
+    def getUploadReport(self):
+        return self.uploadReport
+
     def setDbPathOrUrl(self, dbPathOrUrl:str):
         self.dbPathOrUrl = dbPathOrUrl
         return True
         
 # Relational database 
+# Pragmas applied to the connection used for loading: a WAL journal and a relaxed
+# synchronous mode avoid an fsync per page, a bigger page cache keeps indexes in memory
+_INGEST_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,
+    "temp_store": "MEMORY"
+}
+
+# Pragmas applied to the read-only connections of the query processors: the database file
+# is memory-mapped and every connection keeps a page cache of its own
+_READ_PRAGMAS = {
+    "mmap_size": 268435456,
+    "cache_size": -16000,
+    "temp_store": "MEMORY"
+}
+
+class _SqliteConnectionPool(object):
+    # Read-only connections to one database file shared by the threads using a query
+    # processor. A connection is used by one thread at a time and given back to the pool
+    # afterwards, so its prepared statements (cachedStatements per connection) and its page
+    # cache survive between queries.
+    def __init__(self, path, size=4, cachedStatements=256):
+        self.uri = "file:" + quote(os.path.abspath(path)) + "?mode=ro"
+        self.size = size
+        self.cachedStatements = cachedStatements
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _open(self):
+        con = connect(self.uri, uri=True, check_same_thread=False, cached_statements=self.cachedStatements)
+        for name, value in _READ_PRAGMAS.items():
+            con.execute(f"PRAGMA {name}={value}")
+        return con
+
+    @contextmanager
+    def connection(self):
+        with self.lock:
+            con = self.idle.pop() if self.idle else None
+        if con is None:
+            con = self._open()
+        try:
+            yield con
+        finally:
+            # a failed query must not leave a transaction open on a pooled connection
+            if con.in_transaction:
+                con.rollback()
+            self._release(con)
+
+    def _release(self, con):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(con)
+                return
+        con.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for con in idle:
+            con.close()
+
+def _internalIds(prefix, offset, count):
+    return (prefix + pd.Series(range(offset, offset + count), dtype="int64").astype("string")).array
+
+class _InternalIdSequence(object):
+    # Hands out consecutive internal ids ("annotation-0", "annotation-1", ...) starting
+    # after the highest one already stored in the table, so repeated loads do not reuse them
+    def __init__(self, con, table, prefix):
+        self.prefix = prefix
+        last = con.execute(f'SELECT MAX(CAST(substr("internalId", ?) AS INTEGER)) FROM "{table}" '
+                           f'WHERE "internalId" LIKE ?', (len(prefix) + 1, prefix + "%")).fetchone()[0]
+        self.next = 0 if last is None else last + 1
+
+    def take(self, count):
+        ids = _internalIds(self.prefix, self.next, count)
+        self.next += count
+        return ids
+
+def _createTable(con, table, columns):
+    column_list = ", ".join(f'"{column}" TEXT' for column in columns)
+    con.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({column_list})')
+
+def _insertRows(con, table, df):
+    column_list = ", ".join(f'"{column}"' for column in df.columns)
+    placeholders = ", ".join("?" for _ in df.columns)
+    # Column lists are much cheaper to iterate than the rows of a DataFrame
+    con.executemany(f'INSERT INTO "{table}" ({column_list}) VALUES ({placeholders})',
+                    zip(*(df[column].tolist() for column in df.columns)))
+
+def _ensureUpsertKey(con, table, key):
+    # Adds the contentHash column and the unique key needed by _upsertRows. Tables filled
+    # by earlier append loads may contain the same entity several times: only the last
+    # copy is kept before the unique index is created.
+    index = f"{table}_{key}_unique"
+    if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index,)).fetchone():
+        return
+    columns = [row[1] for row in con.execute(f'PRAGMA table_info("{table}")')]
+    if "contentHash" not in columns:
+        con.execute(f'ALTER TABLE "{table}" ADD COLUMN "contentHash" INTEGER')
+    con.execute(f'DELETE FROM "{table}" WHERE rowid NOT IN (SELECT MAX(rowid) FROM "{table}" GROUP BY "{key}")')
+    con.execute(f'CREATE UNIQUE INDEX "{index}" ON "{table}" ("{key}")')
+
+# Tables of the relational database, with their columns and the column identifying a row
+_RELATIONAL_TABLES = {
+    "Annotation": (["internalId", "id", "body", "target", "motivation"], "id"),
+    "Image": (["internalId", "body"], "body"),
+    "EntityWithMetadata": (["internalId", "id", "title", "creator"], "id"),
+    "Collection": (["internalId", "id", "title", "creator"], "id"),
+    "Manifest": (["internalId", "id", "title", "creator"], "id"),
+    "Canvas": (["internalId", "id", "title", "creator"], "id")
+}
+
+def _schemaV1(con):
+    # Explicit tables with a unique key. Databases created by DataFrame.to_sql already
+    # have the tables, which only get the key (and lose duplicated rows).
+    for table, (columns, key) in _RELATIONAL_TABLES.items():
+        _createTable(con, table, columns)
+        _ensureUpsertKey(con, table, key)
+
+def _schemaV2(con):
+    # Indexes for the lookups done by the query processors
+    con.execute('CREATE INDEX IF NOT EXISTS "Annotation_target" ON "Annotation" ("target")')
+    con.execute('CREATE INDEX IF NOT EXISTS "Annotation_body" ON "Annotation" ("body")')
+    con.execute('CREATE INDEX IF NOT EXISTS "EntityWithMetadata_title" ON "EntityWithMetadata" ("title")')
+
+def _normalizeCreator(name):
+    return " ".join(name.split()).casefold()
+
+def _creatorRows(entities):
+    # One (entityId, name, normName) row per creator of each entity: the creator field
+    # lists several creators separated by semicolons, e.g. "Doe, John; Doe, Jane"
+    creators = entities[["id", "creator"]].astype(object).copy()
+    creators["creator"] = creators["creator"].str.split(";")
+    creators = creators.explode("creator")
+    creators["creator"] = creators["creator"].str.strip()
+    creators = creators[creators["creator"].fillna("") != ""]
+    return DataFrame({
+        "entityId": creators["id"],
+        "name": creators["creator"],
+        "normName": [_normalizeCreator(name) for name in creators["creator"].tolist()]
+    })
+
+def _replaceCreators(con, entities):
+    con.execute('DELETE FROM "Creator" WHERE "entityId" IN (SELECT value FROM json_each(?))',
+                (json.dumps(entities["id"].tolist()),))
+    _insertRows(con, "Creator", _creatorRows(entities))
+
+def _schemaV3(con):
+    # Creators split into their own table, and a full-text index on titles and creators
+    # kept in sync with EntityWithMetadata by triggers
+    con.execute('CREATE TABLE IF NOT EXISTS "Creator" ("entityId" TEXT, "name" TEXT, "normName" TEXT)')
+    con.execute('CREATE INDEX IF NOT EXISTS "Creator_normName" ON "Creator" ("normName")')
+    con.execute('CREATE INDEX IF NOT EXISTS "Creator_entityId" ON "Creator" ("entityId")')
+    entities = read_sql('SELECT "id", "creator" FROM "EntityWithMetadata"', con)
+    _replaceCreators(con, entities)
+
+    con.execute('CREATE VIRTUAL TABLE IF NOT EXISTS "EntitySearch" USING fts5('
+                '"title", "creator", content="EntityWithMetadata", content_rowid="rowid", '
+                'tokenize="unicode61 remove_diacritics 2")')
+    con.execute('CREATE TRIGGER IF NOT EXISTS "EntitySearch_insert" AFTER INSERT ON "EntityWithMetadata" BEGIN '
+                'INSERT INTO "EntitySearch" (rowid, "title", "creator") VALUES (new.rowid, new."title", new."creator"); END')
+    con.execute('CREATE TRIGGER IF NOT EXISTS "EntitySearch_delete" AFTER DELETE ON "EntityWithMetadata" BEGIN '
+                'INSERT INTO "EntitySearch" ("EntitySearch", rowid, "title", "creator") '
+                'VALUES (\'delete\', old.rowid, old."title", old."creator"); END')
+    con.execute('CREATE TRIGGER IF NOT EXISTS "EntitySearch_update" AFTER UPDATE ON "EntityWithMetadata" BEGIN '
+                'INSERT INTO "EntitySearch" ("EntitySearch", rowid, "title", "creator") '
+                'VALUES (\'delete\', old.rowid, old."title", old."creator"); '
+                'INSERT INTO "EntitySearch" (rowid, "title", "creator") VALUES (new.rowid, new."title", new."creator"); END')
+    con.execute('INSERT INTO "EntitySearch" ("EntitySearch") VALUES (\'rebuild\')')
+
+def _iiifTypes(ids):
+    # The type of an entity (Collection, Manifest or Canvas) as named in the path of its
+    # IIIF identifier, e.g. .../28429/collection, .../28429/manifest, .../28429/canvas/p1.
+    # Canvas is matched last since canvas identifiers may include the manifest path.
+    lower = ids.astype(object).str.lower()
+    types = Series([None] * len(ids), index=ids.index, dtype=object)
+    for entityType in ("Collection", "Manifest", "Canvas"):
+        matches = lower.str.contains(f"/{entityType.lower()}s?(?:/|\\.json$|$)", regex=True, na=False)
+        types = types.mask(matches.astype(bool), entityType)
+    return types
+
+def _schemaV4(con):
+    # One row per entity: Collection, Manifest and Canvas are no longer copies of the whole
+    # EntityWithMetadata table but views on the entities of their type
+    columns = [row[1] for row in con.execute('PRAGMA table_info("EntityWithMetadata")')]
+    if "type" not in columns:
+        con.execute('ALTER TABLE "EntityWithMetadata" ADD COLUMN "type" TEXT')
+    entities = read_sql('SELECT rowid AS "row", "id" FROM "EntityWithMetadata"', con, dtype={"id": "string"})
+    con.executemany('UPDATE "EntityWithMetadata" SET "type" = ? WHERE rowid = ?',
+                    zip(_iiifTypes(entities["id"]).tolist(), entities["row"].tolist()))
+    con.execute('CREATE INDEX IF NOT EXISTS "EntityWithMetadata_type" ON "EntityWithMetadata" ("type")')
+    for entityType in ("Collection", "Manifest", "Canvas"):
+        con.execute(f'DROP TABLE IF EXISTS "{entityType}"')
+        con.execute(f'CREATE VIEW IF NOT EXISTS "{entityType}" AS '
+                    f'SELECT "internalId", "id", "title", "creator" FROM "EntityWithMetadata" WHERE "type" = \'{entityType}\'')
+
+# The migration at position n brings the database from version n to version n + 1;
+# the current version is stored in PRAGMA user_version
+_RELATIONAL_MIGRATIONS = [_schemaV1, _schemaV2, _schemaV3, _schemaV4]
+
+def _migrateRelational(con):
+    # Must run inside a transaction, so that a failed migration leaves the database untouched
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    for migration in _RELATIONAL_MIGRATIONS[version:]:
+        migration(con)
+    con.execute(f"PRAGMA user_version = {len(_RELATIONAL_MIGRATIONS)}")
+    return len(_RELATIONAL_MIGRATIONS)
+
+def upgradeRelationalDatabase(dbPath):
+    # Brings an existing relational database (e.g. one created by an older version of
+    # this module) to the current schema and returns the schema version
+    con = connect(dbPath, isolation_level=None)
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        version = _migrateRelational(con)
+        con.execute("COMMIT")
+        return version
+    except Exception:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+
+def _upsertRows(con, table, key, df, ids):
+    # Writes the rows of df that are new or whose content changed since the last load.
+    # Returns how many rows were inserted, updated and left unchanged, and the rows written.
+    df = df.drop_duplicates(subset=[key], keep="last")
+    hashes = pd.util.hash_pandas_object(df, index=False).to_numpy().view("int64")
+    keys = df[key].tolist()
+    existing = dict(con.execute(f'SELECT "{key}", "contentHash" FROM "{table}" '
+                                f'WHERE "{key}" IN (SELECT value FROM json_each(?))', (json.dumps(keys),)))
+    is_new = [k not in existing for k in keys]
+    is_changed = [k in existing and existing[k] != h for k, h in zip(keys, hashes.tolist())]
+    inserted = sum(is_new)
+    updated = sum(is_changed)
+    write_mask = [new or changed for new, changed in zip(is_new, is_changed)]
+    written = df[write_mask]
+
+    if inserted or updated:
+        rows = written.copy()
+        # updated rows keep the internal id they were given when first inserted
+        new_ids = iter(ids.take(inserted))
+        rows.insert(0, "internalId", [next(new_ids) if new else None for new, write in zip(is_new, write_mask) if write])
+        rows["contentHash"] = hashes[write_mask]
+
+        column_list = ", ".join(f'"{column}"' for column in rows.columns)
+        placeholders = ", ".join("?" for _ in rows.columns)
+        assignments = ", ".join(f'"{column}" = excluded."{column}"' for column in rows.columns
+                                if column not in ("internalId", key))
+        con.executemany(f'INSERT INTO "{table}" ({column_list}) VALUES ({placeholders}) '
+                        f'ON CONFLICT("{key}") DO UPDATE SET {assignments}',
+                        zip(*(rows[column].tolist() for column in rows.columns)))
+
+    return {"inserted": inserted, "updated": updated, "unchanged": len(keys) - inserted - updated}, written
+
+def _appendRows(con, table, key, df, ids):
+    # Inserts the rows of df whose key is not in the table yet (the first one of rows with
+    # the same key); rows with a key already stored are left as they are, even if their
+    # content changed. Returns the same counts as _upsertRows and the rows written.
+    df = df.drop_duplicates(subset=[key], keep="first")
+    keys = df[key].tolist()
+    existing = set(row[0] for row in con.execute(f'SELECT "{key}" FROM "{table}" '
+                                                 f'WHERE "{key}" IN (SELECT value FROM json_each(?))', (json.dumps(keys),)))
+    written = df[[k not in existing for k in keys]]
+    if len(written):
+        rows = written.copy()
+        # the same hash as _upsertRows, so a later upsert of the same rows changes nothing
+        rows["contentHash"] = pd.util.hash_pandas_object(written, index=False).to_numpy().view("int64")
+        rows.insert(0, "internalId", ids.take(len(rows)))
+        _insertRows(con, table, rows)
+    return {"inserted": len(written), "updated": 0, "unchanged": len(keys) - len(written)}, written
+
+def _bulkLoad(dbPath, chunks, writeChunk, prepare):
+    # Migrates the database to the current schema, calls prepare(con) and then
+    # writeChunk(con, chunk) for every chunk, all inside a single transaction, and
+    # returns the load report. writeChunk returns how many rows
+    # of the chunk were inserted, updated and left unchanged.
+    started = time.perf_counter()
+    report = {"rows": 0, "inserted": 0, "updated": 0, "unchanged": 0, "chunks": 0}
+    con = connect(dbPath, isolation_level=None)
+    try:
+        for name, value in _INGEST_PRAGMAS.items():
+            con.execute(f"PRAGMA {name}={value}")
+        con.execute("BEGIN")
+        _migrateRelational(con)
+        prepare(con)
+        for chunk in chunks:
+            report["rows"] += len(chunk)
+            report["chunks"] += 1
+            for count, value in writeChunk(con, chunk).items():
+                report[count] += value
+        con.execute("COMMIT")
+    except Exception:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+    report["seconds"] = time.perf_counter() - started
+    report["rowsPerSecond"] = report["rows"] / report["seconds"] if report["seconds"] > 0 else 0.0
+    return report
+
 class MetadataProcessor(Processor):
     def __init__(self, dbPathOrUrl=""):
         super().__init__(dbPathOrUrl)
 
-    def uploadData(self, path):
+    @_instrumented
+    def uploadData(self, path, chunkSize=100000, mode="upsert", workers=None):
         self.path = path
+        # a failed upload must not report the rows of the previous one
+        self.uploadReport = {}
 
         try:
-            entities_with_metadata = pd.read_csv(path, 
-                                keep_default_na=False,
-                                dtype={
+            if mode not in ("upsert", "append"):
+                raise ValueError(f"Unknown upload mode: {mode}")
+            ids = {}
+
+            def prepare(con):
+                ids["EntityWithMetadata"] = _InternalIdSequence(con, "EntityWithMetadata", "metadata-")
+
+            def writeChunk(con, entities_with_metadata):
+                # Every entity is written once; the Collection, Manifest and Canvas views
+                # select the entities of their type
+                entities_with_metadata["type"] = _iiifTypes(entities_with_metadata["id"])
+                if mode == "upsert":
+                    counts, written = _upsertRows(con, "EntityWithMetadata", "id", entities_with_metadata, ids["EntityWithMetadata"])
+                    _replaceCreators(con, written)
+                    return counts
+
+                counts, written = _appendRows(con, "EntityWithMetadata", "id", entities_with_metadata, ids["EntityWithMetadata"])
+                _insertRows(con, "Creator", _creatorRows(written))
+                return counts
+
+            paths = _expandPaths(path)
+            chunks = _csvChunks(paths, {
                                     "id": "string",
                                     "title": "string",
                                     "creator": "string"
-                                })
-            
-            entity_with_metadata_internal_id = []
-            for idx, row in entities_with_metadata.iterrows():
-                entity_with_metadata_internal_id.append("metadata-" + str(idx))
-            entities_with_metadata.insert(0, "internalId", Series(entity_with_metadata_internal_id, dtype="string"))
-
-            collections = entities_with_metadata[["id", "title", "creator"]].drop_duplicates().reset_index(drop=True)
-            collection_internal_id = ["collection-" + str(idx) for idx in range(len(collections))]
-            collections.insert(0, "internalId", collection_internal_id)
-
-            manifests = entities_with_metadata[["id", "title", "creator"]].drop_duplicates().reset_index(drop=True)
-            manifest_internal_id = ["manifest-" + str(idx) for idx in range(len(manifests))]
-            manifests.insert(0, "internalId", manifest_internal_id)
-
-            canvases = entities_with_metadata[["id", "title", "creator"]].drop_duplicates().reset_index(drop=True)
-            canvas_internal_id = ["canvas-" + str(idx) for idx in range(len(canvases))]
-            canvases.insert(0, "internalId", canvas_internal_id)
-
-            with connect(self.dbPathOrUrl) as con:
-                entities_with_metadata.to_sql("EntityWithMetadata", con, if_exists="append", index=False)
-                collections.to_sql("Collection", con, if_exists="append", index=False)
-                manifests.to_sql("Manifest", con, if_exists="append", index=False)
-                canvases.to_sql("Canvas", con, if_exists="append", index=False)
-            con.commit()
+                                }, chunkSize, _workersFor(paths, workers))
+            self.uploadReport = _bulkLoad(self.dbPathOrUrl, chunks, writeChunk, prepare)
+            self.uploadReport["files"] = len(paths)
             return True
 
         except Exception as e:
             print(f"Error while uploading data: {e}")
             
             return False
+        finally:
+            # even a failed upload may have written part of the data
+            _bumpStoreGeneration(self.dbPathOrUrl)
         
 class AnnotationProcessor(Processor):
     def __init__(self, dbPathOrUrl=""):
         super().__init__(dbPathOrUrl)
 
-    def uploadData(self, path):
+    @_instrumented
+    def uploadData(self, path, chunkSize=100000, mode="upsert", workers=None):
         self.path = path
+        # a failed upload must not report the rows of the previous one
+        self.uploadReport = {}
 
         try:
-            annotations= pd.read_csv(path, 
-                                    keep_default_na=False,
-                                    dtype={
-                                        "id": "string",
-                                        "body": "string",
-                                        "target": "string",
-                                        "motivation": "string",
-                                    })
-
-            annotation_internal_id = []
-            for idx, row in annotations.iterrows():
-                annotation_internal_id.append("annotation-" + str(idx))
-            annotations.insert(0, "internalId", Series(annotation_internal_id, dtype="string"))
-
-            image = annotations[["body"]]
-            image_internal_id = ["image-" + str(idx) for idx in range(len(image))]
-            image.insert(0, "internalId", image_internal_id)
-
-            with connect(self.dbPathOrUrl) as con:
-                annotations.to_sql("Annotation", con, if_exists="append", index=False)
-                image.to_sql("Image", con, if_exists="append", index=False)
-            con.commit()
+            if mode not in ("upsert", "append"):
+                raise ValueError(f"Unknown upload mode: {mode}")
+            ids = {}
+
+            def prepare(con):
+                ids["Annotation"] = _InternalIdSequence(con, "Annotation", "annotation-")
+                ids["Image"] = _InternalIdSequence(con, "Image", "image-")
+
+            def writeChunk(con, annotations):
+                if mode == "upsert":
+                    counts = _upsertRows(con, "Annotation", "id", annotations, ids["Annotation"])[0]
+                    _upsertRows(con, "Image", "body", annotations[["body"]], ids["Image"])
+                    return counts
+
+                counts = _appendRows(con, "Annotation", "id", annotations, ids["Annotation"])[0]
+                _appendRows(con, "Image", "body", annotations[["body"]], ids["Image"])
+                return counts
+
+            paths = _expandPaths(path)
+            chunks = _csvChunks(paths, {
+                                    "id": "string",
+                                    "body": "string",
+                                    "target": "string",
+                                    "motivation": "string",
+                                }, chunkSize, _workersFor(paths, workers))
+            self.uploadReport = _bulkLoad(self.dbPathOrUrl, chunks, writeChunk, prepare)
+            self.uploadReport["files"] = len(paths)
             return True
 
         except Exception as e:
             print(f"Error while uploading data: {e}")
             return False
+        finally:
+            # even a failed upload may have written part of the data
+            _bumpStoreGeneration(self.dbPathOrUrl)
                
 # RDF triplestore
+def _ntTerm(term):
+    # N-Triples form of a term, valid both in a N-Triples body and inside INSERT DATA
+    from rdflib import URIRef
+    if isinstance(term, URIRef):
+        return f"<{term}>"
+    value = str(term).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r")
+    if term.language:
+        return f'"{value}"@{term.language}'
+    if term.datatype:
+        return f'"{value}"^^<{term.datatype}>'
+    return f'"{value}"'
+
+def _sparqlString(value):
+    # A string as a SPARQL literal
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r") + '"'
+
+def _isRemote(dbPathOrUrl):
+    return dbPathOrUrl.startswith(("http://", "https://"))
+
+class _LocalGraphStore(object):
+    # Embedded triplestore used when the graph database is a file path instead of the URL
+    # of a SPARQL endpoint. The file is an append-only N-Triples document, loaded once per
+    # process into an rdflib graph that answers the same SPARQL queries as the endpoint.
+    _stores = {}
+    _storesLock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.graph = None
+        self.size = -1
+
+    @classmethod
+    def open(cls, path):
+        path = os.path.abspath(path)
+        with cls._storesLock:
+            if path not in cls._stores:
+                cls._stores[path] = cls(path)
+            return cls._stores[path]
+
+    def _load(self):
+        # (Re)loads the file if another process appended triples to it since the last load
+        from rdflib import Graph
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if self.graph is None or size != self.size:
+            graph = Graph()
+            if size:
+                graph.parse(self.path, format="nt")
+            self.graph = graph
+            self.size = size
+        return self.graph
+
+    def append(self, ntriples):
+        # Only the triples that are not in the store yet are written, so uploading the
+        # same data again leaves the file as it is
+        from rdflib import Graph
+        with self.lock:
+            graph = self._load()
+            triples = [triple for triple in Graph().parse(data=ntriples, format="nt") if triple not in graph]
+            if not triples:
+                return
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(" ".join(_ntTerm(term) for term in triple) + " .\n" for triple in triples))
+            for triple in triples:
+                graph.add(triple)
+            self.size = os.path.getsize(self.path)
+
+    def select(self, query):
+        with self.lock:
+            result = self._load().query(query)
+            columns = [str(variable) for variable in result.vars]
+            rows = [[None if value is None else str(value) for value in row] for row in result]
+        return DataFrame(rows, columns=columns)
+
+class _TripleUploader(object):
+    # Sends triples to a SPARQL endpoint in chunks instead of one request per triple.
+    # mode "insert" wraps each chunk in a SPARQL INSERT DATA update, mode "ntriples"
+    # posts the chunk as an N-Triples document to the endpoint. If the endpoint is a
+    # file path, chunks are appended to the embedded store instead.
+    def __init__(self, endpoint, batchSize=5000, mode="insert", maxRetries=3, timeout=60):
+        if mode not in ("insert", "ntriples"):
+            raise ValueError(f"Unknown upload mode: {mode}")
+        self.endpoint = endpoint
+        self.batchSize = batchSize
+        self.mode = mode
+        self.maxRetries = maxRetries
+        self.timeout = timeout
+        self.chunk = []
+        self.triples = 0
+        self.chunks = 0
+        self.retries = 0
+        self.started = time.perf_counter()
+
+    def add(self, triple):
+        self.chunk.append(" ".join(_ntTerm(term) for term in triple) + " .")
+        if len(self.chunk) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        import http.client
+        from urllib.error import HTTPError
+        if not self.chunk:
+            return
+        body = "\n".join(self.chunk)
+        attempt = 0
+        while True:
+            try:
+                self._send(body)
+                break
+            except (http.client.HTTPException, OSError) as e:
+                # Besides URLError, a dropped connection or a garbled response surfaces as
+                # a plain OSError or HTTPException. Client errors will fail again in the
+                # same way, so only retry the others
+                if (isinstance(e, HTTPError) and e.code < 500) or attempt >= self.maxRetries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                time.sleep(0.5 * 2 ** (attempt - 1))
+        self.triples += len(self.chunk)
+        self.chunks += 1
+        self.chunk = []
+
+    def _send(self, body):
+        from urllib.request import Request, urlopen
+        if not _isRemote(self.endpoint):
+            _LocalGraphStore.open(self.endpoint).append(body)
+            return
+        if self.mode == "insert":
+            data = urlencode({"update": "INSERT DATA {\n" + body + "\n}"}).encode("utf-8")
+            contentType = "application/x-www-form-urlencoded"
+        else:
+            # text/plain is the N-Triples media type understood by Blazegraph
+            data = body.encode("utf-8")
+            contentType = "text/plain"
+        request = Request(self.endpoint, data=data, method="POST", headers={"Content-Type": contentType})
+        with urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    def report(self):
+        seconds = time.perf_counter() - self.started
+        return {
+            "triples": self.triples,
+            "chunks": self.chunks,
+            "retries": self.retries,
+            "seconds": seconds,
+            "triplesPerSecond": self.triples / seconds if seconds > 0 else 0.0
+        }
+
+_WHITESPACE = re.compile(r"[ \t\r\n]*")
+_NUMBER_TAIL = re.compile(r"[-+.eE0-9]*\Z")
+
+class _JsonStream(object):
+    # Pull parser over a JSON text file: the file is read in blocks and only the value
+    # currently being decoded is kept in memory
+    def __init__(self, f, blockSize=1 << 16):
+        self.f = f
+        self.blockSize = blockSize
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+
+    def _read(self):
+        # Values longer than a block make the read size grow, so decoding them stays linear
+        data = self.f.read(max(self.blockSize, len(self.buffer) - self.pos))
+        if not data:
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read():
+                return ""
+
+    def take(self, expected=None):
+        char = self.peek()
+        if expected is not None and char not in expected:
+            raise ValueError(f"Expected one of {expected!r} but found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._read():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next block ("12" of "12.5e3")
+            if (isinstance(value, (int, float)) and _NUMBER_TAIL.match(self.buffer, end)
+                    and self._read()):
+                continue
+            self.pos = end
+            return value
+
+_IIIF_LEVELS = ("Collection", "Manifest", "Canvas")
+
+def _walkIIIFObject(stream, depth, parentId):
+    # Yields (type, id, label, parentId) for the object and, depth first, for its items.
+    # The object itself is yielded as soon as its "items" start, so its children never
+    # need to be held in memory; only if "id" comes after "items" they are kept until the end.
+    fields = {}
+    emitted = False
+    pending = []
+    stream.take("{")
+    if stream.peek() == "}":
+        stream.take()
+    else:
+        while True:
+            key = stream.value()
+            stream.take(":")
+            if key == "items" and depth < len(_IIIF_LEVELS) - 1:
+                if "id" in fields and "label" in fields:
+                    yield (_IIIF_LEVELS[depth], fields["id"], fields["label"]["none"][0], parentId)
+                    emitted = True
+                stream.take("[")
+                if stream.peek() == "]":
+                    stream.take()
+                else:
+                    while True:
+                        for entity in _walkIIIFObject(stream, depth + 1, fields.get("id")):
+                            if "id" in fields:
+                                yield entity
+                            else:
+                                pending.append(entity)
+                        if stream.take(",]") == "]":
+                            break
+            else:
+                fields[key] = stream.value()
+            if stream.take(",}") == "}":
+                break
+    if not emitted:
+        yield (_IIIF_LEVELS[depth], fields["id"], fields["label"]["none"][0], parentId)
+    for entityType, entityId, label, entityParent in pending:
+        yield (entityType, entityId, label, fields["id"] if entityParent is None else entityParent)
+
+def _iterIIIFEntities(path):
+    with open(path, "r", encoding="utf-8") as f:
+        yield from _walkIIIFObject(_JsonStream(f), 0, None)
+
+def _iiifFileChunks(path, chunkSize=10000):
+    chunk = []
+    for entity in _iterIIIFEntities(path):
+        chunk.append(entity)
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _collectionEntities(paths, workers):
+    # The entities of every file, in order, sent by the process uploading the triples (see
+    # _fileChunks for how several files are parsed in parallel)
+    if workers == 1:
+        for path in paths:
+            yield from _iterIIIFEntities(path)
+    else:
+        for entities in _fileChunks(paths, _iiifFileChunks, workers):
+            yield from entities
+
+def _packStrings(strings):
+    # Strings as one UTF-8 buffer plus the offset (in characters) of each of them, instead
+    # of a numpy string array padded to the longest one or a bytes object per string
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, strings), dtype=np.int64, count=len(strings)), out=offsets[1:])
+    return np.frombuffer("".join(strings).encode("utf-8"), dtype=np.uint8), offsets
+
+def _unpackStrings(buffer, offsets):
+    text = buffer.tobytes().decode("utf-8")
+    bounds = offsets.tolist()
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])]
+
+def _containmentIndexPath(dbPathOrUrl):
+    # Next to the file of an embedded store; in the user's cache folder for an endpoint
+    if _isRemote(dbPathOrUrl):
+        cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cache, "iiif-containment", quote(dbPathOrUrl, safe="") + ".npz")
+    return os.path.abspath(dbPathOrUrl) + ".containment.npz"
+
+# Every upload to an endpoint replaces the value of this triple with a new random one, and
+# the containment index records the value it was built for: an index whose value is no
+# longer the one in the endpoint misses some upload
+_STORE_MARKER = ("urn:iiif-containment:store", "urn:iiif-containment:upload")
+_STORE_MARKER_QUERY = f"SELECT ?marker WHERE {{ <{_STORE_MARKER[0]}> <{_STORE_MARKER[1]}> ?marker }}"
+
+def _sparqlSelect(url, query, timeout=30):
+    # A single SELECT query sent to an endpoint outside of a query processor
+    pool = _SparqlHttpPool(url, size=1, timeout=timeout)
+    try:
+        return _decodeSparqlResult(*pool.select(query, _SPARQL_ACCEPT))
+    finally:
+        pool.close()
+
+def _writeStoreMarker(url, timeout=60):
+    from urllib.request import Request, urlopen
+    marker = os.urandom(16).hex()
+    subject, predicate = _STORE_MARKER
+    update = (f"DELETE WHERE {{ <{subject}> <{predicate}> ?marker }} ;\n"
+              f"INSERT DATA {{ <{subject}> <{predicate}> \"{marker}\" }}")
+    request = Request(url, data=urlencode({"update": update}).encode("utf-8"), method="POST",
+                      headers={"Content-Type": "application/x-www-form-urlencoded"})
+    with urlopen(request, timeout=timeout) as response:
+        response.read()
+    return marker
+
+def _markerStamp(df):
+    return ",".join(sorted(df["marker"].dropna().astype(str).tolist()))
+
+def _storeStamp(dbPathOrUrl):
+    # What the containment index records to tell whether it still describes the store:
+    # the size of the file of an embedded store, the marker of the last upload for an
+    # endpoint ("" if there is none)
+    if _isRemote(dbPathOrUrl):
+        return _markerStamp(_sparqlSelect(dbPathOrUrl, _STORE_MARKER_QUERY))
+    try:
+        return str(os.path.getsize(dbPathOrUrl))
+    except OSError:
+        return "0"
+
+def _storeIsEmpty(dbPathOrUrl):
+    if _isRemote(dbPathOrUrl):
+        return len(_sparqlSelect(dbPathOrUrl, "SELECT ?s WHERE { ?s ?p ?o } LIMIT 1")) == 0
+    return _storeStamp(dbPathOrUrl) == "0"
+
+def _currentContainmentIndex(dbPathOrUrl, storeStamp):
+    # The index of the store, or None if there is none or it does not describe the store
+    # as it is now (the store changed without updating the index)
+    index = _ContainmentIndex.open(_containmentIndexPath(dbPathOrUrl))
+    if index is None or index.storeStamp != storeStamp:
+        return None
+    return index
+
+class _ContainmentIndex(object):
+    # The collection -> manifest -> canvas hierarchy of a graph database, built by
+    # CollectionProcessor while uploading and saved next to the store. Entities are numbered
+    # by position (with their type and label); the items of the entity at position i are
+    # children[offsets[i]:offsets[i + 1]], i.e. a CSR adjacency list of integer arrays.
+    TYPES = ("Collection", "Manifest", "Canvas")
+    _indexes = {}
+    _indexesLock = threading.Lock()
+
+    def __init__(self, ids, types, labels, offsets, children, storeStamp=None):
+        self.ids = ids
+        self.types = types
+        self.labels = labels
+        self.offsets = offsets
+        self.children = children
+        # the _storeStamp of the store when the index was saved, to tell whether it is current
+        self.storeStamp = storeStamp
+        self.positions = {entityId: position for position, entityId in enumerate(ids)}
+
+    @classmethod
+    def open(cls, path):
+        # The index saved at path, loaded again if the file changed; None without a file
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return None
+        stamp = (info.st_ino, info.st_size, info.st_mtime_ns)
+        with cls._indexesLock:
+            cached = cls._indexes.get(path)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+        index = cls.load(path)
+        with cls._indexesLock:
+            cls._indexes[path] = (stamp, index)
+        return index
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls(_unpackStrings(arrays["ids"], arrays["idOffsets"]),
+                       arrays["types"].tolist(),
+                       _unpackStrings(arrays["labels"], arrays["labelOffsets"]),
+                       arrays["offsets"], arrays["children"],
+                       str(arrays["storeStamp"]) if "storeStamp" in arrays else None)
+
+    def save(self, path):
+        # Written to a temporary file first, so readers never see half an index
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ids, idOffsets = _packStrings(self.ids)
+        labels, labelOffsets = _packStrings(self.labels)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            np.savez(f, ids=ids, idOffsets=idOffsets, labels=labels, labelOffsets=labelOffsets,
+                     types=np.asarray(self.types, dtype=np.int8), offsets=self.offsets, children=self.children,
+                     storeStamp=np.str_(self.storeStamp))
+        os.replace(temporary, path)
+
+    @classmethod
+    def empty(cls, storeStamp=None):
+        return cls([], [], [], np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), storeStamp)
+
+    def descendants(self, entityId, path):
+        # Positions of the entities reached from entityId following the types in path,
+        # e.g. ("Collection", "Manifest", "Canvas") for the canvases of a collection
+        position = self.positions.get(entityId)
+        if position is None or self.types[position] != self.TYPES.index(path[0]):
+            return []
+        level = [position]
+        for entityType in path[1:]:
+            code = self.TYPES.index(entityType)
+            reached = dict.fromkeys(item for parent in level
+                                    for item in self.children[self.offsets[parent]:self.offsets[parent + 1]].tolist()
+                                    if self.types[item] == code)
+            level = list(reached)
+        return level
+
+    def frame(self, positions, columns=("id", "label")):
+        values = {"id": self.ids, "label": self.labels}
+        return DataFrame({column: [values[column][position] for position in positions] for column in columns},
+                         columns=list(columns))
+
+    def items(self, entityIds):
+        rows = []
+        for entityId in dict.fromkeys(entityIds):
+            position = self.positions.get(entityId)
+            if position is None:
+                continue
+            for item in self.children[self.offsets[position]:self.offsets[position + 1]].tolist():
+                rows.append((entityId, self.ids[item], self.TYPES[self.types[item]], self.labels[item]))
+        return DataFrame(rows, columns=["parent", "id", "type", "label"])
+
+class _ContainmentIndexBuilder(object):
+    # Adds the entities of an upload to the index while they stream: new entities are
+    # appended to a private copy of the index (known ones keep their position), the new
+    # edges are kept as two arrays of positions, and the adjacency arrays are rebuilt once
+    # at the end. Nothing else of the upload is kept in memory.
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+        self.parents = array("q")
+        self.items = array("q")
+
+    @classmethod
+    def start(cls, dbPathOrUrl):
+        # None when the upload cannot be added to the index: there is no index describing
+        # the whole store (an empty store starts a new, empty index)
+        path = _containmentIndexPath(dbPathOrUrl)
+        if _storeIsEmpty(dbPathOrUrl):
+            return cls(path, _ContainmentIndex.empty())
+        index = _ContainmentIndex.load(path) if os.path.exists(path) else None
+        if index is None or index.storeStamp != _storeStamp(dbPathOrUrl):
+            return None
+        return cls(path, index)
+
+    def add(self, entityType, entityId, label, parentId):
+        index = self.index
+        position = index.positions.get(entityId)
+        if position is None:
+            position = index.positions[entityId] = len(index.ids)
+            index.ids.append(entityId)
+            index.types.append(index.TYPES.index(entityType))
+            index.labels.append(label)
+        else:
+            index.types[position] = index.TYPES.index(entityType)
+            index.labels[position] = label
+        parent = index.positions.get(parentId) if parentId is not None else None
+        if parent is not None:
+            self.parents.append(parent)
+            self.items.append(position)
+
+    def save(self, storeStamp):
+        index = self.index
+        parents = np.concatenate([np.repeat(np.arange(len(index.offsets) - 1, dtype=np.int64), np.diff(index.offsets)),
+                                  np.frombuffer(self.parents, dtype=np.int64)])
+        items = np.concatenate([index.children.astype(np.int64), np.frombuffer(self.items, dtype=np.int64)])
+        pairs = np.unique(np.stack([parents, items], axis=1), axis=0)
+        index.offsets = np.zeros(len(index.ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs[:, 0], minlength=len(index.ids)), out=index.offsets[1:])
+        index.children = pairs[:, 1].astype(np.int32)
+        index.storeStamp = storeStamp
+        index.save(self.path)
+
+def _dropContainmentIndex(dbPathOrUrl):
+    # After a failed upload the index may miss part of what reached the store: queries go
+    # back to the store until the next complete upload builds the index again
+    try:
+        os.remove(_containmentIndexPath(dbPathOrUrl))
+    except FileNotFoundError:
+        pass
+
 class CollectionProcessor(Processor):
     def __init__(self, dbPathOrUrl=""):
         super().__init__(dbPathOrUrl)
 
-    def uploadData(self, path):
+    @_instrumented
+    def uploadData(self, path, batchSize=5000, mode="insert", maxRetries=3, workers=None):
         self.path = path
+        # a failed upload must not report the rows of the previous one
+        self.uploadReport = {}
         
         try:
-                base_url = "https://github.com/anitavishinskaite/data_science"
-
-                graph = Graph()
-
-                # classes of resources
-                Collection = URIRef("https://schema.org/Collection")
-                Manifest = URIRef("https://dbpedia.org/page/Manifest")
-                Canvas = URIRef("https://dbpedia.org/page/Canvas")
-
-                # attributes related to classes
-                id = URIRef("https://schema.org/identifier")
-                label = URIRef("https://dbpedia.org/page/label")
-
-                # relations among classes
-                items = URIRef("https://schema.org/isPartOf")
-            
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                
-                    collection_uri = URIRef(data['id'])
-                    graph.add((collection_uri, RDF.type, Collection))
-                    graph.add((collection_uri, id, Literal(data['id'])))
-                    graph.add((collection_uri, label, Literal(data['label']['none'][0])))
-
-
-                    for manifest in data['items']:
-                        manifest_uri = URIRef(manifest['id'])
-                        graph.add((manifest_uri, RDF.type, Manifest))
-                        graph.add((manifest_uri, id, Literal(manifest['id'])))
-                        graph.add((manifest_uri, label, Literal(manifest['label']['none'][0])))
-
-                        graph.add((collection_uri, items, manifest_uri))
-
-                        for canvas in manifest['items']:
-                            canvas_uri = URIRef(canvas['id'])
-                            graph.add((canvas_uri, RDF.type, Canvas))
-                            graph.add((canvas_uri, id, Literal(canvas['id'])))
-                            graph.add((canvas_uri, label, Literal(canvas['label']['none'][0])))
-
-                            graph.add((manifest_uri, items, canvas_uri))
-
-                store = SPARQLUpdateStore(graph)
-                endpoint = self.dbPathOrUrl
-                store.open((endpoint, endpoint))
-                for triple in graph.triples((None, None, None)):
-                    store.add(triple)
-                store.close()
-                return True
-
+            from rdflib import Literal, URIRef
+            from rdflib.namespace import RDF
+
+            # classes of resources
+            classes = {
+                "Collection": URIRef("https://schema.org/Collection"),
+                "Manifest": URIRef("https://dbpedia.org/page/Manifest"),
+                "Canvas": URIRef("https://dbpedia.org/page/Canvas")
+            }
+
+            # attributes related to classes
+            id = URIRef("https://schema.org/identifier")
+            label = URIRef("https://dbpedia.org/page/label")
+
+            # relations among classes
+            items = URIRef("https://schema.org/isPartOf")
+
+            # The file is parsed as a stream and every entity is turned into triples
+            # straight away, so chunks reach the store while the file is still being read
+            paths = _expandPaths(path)
+            # the hierarchy also goes to the containment index (see _ContainmentIndex); the
+            # index is dropped for the time of the upload, so queries ask the store meanwhile
+            indexBuilder = _ContainmentIndexBuilder.start(self.dbPathOrUrl)
+            _dropContainmentIndex(self.dbPathOrUrl)
+            uploader = _TripleUploader(self.dbPathOrUrl, batchSize, mode, maxRetries)
+            for entityType, entityId, entityLabel, parentId in _collectionEntities(paths, _workersFor(paths, workers)):
+                entity_uri = URIRef(entityId)
+                uploader.add((entity_uri, RDF.type, classes[entityType]))
+                uploader.add((entity_uri, id, Literal(entityId)))
+                uploader.add((entity_uri, label, Literal(entityLabel)))
+                if parentId is not None:
+                    uploader.add((URIRef(parentId), items, entity_uri))
+                if indexBuilder is not None:
+                    indexBuilder.add(entityType, entityId, entityLabel, parentId)
+            uploader.flush()
+            self.uploadReport = uploader.report()
+            self.uploadReport["files"] = len(paths)
         except Exception as e:
             print(f"Error while uploading data: {e}")
+            _dropContainmentIndex(self.dbPathOrUrl)
+            # part of the data may have reached the endpoint: the indexes of other clients
+            # must not be used any more either
+            if _isRemote(self.dbPathOrUrl):
+                try:
+                    _writeStoreMarker(self.dbPathOrUrl)
+                except Exception:
+                    pass
+            _bumpStoreGeneration(self.dbPathOrUrl)
             return False
 
+        # the data is in the store: failing to write the marker or the index only means
+        # that queries ask the store
+        try:
+            if _isRemote(self.dbPathOrUrl):
+                storeStamp = _writeStoreMarker(self.dbPathOrUrl)
+            else:
+                storeStamp = _storeStamp(self.dbPathOrUrl)
+            if indexBuilder is not None:
+                indexBuilder.save(storeStamp)
+        except Exception as e:
+            print(f"Error while updating the containment index: {e}")
+            try:
+                _dropContainmentIndex(self.dbPathOrUrl)
+            except OSError:
+                pass
+        finally:
+            _bumpStoreGeneration(self.dbPathOrUrl)
+        return True
+
 ########### Query processors ###########
 
+def _checkPage(limit, after, order):
+    if order not in (None, "asc", "desc"):
+        raise ValueError(f"Unknown order: {order}")
+    if limit is not None and limit < 0:
+        raise ValueError(f"Negative limit: {limit}")
+    # a page (and its cursor) only makes sense on sorted results
+    if order is None and (limit is not None or after is not None):
+        order = "asc"
+    return order
+
+def _pageSql(sql, params, key, limit=None, after=None, order=None):
+    # Adds the requested page to a SELECT statement on one keyed table (without DISTINCT,
+    # GROUP BY or ORDER BY): the rows whose key comes after the cursor, sorted on the key,
+    # at most limit of them. The conditions go in the statement itself, so SQLite walks
+    # the unique index on the key and stops after limit rows instead of sorting them all.
+    order = _checkPage(limit, after, order)
+    if limit is None and order is None:
+        return sql, params
+    params = tuple(params)
+    sql = sql.rstrip()
+    if after is not None:
+        condition = f'{key} {"<" if order == "desc" else ">"} ?'
+        if " WHERE " in sql:
+            start = sql.index(" WHERE ") + len(" WHERE ")
+            sql = f"{sql[:start]}({sql[start:]}) AND {condition}"
+        else:
+            sql += f" WHERE {condition}"
+        params += (after,)
+    if order is not None:
+        sql += f" ORDER BY {key} {order.upper()}"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params += (limit,)
+    return sql, params
+
+def _pageSparql(query, key, limit=None, after=None, order=None):
+    # Same as _pageSql for a SPARQL query: the filter on the string value of the key
+    # variable goes in the WHERE block of the query, ORDER BY and LIMIT after it
+    order = _checkPage(limit, after, order)
+    if limit is None and order is None:
+        return query
+    end = query.rindex("}")
+    if after is not None:
+        query = query[:end] + f'FILTER(STR(?{key}) {"<" if order == "desc" else ">"} {_sparqlString(after)}) ' + query[end:]
+    query = query.rstrip()
+    if order is not None:
+        query += f" ORDER BY {order.upper()}(STR(?{key}))"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    return query
+
+def _mergePages(frames, key, limit=None, after=None, order=None):
+    # Pages of the same query from several databases: the first limit distinct rows of
+    # their union in the requested order (each database already returned at most limit rows)
+    order = _checkPage(limit, after, order)
+    if limit is None and order is None:
+        return frames
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return []
+    merged = pd.concat(frames, ignore_index=True)
+    # the same entity stored in two databases has two different internal ids
+    merged = merged.drop_duplicates(subset=[column for column in merged.columns if column != "internalId"])
+    if after is not None:
+        merged = merged[merged[key] < after] if order == "desc" else merged[merged[key] > after]
+    merged = merged.sort_values(key, ascending=order != "desc", kind="stable")
+    if limit is not None:
+        merged = merged.head(limit)
+    return [merged]
+
+# Media types of SPARQL SELECT results, smallest first: CSV carries only the values, the
+# JSON format (which every endpoint supports) also the type of each of them
+_SPARQL_ACCEPT = "text/csv, application/sparql-results+json;q=0.9"
+
+# Variables whose few distinct values repeat on many rows are decoded as categories: the
+# type and the container of an entity always, the other variables (but the key, id) when at
+# most half of the values of a large enough result are distinct
+_CATEGORY_VARIABLES = ("type", "parent")
+_CATEGORY_MIN_ROWS = 1000
+
+def _checkVariables(variables, known):
+    unknown = [variable for variable in variables if variable not in known]
+    if unknown or not variables:
+        raise ValueError(f"Unknown variables: {unknown or variables}")
+
+def _projectSparql(query, variables):
+    # The query with only the given variables in its outermost projection (the SELECT * of
+    # a paged query, otherwise the query's own list of variables)
+    projected = re.search(r"SELECT\s+(?:DISTINCT\s+)?(\?\w+(?:\s+\?\w+)*)", query)
+    _checkVariables(variables, re.findall(r"\?(\w+)", projected.group(1)) if projected else [])
+    projection = re.search(r"SELECT\s+(DISTINCT\s+)?(\*|\?\w+(?:\s+\?\w+)*)", query)
+    return query[:projection.start(2)] + " ".join("?" + variable for variable in variables) + query[projection.end(2):]
+
+def _typedFrame(frame):
+    # String columns, or categorical ones where the values repeat (see _CATEGORY_VARIABLES).
+    # The nullable "string" dtype keeps unbound values missing with every pandas version
+    # ("str" turns None into the text 'None' before pandas 3).
+    for column in frame.columns:
+        values = frame[column]
+        if column in _CATEGORY_VARIABLES:
+            frame[column] = values.astype("category")
+            continue
+        if values.dtype != "string":
+            values = frame[column] = values.astype("string")
+        if column != "id" and len(frame) >= _CATEGORY_MIN_ROWS and values.nunique() * 2 <= len(frame):
+            frame[column] = values.astype("category")
+    return frame
+
+def _decodeSparqlResult(contentType, data):
+    # Data frame from the body of a SPARQL SELECT response. Values are read as strings
+    # without guessing a type (a label "1999" stays a string, "NA" is not missing): only an
+    # unbound variable (an empty CSV field) is missing.
+    if contentType.split(";")[0].strip() == "application/sparql-results+json":
+        result = json.loads(data)
+        columns = result["head"]["vars"]
+        rows = [[binding[column]["value"] if column in binding else None for column in columns]
+                for binding in result["results"]["bindings"]]
+        return _typedFrame(DataFrame(rows, columns=columns, dtype=object))
+    header = data[:data.find(b"\n")].decode("utf-8").strip()
+    dtype = {column: "category" if column in _CATEGORY_VARIABLES else "string" for column in header.split(",")}
+    return _typedFrame(pd.read_csv(BytesIO(data), dtype=dtype, keep_default_na=False, na_values=[""]))
+
+def _localNames(values):
+    # The local names of class IRIs (the part after the last slash), as categories
+    names = values.astype("category").map(lambda value: value.rsplit("/", 1)[-1], na_action="ignore")
+    return names.astype("category")
+
+class _SparqlHttpPool(object):
+    # Keep-alive HTTP connections to one SPARQL endpoint, reused by the queries of a query
+    # processor instead of opening a new connection (and TCP handshake) for every query
+    def __init__(self, url, size=4, timeout=30, gzip=True):
+        parts = urlsplit(url)
+        self.url = url
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        self.size = size
+        self.timeout = timeout
+        self.gzip = gzip
+        self.idle = []
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "connectionsOpened": 0, "connectionsReused": 0, "bytesReceived": 0}
+
+    def _acquire(self):
+        import http.client
+        with self.lock:
+            self.stats["requests"] += 1
+            if self.idle:
+                self.stats["connectionsReused"] += 1
+                return self.idle.pop(), True
+            self.stats["connectionsOpened"] += 1
+        connectionClass = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return connectionClass(self.host, self.port, timeout=self.timeout), False
+
+    def _release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def select(self, query, accept="text/csv"):
+        import http.client
+        from urllib.error import HTTPError
+        headers = {"Content-Type": "application/sparql-query", "Accept": accept}
+        if self.gzip:
+            headers["Accept-Encoding"] = "gzip"
+        body = query.encode("utf-8")
+        while True:
+            connection, reused = self._acquire()
+            try:
+                connection.request("POST", self.path, body, headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                connection.close()
+                # the endpoint may have closed an idle connection in the meantime: nothing
+                # was received, so the query is sent again on another connection
+                if reused:
+                    continue
+                raise
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                raise
+            try:
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                # the endpoint started answering, so the query is not sent again
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            if response.status >= 400:
+                raise HTTPError(self.url, response.status, response.reason, response.headers, BytesIO(data))
+            if response.getheader("Content-Encoding") == "gzip":
+                data = gzip.decompress(data)
+            with self.lock:
+                self.stats["bytesReceived"] += len(data)
+            return response.getheader("Content-Type", ""), data
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats, idleConnections=len(self.idle))
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
 class QueryProcessor(Processor):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, dbPathOrUrl=""):
+        super().__init__(dbPathOrUrl)
+        self.httpPool = None
+        self.httpOptions = {"size": 4, "timeout": 30, "gzip": True}
+        self.sqlitePool = None
+
+    def setDbPathOrUrl(self, dbPathOrUrl: str):
+        self._closeHttpPool()
+        self._closeSqlitePool()
+        return super().setDbPathOrUrl(dbPathOrUrl)
+
+    def setHttpOptions(self, poolSize=None, timeout=None, gzip=None):
+        # Size of the pool of keep-alive connections, timeout (in seconds) of every request
+        # and whether to ask the SPARQL endpoint for gzip-compressed responses
+        for option, value in (("size", poolSize), ("timeout", timeout), ("gzip", gzip)):
+            if value is not None:
+                self.httpOptions[option] = value
+        self._closeHttpPool()
+        return True
 
+    def getConnectionStats(self):
+        # How many requests were sent and how many of them reused an open connection
+        if self.httpPool is None:
+            return {"requests": 0, "connectionsOpened": 0, "connectionsReused": 0, "bytesReceived": 0, "idleConnections": 0}
+        return self.httpPool.getStats()
+
+    def _closeHttpPool(self):
+        if self.httpPool is not None:
+            self.httpPool.close()
+            self.httpPool = None
+
+    def _closeSqlitePool(self):
+        if self.sqlitePool is not None:
+            self.sqlitePool.close()
+            self.sqlitePool = None
+
+    def _connection(self):
+        # A read-only connection to the relational database, taken from the processor's
+        # pool and given back at the end of the with block
+        if self.sqlitePool is None:
+            self.sqlitePool = _SqliteConnectionPool(self.getDbPathOrUrl())
+        return self.sqlitePool.connection()
+
+    def _query(self, sql, params=()):
+        # Runs a SELECT statement on the relational database with bound parameters: the
+        # text of the statement never changes between calls, so SQLite reuses the prepared
+        # statement from the connection's cache instead of parsing and planning it again
+        _recordQuery(sql)
+        with self._connection() as con:
+            with _phase("backend"):
+                cursor = con.execute(sql, params)
+                columns = [column[0] for column in cursor.description]
+                rows = cursor.fetchall()
+        with _phase("decode"):
+            return DataFrame.from_records(rows, columns=columns)
+
+    def _iterQuery(self, sql, params=(), batchSize=10000):
+        # Like _query, but yields data frames of at most batchSize rows read from the cursor
+        # as they are needed; the connection stays borrowed until the generator is closed
+        with self._connection() as con:
+            cursor = con.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batchSize)
+                if not rows:
+                    return
+                yield DataFrame.from_records(rows, columns=columns)
+
+    def _iterSelect(self, query, orderBy, batchSize=10000, variables=None):
+        # Like _select, but yields data frames of at most batchSize rows, asking the graph
+        # database for one page (ORDER BY ... LIMIT ... OFFSET ...) at a time
+        offset = 0
+        while True:
+            page = self._select(f"{query} ORDER BY {orderBy} LIMIT {batchSize} OFFSET {offset}", variables)
+            if len(page):
+                yield page
+            if len(page) < batchSize:
+                return
+            offset += batchSize
+
+    def _select(self, query, variables=None):
+        # Runs a SELECT query on the graph database: the embedded store for a file path,
+        # the SPARQL endpoint (through the pool of connections) for a URL. With variables,
+        # only those are asked for (and decoded).
+        if variables is not None:
+            query = _projectSparql(query, variables)
+        _recordQuery(query)
+        url = self.getDbPathOrUrl()
+        if not _isRemote(url):
+            with _phase("backend"):
+                df = _LocalGraphStore.open(url).select(query)
+            with _phase("decode"):
+                return _typedFrame(df)
+        if self.httpPool is None:
+            self.httpPool = _SparqlHttpPool(url, **self.httpOptions)
+        with _phase("backend"):
+            contentType, data = self.httpPool.select(query, _SPARQL_ACCEPT)
+        with _phase("decode"):
+            return _decodeSparqlResult(contentType, data)
+
+    @_instrumented
     def getEntityById(self, entityId):
-        url_or_path = self.getDbPathOrUrl()
-        df = DataFrame()
-        if url_or_path.startswith('http'):
-            df = pd.DataFrame(columns=['id', 'label'])
-            endpoint = 'http://127.0.0.1:9999/blazegraph/sparql'
+        if _isRemote(self.getDbPathOrUrl()):
+            return self._getGraphEntityById(entityId)
+        return self._getRelationalEntityById(entityId)
+
+    @_instrumented
+    def getEntitiesByIds(self, entityIds, chunkSize: int = None):
+        if _isRemote(self.getDbPathOrUrl()):
+            return self._getGraphEntitiesByIds(entityIds, chunkSize or 1000)
+        return self._getRelationalEntitiesByIds(entityIds, chunkSize or 10000)
+
+    def _getGraphEntitiesByIds(self, entityIds, chunkSize=1000):
+        # One VALUES query per chunk of identifiers. The type is the local name of the
+        # class (Collection, Manifest or Canvas).
+        frames = []
+        entityIds = list(dict.fromkeys(entityIds))
+        for start in range(0, len(entityIds), chunkSize):
+            values = " ".join(_sparqlString(entityId) for entityId in entityIds[start:start + chunkSize])
             query = """
                 PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
                 PREFIX dbp: <https://dbpedia.org/page/>
                 PREFIX schema: <https://schema.org/>
 
-                SELECT DISTINCT ?id ?label
+                SELECT DISTINCT ?id ?type ?label
                 WHERE {{
-                    ?id schema:identifier "{0}" ;
-                             dbp:label ?label .
+                    VALUES ?id {{ {0} }}
+                    ?entity schema:identifier ?id ;
+                            rdf:type ?type ;
+                            dbp:label ?label .
                 }}
-                """.format(entityId)
-            df = get(endpoint, query, True)
-        else:
-            with connect(url_or_path) as con:
-                query = """
-                        SELECT DISTINCT A.id, A.body, A.motivation,
-                        EWM.id, EWM.title, EWM.creator
-                        FROM EntityWithMetadata AS EWM
-                        LEFT JOIN Annotation AS A
-                            ON A.target = EWM.id
-                        WHERE EWM.id = ?
-                        """
-                df = read_sql(query, con, params=[entityId])
-                filtered_df = df.dropna(axis='columns')
-                filtered_df = filtered_df.loc[:, filtered_df.any()]
-                df = filtered_df 
+                """.format(values)
+            frames.append(self._select(query))
+        if not frames:
+            return DataFrame(columns=["id", "type", "label"])
+        df = pd.concat(frames, ignore_index=True)
+        df["type"] = _localNames(df["type"])
         return df
 
+    def _getRelationalEntitiesByIds(self, entityIds, chunkSize=10000):
+        # One query per chunk of identifiers (bound as a JSON array) over the entities with
+        # metadata, the annotations and the images, with the type of each entity
+        query = """
+                WITH ids(value) AS (SELECT value FROM json_each(?))
+                SELECT id, type, title, creator, NULL AS body, NULL AS target, NULL AS motivation
+                FROM EntityWithMetadata WHERE id IN ids
+                UNION ALL
+                SELECT id, 'Annotation', NULL, NULL, body, target, motivation
+                FROM Annotation WHERE id IN ids
+                UNION ALL
+                SELECT body, 'Image', NULL, NULL, NULL, NULL, NULL
+                FROM Image WHERE body IN ids
+                """
+        frames = []
+        entityIds = list(dict.fromkeys(entityIds))
+        for start in range(0, len(entityIds), chunkSize):
+            frames.append(self._query(query, (json.dumps(entityIds[start:start + chunkSize]),)))
+        if not frames:
+            return DataFrame(columns=["id", "type", "title", "creator", "body", "target", "motivation"])
+        return pd.concat(frames, ignore_index=True)
+
+    def _getGraphEntityById(self, entityId):
+        query = """
+            PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+            PREFIX dbp: <https://dbpedia.org/page/>
+            PREFIX schema: <https://schema.org/>
+
+            SELECT DISTINCT ?id ?label
+            WHERE {{
+                ?id schema:identifier {0} ;
+                         dbp:label ?label .
+            }}
+            """.format(_sparqlString(entityId))
+        return self._select(query)
+
+    def _getRelationalEntityById(self, entityId):
+        query = """
+                SELECT DISTINCT A.id, A.body, A.motivation,
+                EWM.id, EWM.title, EWM.creator
+                FROM EntityWithMetadata AS EWM
+                LEFT JOIN Annotation AS A
+                    ON A.target = EWM.id
+                WHERE EWM.id = ?
+                """
+        df = self._query(query, (entityId,))
+        filtered_df = df.dropna(axis='columns')
+        filtered_df = filtered_df.loc[:, filtered_df.any()]
+        return filtered_df
+
 # Query processor for relational database
 class RelationalQueryProcessor(QueryProcessor):
     def __init__(self):
         super().__init__()
 
-    def getAllAnnotations(self):
-        with connect(self.dbPathOrUrl) as con:
-            query = "SELECT DISTINCT * FROM Annotation"
-            df_sql = pd.read_sql(query, con)
-            return df_sql
+    @_instrumented
+    def getEntityById(self, entityId):
+        return self._getRelationalEntityById(entityId)
+
+    @_instrumented
+    def getEntitiesByIds(self, entityIds, chunkSize: int = 10000):
+        return self._getRelationalEntitiesByIds(entityIds, chunkSize)
+
+    @_instrumented
+    def getAllAnnotations(self, limit: int = None, after: str = None, order: str = None):
+        query = "SELECT internalId, id, body, target, motivation FROM Annotation"
+        return self._query(*_pageSql(query, (), "id", limit, after, order))
     
-    def getAllImages(self):
-        with connect(self.dbPathOrUrl) as con:
-            query = "SELECT DISTINCT * FROM Image"
-            df_sql = pd.read_sql(query, con)
-            return df_sql
+    @_instrumented
+    def getAllImages(self, limit: int = None, after: str = None, order: str = None):
+        query = "SELECT internalId, body FROM Image"
+        return self._query(*_pageSql(query, (), "body", limit, after, order))
+
+    # The iter methods yield the same rows in data frames of at most batchSize rows. The
+    # rows are already distinct (id and body are unique keys), so no DISTINCT is needed,
+    # which would make SQLite collect all of them before returning the first one.
+    def iterAllAnnotations(self, batchSize: int = 10000):
+        return self._iterQuery("SELECT internalId, id, body, target, motivation FROM Annotation ORDER BY rowid", (), batchSize)
+
+    def iterAllImages(self, batchSize: int = 10000):
+        return self._iterQuery("SELECT internalId, body FROM Image ORDER BY rowid", (), batchSize)
         
-    def getAnnotationsWithBody(self, bodyId: str):
-        with connect(self.dbPathOrUrl) as con:
-            query = f"SELECT DISTINCT * FROM Annotation WHERE body='{bodyId}'"
-            df_sql = pd.read_sql(query, con)
-            return df_sql
+    @_instrumented
+    def getAnnotationsWithBody(self, bodyId: str, limit: int = None, after: str = None, order: str = None):
+        query = "SELECT internalId, id, body, target, motivation FROM Annotation WHERE body = ?"
+        return self._query(*_pageSql(query, (bodyId,), "id", limit, after, order))
         
-    def getAnnotationsWithBodyAndTarget(self, bodyId: str, targetId: str):
-        with connect(self.dbPathOrUrl) as con:
-            query = f"SELECT DISTINCT * FROM Annotation WHERE body='{bodyId}' OR target='{targetId}'"
-            df_sql = pd.read_sql(query, con)
-            return df_sql
+    @_instrumented
+    def getAnnotationsWithBodyAndTarget(self, bodyId: str, targetId: str, limit: int = None, after: str = None, order: str = None):
+        query = "SELECT internalId, id, body, target, motivation FROM Annotation WHERE body = ? OR target = ?"
+        return self._query(*_pageSql(query, (bodyId, targetId), "id", limit, after, order))
         
-    def getAnnotationsWithTarget(self, targetId: str):
-        with connect(self.dbPathOrUrl) as con:
-            query = f"SELECT DISTINCT * FROM Annotation WHERE target='{targetId}'"
-            df_sql = pd.read_sql(query, con)
-            return df_sql
+    @_instrumented
+    def getAnnotationsWithTarget(self, targetId: str, limit: int = None, after: str = None, order: str = None):
+        query = "SELECT internalId, id, body, target, motivation FROM Annotation WHERE target = ?"
+        return self._query(*_pageSql(query, (targetId,), "id", limit, after, order))
+
+    @_instrumented
+    def getImagesWithTarget(self, targetId: str, limit: int = None, after: str = None, order: str = None):
+        # The images that are the body of an annotation of the target, once each (Image has
+        # one row per body), paged on the body
+        query = "SELECT internalId, body FROM Image WHERE body IN (SELECT body FROM Annotation WHERE target = ?)"
+        return self._query(*_pageSql(query, (targetId,), "body", limit, after, order))
+
+    @_instrumented
+    def getAnnotationsWithTargets(self, targetIds, limit: int = None, after: str = None, order: str = None):
+        # Annotations having any of the input identifiers as target, in a single query: the
+        # identifiers are bound as one JSON array, so the text of the query does not depend
+        # on how many they are, and every one of them is looked up in the index on target
+        query = """
+                SELECT internalId, id, body, target, motivation FROM Annotation
+                WHERE target IN (SELECT value FROM json_each(?))
+                """
+        return self._query(*_pageSql(query, (json.dumps(list(targetIds)),), "id", limit, after, order))
         
-    def getEntitiesWithCreator(self, creatorName: str):
-        with connect(self.dbPathOrUrl) as con:
-            query = f"SELECT DISTINCT * FROM EntityWithMetadata WHERE creator LIKE '%{creatorName}%'"
-            df_sql = pd.read_sql(query, con)
-            return df_sql
-
-    def getEntitiesWithTitle(self, title: str):  
-        with connect(self.dbPathOrUrl) as con:
-            query = f"SELECT DISTINCT * FROM EntityWithMetadata WHERE title = '{title}'"
-            df_sql = pd.read_sql(query, con)
-            return df_sql
+    @_instrumented
+    def getEntitiesWithCreator(self, creatorName: str, limit: int = None, after: str = None, order: str = None):
+        # Exact (case and space insensitive) match on one of the creators of the entity
+        query = """
+                SELECT internalId, id, title, creator FROM EntityWithMetadata
+                WHERE id IN (SELECT entityId FROM Creator WHERE normName = ?)
+                """
+        return self._query(*_pageSql(query, (_normalizeCreator(creatorName),), "id", limit, after, order))
+
+    @_instrumented
+    def searchEntities(self, text: str, field: str = None, prefix: bool = True, limit: int = None, after: str = None, order: str = None):
+        # Full-text search on titles and creators: every word of the input must appear in
+        # the entity (as the beginning of a word if prefix is True). The search can be
+        # limited to the "title" or the "creator" field. Best matches come first.
+        terms = " AND ".join('"' + word.replace('"', '""') + '"' + ("*" if prefix else "") for word in text.split())
+        if not terms:
+            return DataFrame(columns=["internalId", "id", "title", "creator"])
+        if field is not None:
+            if field not in ("title", "creator"):
+                raise ValueError(f"Unknown search field: {field}")
+            terms = f"{field} : ({terms})"
+        query = """
+                SELECT EWM.internalId, EWM.id, EWM.title, EWM.creator
+                FROM EntitySearch AS S
+                JOIN EntityWithMetadata AS EWM ON EWM.rowid = S.rowid
+                WHERE EntitySearch MATCH ?
+                """
+        if order is None and after is None:
+            # best matches first: only the number of results is limited
+            return self._query(query + " ORDER BY S.rank LIMIT ?", (terms, -1 if limit is None else limit))
+        return self._query(*_pageSql(query, (terms,), "EWM.id", limit, after, order))
+
+    @_instrumented
+    def getEntitiesWithTitle(self, title: str, limit: int = None, after: str = None, order: str = None):
+        query = "SELECT internalId, id, title, creator FROM EntityWithMetadata WHERE title = ?"
+        return self._query(*_pageSql(query, (title,), "id", limit, after, order))
 
 # Query processor for graph database
 class TriplestoreQueryProcessor(QueryProcessor):
-    def __init__(self):
-        super().__init__()
-
-    def getAllCanvases(self):
-        query = """
+    # Queries shared by the get and the iter methods
+    _allCanvasesQuery = """
         PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
         PREFIX dbp: <https://dbpedia.org/page/>
         PREFIX schema: <https://schema.org/>
@@ -372,11 +1974,8 @@ class TriplestoreQueryProcessor(QueryProcessor):
                     dbp:label ?label .
         }
         """
-        df_sparql = get(self.dbPathOrUrl, query, True)
-        return df_sparql
-    
-    def getAllCollections(self):
-        query = """
+
+    _allCollectionsQuery = """
         PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
         PREFIX dbp: <https://dbpedia.org/page/>
         PREFIX schema: <https://schema.org/>
@@ -388,11 +1987,8 @@ class TriplestoreQueryProcessor(QueryProcessor):
                         dbp:label ?label .
         }
         """
-        df_sparql = get(self.dbPathOrUrl, query, True)
-        return df_sparql
-    
-    def getAllManifests(self):
-        query = """
+
+    _allManifestsQuery = """
         PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
         PREFIX dbp: <https://dbpedia.org/page/>
         PREFIX schema: <https://schema.org/>
@@ -404,10 +2000,121 @@ class TriplestoreQueryProcessor(QueryProcessor):
                         dbp:label ?label .
         }
         """
-        df_sparql = get(self.dbPathOrUrl, query, True)
-        return df_sparql     
+
+    def __init__(self):
+        super().__init__()
+        self.useContainmentIndex = True
+        # ((url, generation), marker) of the endpoint, see _containmentIndex
+        self.storeStamp = None
+
+    def setUseContainmentIndex(self, use: bool):
+        # Whether containment queries may be answered by the index built by
+        # CollectionProcessor instead of the graph database
+        self.useContainmentIndex = use
+        return True
+
+    def _containmentIndex(self):
+        if not self.useContainmentIndex:
+            return None
+        url = self.getDbPathOrUrl()
+        if not _isRemote(url):
+            return _currentContainmentIndex(url, _storeStamp(url))
+        # The marker of an endpoint is asked once, and again after every upload made from
+        # this process; if the endpoint does not answer, the query will tell
+        key = (url, _storeGeneration(url))
+        if self.storeStamp is None or self.storeStamp[0] != key:
+            try:
+                marker = _markerStamp(self._select(_STORE_MARKER_QUERY))
+            except Exception:
+                return None
+            self.storeStamp = (key, marker)
+        return _currentContainmentIndex(url, self.storeStamp[1])
+
+    def _contained(self, entityId, path, limit, after, order, variables=None):
+        # Containment query answered by the index, or None when there is no index
+        index = self._containmentIndex()
+        # an entity the index does not know was uploaded by someone else: ask the store
+        if index is None or entityId not in index.positions:
+            return None
+        df = index.frame(index.descendants(entityId, path))
+        pages = _mergePages([df], "id", limit, after, order)
+        df = pages[0] if pages else df.iloc[0:0]
+        if variables is not None:
+            _checkVariables(variables, df.columns)
+            df = df[list(variables)]
+        return _typedFrame(df)
+
+    # The graph database may also be a local file (the embedded store), so the type of
+    # query cannot be guessed from the path
+    @_instrumented
+    def getEntityById(self, entityId):
+        return self._getGraphEntityById(entityId)
+
+    @_instrumented
+    def getEntitiesByIds(self, entityIds, chunkSize: int = 1000):
+        return self._getGraphEntitiesByIds(entityIds, chunkSize)
+
+    @_instrumented
+    def getItemsByIds(self, entityIds, chunkSize: int = 1000):
+        # The entities contained in the collections and manifests with the input identifiers
+        # (one VALUES query per chunk): the identifier of the container, and the identifier,
+        # type and label of every entity in it
+        frames = []
+        entityIds = list(dict.fromkeys(entityIds))
+        index = self._containmentIndex()
+        if index is not None:
+            frames.append(index.items([entityId for entityId in entityIds if entityId in index.positions]))
+            entityIds = [entityId for entityId in entityIds if entityId not in index.positions]
+        for start in range(0, len(entityIds), chunkSize):
+            values = " ".join(_sparqlString(entityId) for entityId in entityIds[start:start + chunkSize])
+            query = """
+                PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+                PREFIX dbp: <https://dbpedia.org/page/>
+                PREFIX schema: <https://schema.org/>
+
+                SELECT DISTINCT ?parent ?id ?type ?label
+                WHERE {{
+                    VALUES ?parent {{ {0} }}
+                    ?container schema:identifier ?parent ;
+                               schema:isPartOf ?item .
+                    ?item schema:identifier ?id ;
+                          rdf:type ?type ;
+                          dbp:label ?label .
+                }}
+                """.format(values)
+            frames.append(self._select(query))
+        if not frames:
+            return DataFrame(columns=["parent", "id", "type", "label"])
+        df = pd.concat(frames, ignore_index=True)
+        df["type"] = _localNames(df["type"])
+        return df
+
+    @_instrumented
+    def getAllCanvases(self, limit: int = None, after: str = None, order: str = None, variables: List[str] = None):
+        return self._select(_pageSparql(self._allCanvasesQuery, "id", limit, after, order), variables)
+
+    def iterAllCanvases(self, batchSize: int = 10000, variables: List[str] = None):
+        return self._iterSelect(self._allCanvasesQuery, "?id ?label", batchSize, variables)
     
-    def getCanvasesInCollection(self, collectionId: str):
+    @_instrumented
+    def getAllCollections(self, limit: int = None, after: str = None, order: str = None, variables: List[str] = None):
+        return self._select(_pageSparql(self._allCollectionsQuery, "id", limit, after, order), variables)
+
+    def iterAllCollections(self, batchSize: int = 10000, variables: List[str] = None):
+        return self._iterSelect(self._allCollectionsQuery, "?id ?label", batchSize, variables)
+    
+    @_instrumented
+    def getAllManifests(self, limit: int = None, after: str = None, order: str = None, variables: List[str] = None):
+        return self._select(_pageSparql(self._allManifestsQuery, "id", limit, after, order), variables)
+
+    def iterAllManifests(self, batchSize: int = 10000, variables: List[str] = None):
+        return self._iterSelect(self._allManifestsQuery, "?id ?label", batchSize, variables)
+    
+    @_instrumented
+    def getCanvasesInCollection(self, collectionId: str, limit: int = None, after: str = None, order: str = None, variables: List[str] = None):
+        contained = self._contained(collectionId, ("Collection", "Manifest", "Canvas"), limit, after, order, variables)
+        if contained is not None:
+            return contained
         query = """
         PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
         PREFIX dbp: <https://dbpedia.org/page/>
@@ -417,7 +2124,7 @@ class TriplestoreQueryProcessor(QueryProcessor):
         SELECT DISTINCT ?id ?label 
         WHERE {{
             ?collection rdf:type schema:Collection ;
-                        schema:identifier "{0}" ;
+                        schema:identifier {0} ;
                         schema:isPartOf ?manifest .
             ?manifest rdf:type dbp:Manifest ;
                         schema:isPartOf ?canvas .
@@ -425,12 +2132,16 @@ class TriplestoreQueryProcessor(QueryProcessor):
                         schema:identifier ?id ;
                         dbp:label ?label .
         }}
-        """.format(collectionId)
+        """.format(_sparqlString(collectionId))
      
-        df_sparql = get(self.dbPathOrUrl, query, True)
+        df_sparql = self._select(_pageSparql(query, "id", limit, after, order), variables)
         return df_sparql  
            
-    def getCanvasesInManifest(self, manifestId: str):
+    @_instrumented
+    def getCanvasesInManifest(self, manifestId: str, limit: int = None, after: str = None, order: str = None, variables: List[str] = None):
+        contained = self._contained(manifestId, ("Manifest", "Canvas"), limit, after, order, variables)
+        if contained is not None:
+            return contained
         query = """
         PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
         PREFIX dbp: <https://dbpedia.org/page/>
@@ -441,17 +2152,18 @@ class TriplestoreQueryProcessor(QueryProcessor):
             ?collection rdf:type schema:Collection ;
                         schema:isPartOf ?manifest .  
             ?manifest rdf:type dbp:Manifest ;
-                    schema:identifier "{0}" ;
+                    schema:identifier {0} ;
                     schema:isPartOf ?canvas . 
             ?canvas rdf:type dbp:Canvas ;
                     schema:identifier ?id ;
                     dbp:label ?label .
         }}
-        """.format(manifestId)
-        df_sparql = get(self.dbPathOrUrl, query, True)
+        """.format(_sparqlString(manifestId))
+        df_sparql = self._select(_pageSparql(query, "id", limit, after, order), variables)
         return df_sparql    
 
-    def getEntitiesWithLabel(self, label: str):
+    @_instrumented
+    def getEntitiesWithLabel(self, label: str, limit: int = None, after: str = None, order: str = None, variables: List[str] = None):
         query = """
         PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
         PREFIX dbp: <https://dbpedia.org/page/>
@@ -460,15 +2172,19 @@ class TriplestoreQueryProcessor(QueryProcessor):
 
         SELECT DISTINCT ?id ?label
         WHERE {{        
-            ?entity dbp:label "{0}" ;
+            ?entity dbp:label {0} ;
                     dbp:label ?label ;
                     schema:identifier ?id .
         }}
-        """.format(label.replace('"', '\\"'))
-        df_sparql = get(self.dbPathOrUrl, query, True)
+        """.format(_sparqlString(label))
+        df_sparql = self._select(_pageSparql(query, "id", limit, after, order), variables)
         return df_sparql        
 
-    def getManifestsInCollection(self, collectionId: str):
+    @_instrumented
+    def getManifestsInCollection(self, collectionId: str, limit: int = None, after: str = None, order: str = None, variables: List[str] = None):
+        contained = self._contained(collectionId, ("Collection", "Manifest"), limit, after, order, variables)
+        if contained is not None:
+            return contained
         query = """
         PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
         PREFIX dbp: <https://dbpedia.org/page/>
@@ -479,358 +2195,562 @@ class TriplestoreQueryProcessor(QueryProcessor):
         WHERE {{
             ?collection rdf:type schema:Collection ;
                         schema:isPartOf ?manifest ;
-                        schema:identifier "{0}" .
+                        schema:identifier {0} .
             ?manifest rdf:type dbp:Manifest ;
                         schema:identifier ?id ;
                         dbp:label ?label .
         }}
-        """.format(collectionId)
-        df_sparql = get(self.dbPathOrUrl, query, True)
+        """.format(_sparqlString(collectionId))
+        df_sparql = self._select(_pageSparql(query, "id", limit, after, order), variables)
         return df_sparql        
 
-class GenericQueryProcessor(object):
+def _materialize(frames, build, columns):
+    # One entity per row of the data frames, built by calling build with the values of the
+    # given columns. The columns are read as Python lists and zipped, instead of creating a
+    # pandas Series for every row as iterrows does.
+    entities = []
+    with _phase("materialize"):
+        for frame in frames:
+            if len(frame):
+                entities.extend(map(build, *(frame[column].tolist() for column in columns)))
+    return entities
+
+def _entityWithMetadata(id, title, creators):
+    if id.endswith("collection"):
+        return Collection(id, label=None, title=title, creators=creators)
+    elif id.endswith("manifest"):
+        return Manifest(id, label=None, title=title, creators=creators)
+    return EntityWithMetadata(id, title=title, creators=creators)
+
+def _entityWithLabel(id, label):
+    if id.endswith("collection"):
+        return Collection(id, label=label)
+    elif id.endswith("manifest"):
+        return Manifest(id, label=label)
+    return EntityWithMetadata(id, label=label)
+
+def _entityFromFields(id, fields):
+    # The object for an identifier from the values found for it in all the databases
+    entityType = fields.get("type")
+    if entityType == "Annotation":
+        return Annotation(id, fields.get("body"), fields.get("target"), fields.get("motivation"))
+    if entityType == "Image":
+        return Image(id)
+    label, creators, title = fields.get("label"), fields.get("creator"), fields.get("title")
+    if entityType == "Collection":
+        return Collection(id, label, creators=creators, title=title)
+    if entityType == "Manifest":
+        return Manifest(id, label, creators=creators, title=title)
+    if entityType == "Canvas":
+        return Canvas(id, label, creators=creators, title=title)
+    return EntityWithMetadata(id, label, creators=creators, title=title)
+
+class _QueryCache(object):
+    # Results of GenericQueryProcessor methods keyed by method and arguments (or entities
+    # keyed by identifier, for the identity map), evicted in
+    # least recently used order beyond maxSize and, if ttl is given, after ttl seconds.
+    # Every result remembers the generation of the databases it was computed from and is
+    # dropped as soon as one of them has been uploaded to since.
+    def __init__(self, maxSize=256, ttl=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, entryGeneration, expires = entry
+                if entryGeneration != generation:
+                    del self.entries[key]
+                    self.stats["invalidations"] += 1
+                elif expires is not None and expires < time.monotonic():
+                    del self.entries[key]
+                    self.stats["expirations"] += 1
+                else:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return True, value
+            self.stats["misses"] += 1
+            return False, None
+
+    def put(self, key, generation, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, generation, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats, size=len(self.entries), maxSize=self.maxSize, ttl=self.ttl)
+
+class _BackendPool(object):
+    # Threads running the fan-out queries of one query processor. At most size queries run
+    # at once: a query that would have to wait for a free thread fails at once instead, so
+    # a database that stopped answering only ties up its own threads, never the threads of
+    # the other databases.
+    def __init__(self, name, size=4):
+        from concurrent.futures import ThreadPoolExecutor
+        self.name = name
+        self.size = size
+        self.running = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="GenericQueryProcessor")
+
+    def submit(self, call, processor):
+        with self.lock:
+            if self.running >= self.size:
+                raise TimeoutError(f"{self.name} is still running {self.size} queries")
+            self.running += 1
+        task = _BackendTask()
+
+        def run():
+            task.started = time.monotonic()
+            task.startedEvent.set()
+            try:
+                return call(processor)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+        task.future = self.executor.submit(run)
+        return task
+
+class _BackendTask(object):
+    __slots__ = ("future", "started", "startedEvent")
+
+    def __init__(self):
+        self.future = None
+        self.started = None
+        self.startedEvent = threading.Event()
+
+    def result(self, timeout):
+        # The timeout counts from the moment the query started running, not from when it
+        # was submitted
+        from concurrent.futures import TimeoutError as FutureTimeoutError
+        if timeout is None:
+            return self.future.result()
+        if not self.startedEvent.wait(timeout):
+            raise FutureTimeoutError()
+        return self.future.result(timeout=max(0.0, self.started + timeout - time.monotonic()))
+
+def _cached(method):
+    # Serves the method from the cache of the GenericQueryProcessor when it is enabled
+    @wraps(method)
+    def cachedMethod(self, *args, **kwargs):
+        # all the fan-outs of the method report their errors to the same list
+        with self._fanOutScope():
+            if self.cache is None:
+                return method(self, *args, **kwargs)
+            key = (method.__name__, args, tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                return method(self, *args, **kwargs)
+            generation = self._storesGeneration()
+            found, value = self.cache.get(key, generation)
+            if not found:
+                value = method(self, *args, **kwargs)
+                # a partial result (some query processor failed) is not kept
+                if not self.getFanOutErrors():
+                    self.cache.put(key, generation, value)
+            # callers get their own list, so changing it does not change the cached result
+            return list(value) if isinstance(value, list) else value
+    return cachedMethod
+
+class GenericQueryProcessor(_Instrumented):
     def __init__(self):
         self.queryProcessors = []
-    
-    def cleanQueryProcessors(self):
-        self.queryProcessors = []
-        return True
-        
-    def addQueryProcessor(self, processor: QueryProcessor):
-        self.queryProcessors.append(processor)
+        self.cache = None
+        # one _BackendPool per query processor, dropped with the processor
+        self.backendPools = weakref.WeakKeyDictionary()
+        self.backendPoolsLock = threading.Lock()
+        self.timeouts = {RelationalQueryProcessor: None, TriplestoreQueryProcessor: None}
+        self.partialResults = False
+        self.fanOutErrors = threading.local()
+        # One object per identifier, shared by all the calls of getEntityById and
+        # getEntitiesByIds until one of the databases changes
+        self.identityMap = _QueryCache(10000)
+
+    def setIdentityMapSize(self, maxSize: int):
+        self.identityMap = _QueryCache(maxSize)
         return True
 
-    def getAllAnnotations(self) -> List[Annotation]:
-        all_annotations_df = []
-        all_annotations = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, RelationalQueryProcessor):
-                all_annotations_df.append(queryProcessor.getAllAnnotations())
-        for annotations_df in all_annotations_df:
-            for i, row in annotations_df.iterrows():
-                id = row["id"]
-                body = row["body"]
-                target = row["target"]
-                motivation = row["motivation"]
-                annotation = Annotation(id, body, target, motivation)
-                all_annotations.append(annotation)
-        return all_annotations
-    
-    def getAllCanvas(self)-> List[Canvas]:
-        all_canvases_df = []
-        all_canvases = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, TriplestoreQueryProcessor):
-                all_canvases_df.append(queryProcessor.getAllCanvases())
-        for canvas_df in all_canvases_df:
-            for i, row in canvas_df.iterrows():
-                id = row["id"]
-                label = row["label"]
-                canvas = Canvas(id, label)
-                all_canvases.append(canvas)
-        return  all_canvases
-
-    def getAllCollections(self)-> List[Collection]:
-        all_collections_df = []
-        all_collections = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, TriplestoreQueryProcessor):
-                all_collections_df.append(queryProcessor.getAllCollections())
-        for collection_df in all_collections_df:
-            for i, row in collection_df.iterrows():
-                id = row["id"]
-                label = row["label"]
-                collection = Collection(id, label)
-                all_collections.append(collection)
-        return  all_collections
-    
-    def getAllImages(self)-> List[Image]:
-        all_images_df = []
-        all_images = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, RelationalQueryProcessor):
-                all_images_df.append(queryProcessor.getAllImages())
-        for image_df in all_images_df:
-            for i, row in image_df.iterrows():
-                id = row["body"]
-                image = Image(id)
-                all_images.append(image)
-        return all_images
-
-    def getAllManifests(self)-> List[Manifest]:
-        all_manifests_df = []
-        all_manifests = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, TriplestoreQueryProcessor):
-                all_manifests_df.append(queryProcessor.getAllManifests())
-        for manifest_df in all_manifests_df:
-            for i, row in manifest_df.iterrows():
-                id = row["id"]
-                label = row["label"]
-                manifest = Manifest(id, label)
-                all_manifests.append(manifest)
-        return  all_manifests
-    
-    def getAnnotationsToCanvas(self, canvasId: str) -> List[Annotation]:
-        annotations_to_canvas = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, RelationalQueryProcessor):
-                with connect(queryProcessor.getDbPathOrUrl()) as con:
-                    query = f"SELECT DiSTINCT * FROM Annotation WHERE target ='{canvasId}'"
-                    df_sq = pd.read_sql(query, con)
-                    for i, row in df_sq.iterrows():
-                        id = row["id"]
-                        body = row["body"]
-                        target = row["target"]
-                        motivation = row["motivation"]
-                        annotation = Annotation(id, body, target, motivation)
-                        annotations_to_canvas.append(annotation)
-        return annotations_to_canvas
-    
-    def getAnnotationsToCollection(self, collectionId: str) -> List[Annotation]:
-        annotations_to_collection = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, RelationalQueryProcessor):
-                with connect(queryProcessor.getDbPathOrUrl()) as con:
-                    query = f"SELECT DiSTINCT * FROM Annotation WHERE target ='{collectionId}'"
-                    df_sq = pd.read_sql(query, con)
-                    for i, row in df_sq.iterrows():
-                        id = row["id"]
-                        body = row["body"]
-                        target = row["target"]
-                        motivation = row["motivation"]
-                        annotation = Annotation(id, body, target, motivation)
-                        annotations_to_collection.append(annotation)
-        return annotations_to_collection
-    
-    def getAnnotationsToManifest(self, manifestId: str) -> List[Annotation]:
-        annotations_to_manifest = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, RelationalQueryProcessor):
-                with connect(queryProcessor.getDbPathOrUrl()) as con:
-                    query = f"SELECT DiSTINCT * FROM Annotation WHERE target ='{manifestId}'"
-                    df_sq = pd.read_sql(query, con)
-                    for i, row in df_sq.iterrows():
-                        id = row["id"]
-                        body = row["body"]
-                        target = row["target"]
-                        motivation = row["motivation"]
-                        annotation = Annotation(id, body, target, motivation)
-                        annotations_to_manifest.append(annotation)
-        return annotations_to_manifest
-                        
-    def getAnnotationsWithBody(self, bodyId: str) -> List[Annotation]:
-        annotations_with_body_df = []
-        annotations_with_body = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, RelationalQueryProcessor):
-                annotations_with_body_df.append(queryProcessor.getAnnotationsWithBody(bodyId))
-        for annotation_df in annotations_with_body_df:
-            for i, row in annotation_df.iterrows():
-                id = row["id"]
-                body = row["body"]
-                target = row["target"]
-                motivation = row["motivation"]
-                annotation = Annotation(id, body, target, motivation)
-                annotations_with_body.append(annotation)
-        return annotations_with_body
-    
-    def getAnnotationsWithBodyAndTarget(self, bodyId: str, targetId : str) -> List[Annotation]:
-        annotations_with_body_and_target_df = []
-        annotations_with_body_and_target = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, RelationalQueryProcessor):
-                annotations_with_body_and_target_df.append(queryProcessor.getAnnotationsWithBodyAndTarget(bodyId, targetId))
-        for annotation_df in annotations_with_body_and_target_df:
-            for i, row in annotation_df.iterrows():
-                id = row["id"]
-                body = row["body"]
-                target = row["target"]
-                motivation = row["motivation"]
-                annotation = Annotation(id, body, target, motivation)
-                annotations_with_body_and_target.append(annotation)  
-        return annotations_with_body_and_target
-       
-    def getAnnotationsWithTarget(self, targetId: str) -> List[Annotation]:
-        annotations_with_target_df = []
-        annotations_with_target = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, RelationalQueryProcessor):
-                annotations_with_target_df.append(queryProcessor.getAnnotationsWithTarget(targetId))
-        for annotation_df in annotations_with_target_df:
-            for i, row in annotation_df.iterrows():
-                id = row["id"]
-                body = row["body"]
-                target = row["target"]
-                motivation = row["motivation"]
-                annotation = Annotation(id, body, target, motivation)
-                annotations_with_target.append(annotation)  
-        return annotations_with_target        
-    
-    def getCanvasesInCollection(self, collectionId: str) -> List[Canvas]:
-        canvases_in_collection_df = []
-        canvases_in_collection = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, TriplestoreQueryProcessor):
-                canvases_in_collection_df.append(queryProcessor.getCanvasesInCollection(collectionId))
-        for canvas_in_collection_df in canvases_in_collection_df:
-            for i, row in canvas_in_collection_df.iterrows():
-                id = row["id"]
-                label = row["label"]
-                canvas = Canvas(id, label)
-                canvases_in_collection.append(canvas)
-        return canvases_in_collection
-    
-    def getCanvasesInManifest(self, manifestId: str) -> List[Canvas]:
-        canvases_in_manifest_df = []
-        canvases_in_manifest = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, TriplestoreQueryProcessor):
-                canvases_in_manifest_df.append(queryProcessor.getCanvasesInManifest(manifestId))
-        for canvas_in_manifest_df in canvases_in_manifest_df:
-            for i, row in canvas_in_manifest_df.iterrows():
-                id = row["id"]
-                label = row["label"]
-                canvas = Canvas(id, label)
-                canvases_in_manifest.append(canvas)
-        return canvases_in_manifest
-    
-    def getEntitiesWithCreator(self, creatorName: str) -> List[EntityWithMetadata]:
-        entities_with_creator_df = []
-        entities_with_creator = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, RelationalQueryProcessor):
-                entities_with_creator_df.append(queryProcessor.getEntitiesWithCreator(creatorName))
-        for entity_with_creator_df in entities_with_creator_df:
-            for i, row in entity_with_creator_df.iterrows():
-                id = row["id"]
-                title = row["title"]
-                creators = row["creator"]
-                
-                if id.endswith("collection"):
-                    entity = Collection(id, label=None, title=title, creators=creators)
-                elif id.endswith("manifest"):
-                    entity = Manifest(id, label=None, title=title, creators=creators)
-                else:
-                    entity = EntityWithMetadata(id, title=title, creators=creators)
+    def _storesGeneration(self):
+        # Changes whenever the list of query processors or the data in their databases does
+        return tuple((type(processor).__name__, processor.getDbPathOrUrl(), _storeGeneration(processor.getDbPathOrUrl()))
+                     for processor in self.queryProcessors)
 
-                entities_with_creator.append(entity)
-        return entities_with_creator
+    def setTimeouts(self, relational: float = None, triplestore: float = None):
+        # Seconds each kind of database has to answer a query (None waits forever)
+        self.timeouts[RelationalQueryProcessor] = relational
+        self.timeouts[TriplestoreQueryProcessor] = triplestore
+        return True
 
-    def getEntitiesWithLabel(self, label: str) -> List[EntityWithMetadata]:
-        entities_with_label_df = []
-        entities_with_label = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, TriplestoreQueryProcessor):
-                entities_with_label_df.append(queryProcessor.getEntitiesWithLabel(label))
-        for entity_with_label_df in entities_with_label_df:
-            for i, row in entity_with_label_df.iterrows():
-                id = row["id"]
-                label =  row["label"]
-
-                if id.endswith("collection"):
-                    entity = Collection(id, label=label)
-                elif id.endswith("manifest"):
-                    entity = Manifest(id, label=label)
-                else:
-                    entity = EntityWithMetadata(id, label=label)
-                entities_with_label.append(entity)
-        return entities_with_label
+    def allowPartialResults(self, allow: bool = True):
+        # With partial results, a query processor that fails or times out is left out of the
+        # result (see getFanOutErrors) instead of making the whole method fail
+        self.partialResults = allow
+        return True
 
-    def getEntitiesWithTitle(self, title: str) -> List[EntityWithMetadata]:
-        entities_with_title_df = []
-        entities_with_title = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, RelationalQueryProcessor):
-                entities_with_title_df.append(queryProcessor.getEntitiesWithTitle(title))
-        for entity_with_title_df in entities_with_title_df:
-            for i, row in entity_with_title_df.iterrows():
-                id = row["id"]
-                title = row["title"]
-                creators = row["creator"]
-
-                if id.endswith("collection"):
-                    entity = Collection(id, label=None, title=title, creators=creators)
-                elif id.endswith("manifest"):
-                    entity = Manifest(id, label=None, title=title, creators=creators)
-                else:
-                    entity = EntityWithMetadata(id, title=title, creators=creators)
-                entities_with_title.append(entity)
-        return entities_with_title
-        
-    def getEntityById(self, entityId: str) -> IdentifiableEntity:
-        combined_df = pd.DataFrame()  
-        for processor in self.queryProcessors:
-            entity = processor.getEntityById(entityId)
-            if entity is not None:
-                combined_df = pd.concat([combined_df, entity], ignore_index=True)
-        
-        if not combined_df.empty:
-            merge_columns = []
-            if 'body' in combined_df.columns and 'motivation' in combined_df.columns:
-                merge_columns.extend(['body', 'motivation'])
-            if 'title' in combined_df.columns and 'creator' in combined_df.columns:
-                merge_columns.extend(['title', 'creator'])
-            
-            if len(merge_columns) > 0:
-                merged_entity = combined_df.dropna(subset=merge_columns)
-                if not merged_entity.empty:
-                    merged_label = combined_df['label'].dropna().values[0]
-                    merged_entity.at[0, 'label'] = merged_label
-                    return merged_entity
+    def getFanOutErrors(self):
+        # (query processor, exception) for every processor left out by the last method
+        # called in this thread
+        return list(getattr(self.fanOutErrors, "errors", []))
+
+    @contextmanager
+    def _fanOutScope(self):
+        # Starts a new list of errors for the outermost method called in this thread: the
+        # fan-outs it runs (possibly more than one) add to it instead of replacing it
+        state = self.fanOutErrors
+        depth = getattr(state, "depth", 0)
+        if depth == 0:
+            state.errors = []
+        state.depth = depth + 1
+        try:
+            yield
+        finally:
+            state.depth = depth
+
+    def _timeoutFor(self, processor):
+        for processorType, timeout in self.timeouts.items():
+            if isinstance(processor, processorType):
+                return timeout
         return None
 
-    def getImagesAnnotatingCanvas(self, canvasId: str) -> List[Image]:
-        images_annotating_canvas = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, RelationalQueryProcessor):
-                with connect(queryProcessor.getDbPathOrUrl()) as con:
-                    query = f"SELECT DISTINCT * FROM Annotation WHERE target = '{canvasId}'"
-                    df_sq = pd.read_sql(query, con)
-                    for i, row in df_sq.iterrows():
-                        id = row["body"]
-                        image = Image(id)
-                        images_annotating_canvas.append(image)
-        return images_annotating_canvas
-
-    def getManifestsInCollection(self, collectionId: str) -> List[Manifest]:
-        manifests_in_collection_df = []
-        manifests_in_collection = []
-        for queryProcessor in self.queryProcessors:
-            if isinstance(queryProcessor, TriplestoreQueryProcessor):
-                manifests_in_collection_df.append(queryProcessor.getManifestsInCollection(collectionId))
-        for manifest_in_collection_df in manifests_in_collection_df:
-            for i, row in manifest_in_collection_df.iterrows():
-                id = row["id"]
-                label = row["label"]
-                manifest = Manifest(id, label)
-                manifests_in_collection.append(manifest)
-        return manifests_in_collection
-
-rel_path = "relational.db"
-ann_dp = AnnotationProcessor()
-ann_dp.setDbPathOrUrl(rel_path)
-ann_dp.uploadData("data/annotations.csv")
-
-met_dp = MetadataProcessor()
-met_dp.setDbPathOrUrl(rel_path)
-met_dp.uploadData("data/metadata.csv")
-
-grp_endpoint = "http://127.0.0.1:9999/blazegraph/sparql"
-col_dp = CollectionProcessor()
-col_dp.setDbPathOrUrl(grp_endpoint)
-col_dp.uploadData("data/collection-1.json")
-col_dp.uploadData("data/collection-2.json")
-
-rel_qp = RelationalQueryProcessor()
-rel_qp.setDbPathOrUrl(rel_path)
-
-grp_qp = TriplestoreQueryProcessor()
-grp_qp.setDbPathOrUrl(grp_endpoint)
+    def _fanOut(self, processorType, call):
+        # Runs call(processor) on every query processor of the given type at the same time,
+        # so a method waits for the slowest database instead of all of them in turn, and
+        # returns the results in the order of queryProcessors. The time spent waiting is the
+        # backend phase of the instrumented call.
+        with _phase("backend"), _callBarrier():
+            return self._runFanOut(processorType, call)
+
+    def _backendPool(self, processor):
+        with self.backendPoolsLock:
+            pool = self.backendPools.get(processor)
+            if pool is None:
+                pool = self.backendPools[processor] = _BackendPool(
+                    f"{type(processor).__name__} on {processor.getDbPathOrUrl()}")
+            return pool
+
+    def _runFanOut(self, processorType, call):
+        from concurrent.futures import TimeoutError as FutureTimeoutError
+        processors = [processor for processor in self.queryProcessors if isinstance(processor, processorType)]
+        if getattr(self.fanOutErrors, "depth", 0):
+            errors = self.fanOutErrors.errors
+        else:
+            errors = self.fanOutErrors.errors = []
+        tasks = None
+        if len(processors) > 1 or (processors and self._timeoutFor(processors[0]) is not None):
+            tasks = []
+            for processor in processors:
+                try:
+                    tasks.append(self._backendPool(processor).submit(call, processor))
+                except TimeoutError as e:
+                    tasks.append(e)
+        results = []
+        for index, processor in enumerate(processors):
+            try:
+                if tasks is None:
+                    results.append(call(processor))
+                    continue
+                if isinstance(tasks[index], Exception):
+                    raise tasks[index]
+                timeout = self._timeoutFor(processor)
+                try:
+                    results.append(tasks[index].result(timeout))
+                except FutureTimeoutError:
+                    raise TimeoutError(f"{type(processor).__name__} on {processor.getDbPathOrUrl()} "
+                                       f"did not answer within {timeout} seconds")
+            except Exception as e:
+                if not self.partialResults:
+                    raise
+                errors.append((processor, e))
+        return results
+
+    def enableCache(self, maxSize: int = 256, ttl: float = None):
+        # Opt-in cache of the results of the get methods (see _QueryCache)
+        self.cache = _QueryCache(maxSize, ttl)
+        return True
 
-generic = GenericQueryProcessor()
-generic.addQueryProcessor(rel_qp)
-generic.addQueryProcessor(grp_qp)
+    def disableCache(self):
+        self.cache = None
+        return True
 
+    def clearCache(self):
+        if self.cache is not None:
+            self.cache.clear()
+        return True
 
+    def getCacheStats(self):
+        if self.cache is None:
+            return {}
+        return self.cache.getStats()
+    
+    def cleanQueryProcessors(self):
+        self.queryProcessors = []
+        return True
+        
+    def addQueryProcessor(self, processor: QueryProcessor):
+        self.queryProcessors.append(processor)
+        return True
 
+    @_instrumented
+    @_cached
+    def getAllAnnotations(self, limit: int = None, after: str = None, order: str = None) -> List[Annotation]:
+        all_annotations_df = self._fanOut(RelationalQueryProcessor, lambda queryProcessor: queryProcessor.getAllAnnotations(limit=limit, after=after, order=order))
+        return _materialize(_mergePages(all_annotations_df, "id", limit, after, order), Annotation, ["id", "body", "target", "motivation"])
+
+    @_instrumented
+    @_cached
+    def getAllCanvas(self, limit: int = None, after: str = None, order: str = None)-> List[Canvas]:
+        all_canvases_df = self._fanOut(TriplestoreQueryProcessor, lambda queryProcessor: queryProcessor.getAllCanvases(limit=limit, after=after, order=order))
+        return _materialize(_mergePages(all_canvases_df, "id", limit, after, order), Canvas, ["id", "label"])
+
+    @_instrumented
+    @_cached
+    def getAllCollections(self, limit: int = None, after: str = None, order: str = None)-> List[Collection]:
+        all_collections_df = self._fanOut(TriplestoreQueryProcessor, lambda queryProcessor: queryProcessor.getAllCollections(limit=limit, after=after, order=order))
+        return _materialize(_mergePages(all_collections_df, "id", limit, after, order), Collection, ["id", "label"])
+
+    @_instrumented
+    @_cached
+    def getAllImages(self, limit: int = None, after: str = None, order: str = None)-> List[Image]:
+        all_images_df = self._fanOut(RelationalQueryProcessor, lambda queryProcessor: queryProcessor.getAllImages(limit=limit, after=after, order=order))
+        return _materialize(_mergePages(all_images_df, "body", limit, after, order), Image, ["body"])
+
+    @_instrumented
+    @_cached
+    def getAllManifests(self, limit: int = None, after: str = None, order: str = None)-> List[Manifest]:
+        all_manifests_df = self._fanOut(TriplestoreQueryProcessor, lambda queryProcessor: queryProcessor.getAllManifests(limit=limit, after=after, order=order))
+        return _materialize(_mergePages(all_manifests_df, "id", limit, after, order), Manifest, ["id", "label"])
+
+    # The iter methods yield the same objects as the corresponding get methods, reading
+    # batchSize rows at a time from one database after the other, so the whole result is
+    # never in memory. They are not cached.
+    def _iterAll(self, processorType, iterate, build, columns, batchSize):
+        for queryProcessor in self.queryProcessors:
+            if isinstance(queryProcessor, processorType):
+                for batch in iterate(queryProcessor, batchSize):
+                    yield from _materialize([batch], build, columns)
+
+    def iterAllAnnotations(self, batchSize: int = 10000) -> Iterator[Annotation]:
+        return self._iterAll(RelationalQueryProcessor, RelationalQueryProcessor.iterAllAnnotations,
+                             Annotation, ["id", "body", "target", "motivation"], batchSize)
+
+    def iterAllCanvas(self, batchSize: int = 10000) -> Iterator[Canvas]:
+        return self._iterAll(TriplestoreQueryProcessor, TriplestoreQueryProcessor.iterAllCanvases,
+                             Canvas, ["id", "label"], batchSize)
+
+    def iterAllCollections(self, batchSize: int = 10000) -> Iterator[Collection]:
+        return self._iterAll(TriplestoreQueryProcessor, TriplestoreQueryProcessor.iterAllCollections,
+                             Collection, ["id", "label"], batchSize)
+
+    def iterAllImages(self, batchSize: int = 10000) -> Iterator[Image]:
+        return self._iterAll(RelationalQueryProcessor, RelationalQueryProcessor.iterAllImages,
+                             Image, ["body"], batchSize)
+
+    def iterAllManifests(self, batchSize: int = 10000) -> Iterator[Manifest]:
+        return self._iterAll(TriplestoreQueryProcessor, TriplestoreQueryProcessor.iterAllManifests,
+                             Manifest, ["id", "label"], batchSize)
+
+    def _annotationsToContained(self, containerId, getCanvases, limit, after, order):
+        # Cross-database join: one query per graph database for the canvases contained in
+        # the collection or manifest, then one query per relational database for the
+        # annotations whose target is the container or any of those canvases
+        targetIds = {containerId}
+        for canvases_df in self._fanOut(TriplestoreQueryProcessor, getCanvases):
+            targetIds.update(canvases_df["id"].tolist())
+        annotations_df = self._fanOut(RelationalQueryProcessor, lambda queryProcessor: queryProcessor.getAnnotationsWithTargets(sorted(targetIds), limit=limit, after=after, order=order))
+        return _materialize(_mergePages(annotations_df, "id", limit, after, order), Annotation, ["id", "body", "target", "motivation"])
+
+    @_instrumented
+    @_cached
+    def getAnnotationsToCanvas(self, canvasId: str, limit: int = None, after: str = None, order: str = None) -> List[Annotation]:
+        annotations_to_canvas_df = self._fanOut(RelationalQueryProcessor, lambda queryProcessor: queryProcessor.getAnnotationsWithTarget(canvasId, limit=limit, after=after, order=order))
+        return _materialize(_mergePages(annotations_to_canvas_df, "id", limit, after, order), Annotation, ["id", "body", "target", "motivation"])
+
+    @_instrumented
+    @_cached
+    def getAnnotationsToCollection(self, collectionId: str, limit: int = None, after: str = None, order: str = None) -> List[Annotation]:
+        return self._annotationsToContained(collectionId, lambda queryProcessor: queryProcessor.getCanvasesInCollection(collectionId, variables=["id"]), limit, after, order)
+
+    @_instrumented
+    @_cached
+    def getAnnotationsToManifest(self, manifestId: str, limit: int = None, after: str = None, order: str = None) -> List[Annotation]:
+        return self._annotationsToContained(manifestId, lambda queryProcessor: queryProcessor.getCanvasesInManifest(manifestId, variables=["id"]), limit, after, order)
+
+    @_instrumented
+    @_cached
+    def getAnnotationsWithBody(self, bodyId: str, limit: int = None, after: str = None, order: str = None) -> List[Annotation]:
+        annotations_with_body_df = self._fanOut(RelationalQueryProcessor, lambda queryProcessor: queryProcessor.getAnnotationsWithBody(bodyId, limit=limit, after=after, order=order))
+        return _materialize(_mergePages(annotations_with_body_df, "id", limit, after, order), Annotation, ["id", "body", "target", "motivation"])
+
+    @_instrumented
+    @_cached
+    def getAnnotationsWithBodyAndTarget(self, bodyId: str, targetId : str, limit: int = None, after: str = None, order: str = None) -> List[Annotation]:
+        annotations_with_body_and_target_df = self._fanOut(RelationalQueryProcessor, lambda queryProcessor: queryProcessor.getAnnotationsWithBodyAndTarget(bodyId, targetId, limit=limit, after=after, order=order))
+        return _materialize(_mergePages(annotations_with_body_and_target_df, "id", limit, after, order), Annotation, ["id", "body", "target", "motivation"])
+
+    @_instrumented
+    @_cached
+    def getAnnotationsWithTarget(self, targetId: str, limit: int = None, after: str = None, order: str = None) -> List[Annotation]:
+        annotations_with_target_df = self._fanOut(RelationalQueryProcessor, lambda queryProcessor: queryProcessor.getAnnotationsWithTarget(targetId, limit=limit, after=after, order=order))
+        return _materialize(_mergePages(annotations_with_target_df, "id", limit, after, order), Annotation, ["id", "body", "target", "motivation"])
+
+    @_instrumented
+    @_cached
+    def getCanvasesInCollection(self, collectionId: str, limit: int = None, after: str = None, order: str = None) -> List[Canvas]:
+        canvases_in_collection_df = self._fanOut(TriplestoreQueryProcessor, lambda queryProcessor: queryProcessor.getCanvasesInCollection(collectionId, limit=limit, after=after, order=order))
+        return _materialize(_mergePages(canvases_in_collection_df, "id", limit, after, order), Canvas, ["id", "label"])
+
+    @_instrumented
+    @_cached
+    def getCanvasesInManifest(self, manifestId: str, limit: int = None, after: str = None, order: str = None) -> List[Canvas]:
+        canvases_in_manifest_df = self._fanOut(TriplestoreQueryProcessor, lambda queryProcessor: queryProcessor.getCanvasesInManifest(manifestId, limit=limit, after=after, order=order))
+        return _materialize(_mergePages(canvases_in_manifest_df, "id", limit, after, order), Canvas, ["id", "label"])
+
+    @_instrumented
+    @_cached
+    def getEntitiesWithCreator(self, creatorName: str, limit: int = None, after: str = None, order: str = None) -> List[EntityWithMetadata]:
+        entities_with_creator_df = self._fanOut(RelationalQueryProcessor, lambda queryProcessor: queryProcessor.getEntitiesWithCreator(creatorName, limit=limit, after=after, order=order))
+        return _materialize(_mergePages(entities_with_creator_df, "id", limit, after, order), _entityWithMetadata, ["id", "title", "creator"])
+
+    @_instrumented
+    @_cached
+    def getEntitiesWithLabel(self, label: str, limit: int = None, after: str = None, order: str = None) -> List[EntityWithMetadata]:
+        entities_with_label_df = self._fanOut(TriplestoreQueryProcessor, lambda queryProcessor: queryProcessor.getEntitiesWithLabel(label, limit=limit, after=after, order=order))
+        return _materialize(_mergePages(entities_with_label_df, "id", limit, after, order), _entityWithLabel, ["id", "label"])
+
+    @_instrumented
+    @_cached
+    def getEntitiesWithTitle(self, title: str, limit: int = None, after: str = None, order: str = None) -> List[EntityWithMetadata]:
+        entities_with_title_df = self._fanOut(RelationalQueryProcessor, lambda queryProcessor: queryProcessor.getEntitiesWithTitle(title, limit=limit, after=after, order=order))
+        return _materialize(_mergePages(entities_with_title_df, "id", limit, after, order), _entityWithMetadata, ["id", "title", "creator"])
+
+    @_instrumented
+    @_cached
+    def searchEntities(self, text: str, field: str = None, prefix: bool = True, limit: int = None, after: str = None, order: str = None) -> List[EntityWithMetadata]:
+        found_entities_df = self._fanOut(RelationalQueryProcessor, lambda queryProcessor: queryProcessor.searchEntities(text, field, prefix, limit=limit, after=after, order=order))
+        if order is None and after is None:
+            # best matches of every database first, as in RelationalQueryProcessor
+            found_entities = _materialize(found_entities_df, _entityWithMetadata, ["id", "title", "creator"])
+            return found_entities if limit is None else found_entities[:limit]
+        return _materialize(_mergePages(found_entities_df, "id", limit, after, order), _entityWithMetadata, ["id", "title", "creator"])
+
+    def _resolveEntities(self, entityIds):
+        # Identifier -> entity for the identifiers found in some database. Entities already
+        # in the identity map are returned as they are; the others are built from the rows
+        # of all the databases (then the items of the collections and manifests among them)
+        # and added to it, unless one of the two fan-outs left a database out.
+        with self._fanOutScope():
+            return self._resolveEntitiesInScope(entityIds)
+
+    def _resolveEntitiesInScope(self, entityIds):
+        generation = self._storesGeneration()
+        entities = {}
+        missing = []
+        for entityId in dict.fromkeys(entityIds):
+            found, entity = self.identityMap.get(entityId, generation)
+            if found:
+                entities[entityId] = entity
+            else:
+                missing.append(entityId)
+        if not missing:
+            return entities
+
+        fieldsById = {}
+        for entities_df in self._fanOut(QueryProcessor, lambda queryProcessor: queryProcessor.getEntitiesByIds(missing)):
+            for record in entities_df.to_dict("records"):
+                fields = fieldsById.setdefault(record["id"], {})
+                for name, value in record.items():
+                    if name not in fields and not pd.isna(value):
+                        fields[name] = value
+        containers = [entityId for entityId, fields in fieldsById.items() if fields.get("type") in ("Collection", "Manifest")]
+        itemsById = {entityId: {} for entityId in containers}
+        if containers:
+            for items_df in self._fanOut(TriplestoreQueryProcessor, lambda queryProcessor: queryProcessor.getItemsByIds(containers)):
+                for parent, itemId, itemType, label in zip(*(items_df[column].tolist() for column in ("parent", "id", "type", "label"))):
+                    items = itemsById[parent]
+                    if itemId not in items:
+                        items[itemId] = _entityFromFields(itemId, {"type": itemType, "label": label})
+
+        complete = not self.getFanOutErrors()
+        with _phase("materialize"):
+            for entityId, fields in fieldsById.items():
+                entity = _entityFromFields(entityId, fields)
+                if entityId in itemsById:
+                    entity.items = list(itemsById[entityId].values())
+                # an entity built without some of the databases is not kept
+                if complete:
+                    self.identityMap.put(entityId, generation, entity)
+                entities[entityId] = entity
+        return entities
+
+    @_instrumented
+    def getEntitiesByIds(self, entityIds: List[str]) -> List[IdentifiableEntity]:
+        # The entities with the input identifiers, in the same order (identifiers found in
+        # no database are left out), each one merging what every database knows about it
+        entities = self._resolveEntities(entityIds)
+        return [entities[entityId] for entityId in dict.fromkeys(entityIds) if entityId in entities]
+
+    @_instrumented
+    def getEntityById(self, entityId: str) -> IdentifiableEntity:
+        return self._resolveEntities([entityId]).get(entityId)
+
+    @_instrumented
+    @_cached
+    def getImagesAnnotatingCanvas(self, canvasId: str, limit: int = None, after: str = None, order: str = None) -> List[Image]:
+        images_annotating_canvas_df = self._fanOut(RelationalQueryProcessor, lambda queryProcessor: queryProcessor.getImagesWithTarget(canvasId, limit=limit, after=after, order=order))
+        frames = _mergePages(images_annotating_canvas_df, "body", limit, after, order)
+        # an image stored in several databases is returned once, paged or not
+        frames = [pd.concat(frames, ignore_index=True).drop_duplicates(subset=["body"])] if len(frames) else []
+        return _materialize(frames, Image, ["body"])
+
+    @_instrumented
+    @_cached
+    def getManifestsInCollection(self, collectionId: str, limit: int = None, after: str = None, order: str = None) -> List[Manifest]:
+        manifests_in_collection_df = self._fanOut(TriplestoreQueryProcessor, lambda queryProcessor: queryProcessor.getManifestsInCollection(collectionId, limit=limit, after=after, order=order))
+        return _materialize(_mergePages(manifests_in_collection_df, "id", limit, after, order), Manifest, ["id", "label"])
+
+def main():
+    # Loads the sample data shipped in data/ and builds the query processors on top of it.
+    # Run with "python impl.py"; importing the module does not load anything.
+    rel_path = "relational.db"
+    ann_dp = AnnotationProcessor()
+    ann_dp.setDbPathOrUrl(rel_path)
+    ann_dp.uploadData("data/annotations.csv")
+
+    met_dp = MetadataProcessor()
+    met_dp.setDbPathOrUrl(rel_path)
+    met_dp.uploadData("data/metadata.csv")
+
+    grp_endpoint = "http://127.0.0.1:9999/blazegraph/sparql"
+    col_dp = CollectionProcessor()
+    col_dp.setDbPathOrUrl(grp_endpoint)
+    col_dp.uploadData(["data/collection-1.json", "data/collection-2.json"])
+
+    rel_qp = RelationalQueryProcessor()
+    rel_qp.setDbPathOrUrl(rel_path)
+
+    grp_qp = TriplestoreQueryProcessor()
+    grp_qp.setDbPathOrUrl(grp_endpoint)
+
+    generic = GenericQueryProcessor()
+    generic.addQueryProcessor(rel_qp)
+    generic.addQueryProcessor(grp_qp)
+
+    return generic
+
+if __name__ == "__main__":
+    main()
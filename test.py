@@ -12,12 +12,34 @@
 # DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
 # ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
 # SOFTWARE.
+import gzip
+import http.client
+import io
+import json
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
-from os import sep
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from unittest.mock import patch
+from urllib.parse import parse_qs
+from os import environ, getpid, listdir, mkdir, sep
+from os.path import abspath, dirname, getsize, join
 from impl import AnnotationProcessor, MetadataProcessor, RelationalQueryProcessor
 from impl import CollectionProcessor, TriplestoreQueryProcessor
-from impl import GenericQueryProcessor
-from pandas import DataFrame
+from impl import GenericQueryProcessor, _decodeSparqlResult, _normalizeCreator, _pageSql
+from impl import _SparqlHttpPool, _TripleUploader, _writeStoreMarker
+from impl import _csvFileChunks, _spillChunks, _workersFor, _JsonStream, _walkIIIFObject
+from impl import getMetrics, getMetricsText, resetMetrics, upgradeRelationalDatabase
+from benchmark import runBenchmark
+from pandas import DataFrame, isna, read_csv
+from rdflib import Graph, Literal, URIRef
 from impl import IdentifiableEntity, EntityWithMetadata, Canvas, Collection, Image, Annotation, Manifest
 
 # REMEMBER: before launching the tests, please run the Blazegraph instance!
@@ -199,4 +221,1195 @@ class TestProjectBasic(unittest.TestCase):
         man_2 = generic.getManifestsInCollection("https://dl.ficlit.unibo.it/iiif/28429/collection")
         self.assertIsInstance(man_2, list)
         for a in man_2:
-            self.assertIsInstance(a, Manifest)
\ No newline at end of file
+            self.assertIsInstance(a, Manifest)
+
+class TestEmbeddedTriplestore(TestProjectBasic):
+
+    # The same tests, with the graph database stored in a local file (the embedded
+    # triplestore) instead of a Blazegraph instance
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.TemporaryDirectory()
+        cls.graph = join(cls.folder.name, "graph.nt")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.folder.cleanup()
+
+# A local HTTP server standing in for a SPARQL endpoint: respond(handler, body) is called
+# for every request and writes the response. Yields the endpoint URL.
+@contextmanager
+def stubEndpoint(respond):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            respond(self, b"")
+
+        def do_POST(self):
+            respond(self, self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/sparql"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class TestTripleUploader(unittest.TestCase):
+
+    # The first request gets a garbled status line (an HTTPException, not a URLError):
+    # the chunk is sent again and the upload goes on
+    def test_retries_a_garbled_response(self):
+        requests = []
+
+        def respond(handler, body):
+            requests.append(body)
+            if len(requests) == 1:
+                handler.wfile.write(b"garbage\r\n")
+                handler.close_connection = True
+                return
+            handler.send_response(200)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+
+        with stubEndpoint(respond) as endpoint:
+            uploader = _TripleUploader(endpoint, batchSize=10)
+            uploader.add((URIRef("http://example.org/a"), URIRef("http://example.org/p"), Literal("b")))
+            uploader.flush()
+
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[0], requests[1])
+        self.assertEqual(uploader.report()["retries"], 1)
+        self.assertEqual(uploader.report()["triples"], 1)
+
+    # Client errors are not retried
+    def test_does_not_retry_client_errors(self):
+        requests = []
+
+        def respond(handler, body):
+            requests.append(body)
+            handler.send_response(400)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+
+        with stubEndpoint(respond) as endpoint:
+            uploader = _TripleUploader(endpoint, batchSize=10)
+            uploader.add((URIRef("http://example.org/a"), URIRef("http://example.org/p"), Literal("b")))
+            with self.assertRaises(OSError):
+                uploader.flush()
+        self.assertEqual(len(requests), 1)
+
+
+class TestSparqlHttpPool(unittest.TestCase):
+
+    csv = b"id,label\r\na,A\r\n"
+
+    def respond(self, handler, data, headers=()):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/csv")
+        for name, value in headers:
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def test_connections_are_reused(self):
+        with stubEndpoint(lambda handler, body: self.respond(handler, self.csv)) as endpoint:
+            pool = _SparqlHttpPool(endpoint, gzip=False)
+            for _ in range(3):
+                self.assertEqual(pool.select("SELECT * WHERE { ?s ?p ?o }"), ("text/csv", self.csv))
+            stats = pool.getStats()
+            pool.close()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["connectionsOpened"], 1)
+        self.assertEqual(stats["connectionsReused"], 2)
+        self.assertEqual(stats["bytesReceived"], 3 * len(self.csv))
+        self.assertEqual(stats["idleConnections"], 1)
+
+    def test_gzip_responses_are_decompressed(self):
+        encodings = []
+
+        def respond(handler, body):
+            encodings.append(handler.headers.get("Accept-Encoding"))
+            self.respond(handler, gzip.compress(self.csv), [("Content-Encoding", "gzip")])
+
+        with stubEndpoint(respond) as endpoint:
+            pool = _SparqlHttpPool(endpoint)
+            self.assertEqual(pool.select("SELECT * WHERE { ?s ?p ?o }")[1], self.csv)
+            pool.close()
+        self.assertEqual(encodings, ["gzip"])
+
+    # The endpoint closes the connection after the first response without saying so: the
+    # next query fails on the reused connection before anything is received, and is sent
+    # again on a new connection
+    def test_closed_idle_connections_are_retried(self):
+        requests = []
+
+        def respond(handler, body):
+            requests.append(body)
+            self.respond(handler, self.csv)
+            handler.close_connection = True
+
+        with stubEndpoint(respond) as endpoint:
+            pool = _SparqlHttpPool(endpoint, gzip=False)
+            self.assertEqual(pool.select("SELECT * WHERE { ?s ?p ?o }")[1], self.csv)
+            self.assertEqual(pool.select("SELECT * WHERE { ?s ?p ?o }")[1], self.csv)
+            stats = pool.getStats()
+            pool.close()
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(stats["connectionsOpened"], 2)
+
+    # A response cut short on a reused connection is not sent again
+    def test_partial_responses_are_not_retried(self):
+        requests = []
+
+        def respond(handler, body):
+            requests.append(body)
+            if len(requests) == 1:
+                self.respond(handler, self.csv)
+                return
+            handler.send_response(200)
+            handler.send_header("Content-Length", str(len(self.csv) + 100))
+            handler.end_headers()
+            handler.wfile.write(self.csv)
+            handler.close_connection = True
+
+        with stubEndpoint(respond) as endpoint:
+            pool = _SparqlHttpPool(endpoint, gzip=False)
+            pool.select("SELECT * WHERE { ?s ?p ?o }")
+            with self.assertRaises(http.client.IncompleteRead):
+                pool.select("SELECT * WHERE { ?s ?p ?o }")
+            pool.close()
+        self.assertEqual(len(requests), 2)
+
+
+def _iiifEntities(obj, depth=0, parentId=None):
+    # What _walkIIIFObject must yield, computed on the whole document loaded by json.load
+    levels = ("Collection", "Manifest", "Canvas")
+    yield (levels[depth], obj["id"], obj["label"]["none"][0], parentId)
+    if depth < len(levels) - 1:
+        for item in obj.get("items", []):
+            yield from _iiifEntities(item, depth + 1, obj["id"])
+
+
+class TestJsonStream(unittest.TestCase):
+
+    # Keys in any order ("id" after "items"), nested values the walker skips, strings with
+    # brackets, escapes and non-ASCII characters, numbers, and an empty list of items
+    document = {
+        "items": [
+            {"label": {"none": ["Manifest {1}, \"quoted\""]},
+             "items": [{"id": f"https://example.org/m1/canvas/p{page}", "type": "Canvas",
+                        "label": {"none": [f"p. {page} — ],[{{"]}, "width": 1234567 + page, "height": 0.5}
+                       for page in range(5)],
+             "metadata": [{"label": "a", "value": [1, 2.5e3, None, True, {"b": "}"}]}],
+             "id": "https://example.org/m1/manifest", "type": "Manifest"},
+            {"id": "https://example.org/m2/manifest", "type": "Manifest", "items": [],
+             "label": {"none": ["Città\\n"]}}],
+        "type": "Collection", "label": {"none": ["Collezione"]}, "id": "https://example.org/collection"}
+
+    def test_matches_json_load_for_every_block_size(self):
+        with open("data" + sep + "collection-1.json", encoding="utf-8") as f:
+            sample = f.read()
+        for text in (json.dumps(self.document, ensure_ascii=False), json.dumps(self.document, indent=4), sample):
+            expected = list(_iiifEntities(json.loads(text)))
+            for blockSize in (1, 2, 3, 7, 64, 1000, 65536):
+                self.assertEqual(list(_walkIIIFObject(_JsonStream(io.StringIO(text), blockSize), 0, None)), expected,
+                                 f"block size {blockSize}")
+
+    # The first chunk of triples leaves while most of the file is still unread
+    def test_first_chunk_is_sent_before_the_file_is_read(self):
+        with tempfile.TemporaryDirectory() as folder:
+            collection = {"id": "https://example.org/big/collection", "type": "Collection",
+                          "label": {"none": ["Big"]},
+                          "items": [{"id": f"https://example.org/big/m{m}/manifest", "type": "Manifest",
+                                     "label": {"none": [f"Manifest {m}"]},
+                                     "items": [{"id": f"https://example.org/big/m{m}/canvas/p{p}", "type": "Canvas",
+                                                "label": {"none": [f"p. {p}"]}} for p in range(100)]}
+                                    for m in range(30)]}
+            path = join(folder, "collection.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(collection, f)
+            files = []
+            positions = []
+
+            def opened(file, *args, **kwargs):
+                f = open(file, *args, **kwargs)
+                if file == path:
+                    files.append(f)
+                return f
+
+            send = _TripleUploader._send
+
+            def sent(uploader, body):
+                # the last chunk is flushed once the file is done with
+                positions.append(getsize(path) if files[0].closed else files[0].tell())
+                return send(uploader, body)
+
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(join(folder, "graph.nt"))
+            with patch("impl.open", opened, create=True), patch.object(_TripleUploader, "_send", sent):
+                self.assertTrue(col_dp.uploadData(path, batchSize=100, workers=1))
+            self.assertGreater(len(positions), 1)
+            self.assertLess(positions[0], getsize(path) / 2)
+
+
+class TestSeveralFiles(unittest.TestCase):
+
+    # The annotations split in three files, uploaded through a glob by two worker
+    # processes: the database gets the same rows as from the single file, and the chunks
+    # spilled by the workers are deleted
+    def test_glob_upload_with_workers(self):
+        with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as spills, \
+                patch("tempfile.tempdir", spills):
+            annotations = read_csv("data" + sep + "annotations.csv", keep_default_na=False, dtype=str)
+            for part in range(3):
+                annotations.iloc[part::3].to_csv(join(folder, f"annotations-{part}.csv"), index=False)
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(join(folder, "relational.db"))
+            self.assertTrue(ann_dp.uploadData(join(folder, "annotations-*.csv"), chunkSize=20, workers=2))
+            report = ann_dp.getUploadReport()
+            self.assertEqual(report["files"], 3)
+            self.assertEqual(report["rows"], len(annotations))
+            self.assertGreater(report["chunks"], 3)
+            with sqlite3.connect(join(folder, "relational.db")) as con:
+                ids = [row[0] for row in con.execute("SELECT id FROM Annotation")]
+            con.close()
+            self.assertEqual(sorted(ids), sorted(annotations["id"]))
+            self.assertEqual(listdir(spills), [])
+
+    # A list of collection files parsed by two workers gives the same triples as the files
+    # read one after the other by the uploading process
+    def test_list_upload_with_workers(self):
+        with tempfile.TemporaryDirectory() as folder:
+            files = ["data" + sep + "collection-1.json", "data" + sep + "collection-2.json"]
+            for name, workers in (("parallel.nt", 2), ("serial.nt", 1)):
+                col_dp = CollectionProcessor()
+                col_dp.setDbPathOrUrl(join(folder, name))
+                self.assertTrue(col_dp.uploadData(files, workers=workers))
+                self.assertEqual(col_dp.getUploadReport()["files"], 2)
+            graphs = []
+            for name in ("parallel.nt", "serial.nt"):
+                with open(join(folder, name), encoding="utf-8") as f:
+                    graphs.append(f.readlines())
+            self.assertEqual(graphs[0], graphs[1])
+
+    # Each chunk of a file is spilled on its own, and small uploads use no worker processes
+    def test_chunks_are_spilled_one_by_one(self):
+        with tempfile.TemporaryDirectory() as folder:
+            spilled = _spillChunks("data" + sep + "annotations.csv",
+                                   partial(_csvFileChunks, dtype=str, chunkSize=50), folder)
+            rows = len(read_csv("data" + sep + "annotations.csv"))
+            self.assertEqual(len(spilled), -(-rows // 50))
+        self.assertEqual(_workersFor(["data" + sep + "collection-1.json", "data" + sep + "collection-2.json"], None), 1)
+        self.assertEqual(_workersFor(["data" + sep + "collection-1.json", "data" + sep + "collection-2.json"], 4), 2)
+
+
+class TestRepeatedUploads(unittest.TestCase):
+
+    annotations = "data" + sep + "annotations.csv"
+    metadata = "data" + sep + "metadata.csv"
+
+    def test_upsert_does_not_duplicate_rows(self):
+        with tempfile.TemporaryDirectory() as folder:
+            relational = join(folder, "relational.db")
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(relational)
+            met_dp = MetadataProcessor()
+            met_dp.setDbPathOrUrl(relational)
+
+            self.assertTrue(ann_dp.uploadData(self.annotations))
+            self.assertTrue(met_dp.uploadData(self.metadata))
+            self.assertTrue(ann_dp.uploadData(self.annotations))
+            self.assertTrue(met_dp.uploadData(self.metadata))
+
+            report = ann_dp.getUploadReport()
+            self.assertEqual(report["inserted"], 0)
+            self.assertEqual(report["unchanged"], report["rows"])
+            with sqlite3.connect(relational) as con:
+                self.assertEqual(con.execute("SELECT COUNT(*) FROM Annotation").fetchone()[0], report["rows"])
+                self.assertEqual(con.execute("SELECT COUNT(*) FROM EntityWithMetadata").fetchone()[0],
+                                 met_dp.getUploadReport()["rows"])
+
+    # The embedded triplestore only appends triples it does not contain yet
+    def test_reupload_does_not_grow_the_graph_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            graph = join(folder, "graph.nt")
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(graph)
+
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-1.json"))
+            with open(graph, encoding="utf-8") as f:
+                lines = f.readlines()
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-1.json"))
+            with open(graph, encoding="utf-8") as f:
+                self.assertEqual(f.readlines(), lines)
+            self.assertEqual(len(lines), len(set(lines)))
+
+    # Append mode only adds identifiers that are not stored yet: running it twice
+    # succeeds, and a row whose content changed keeps the stored version
+    def test_append_skips_existing_identifiers(self):
+        with tempfile.TemporaryDirectory() as folder:
+            relational = join(folder, "relational.db")
+            met_dp = MetadataProcessor()
+            met_dp.setDbPathOrUrl(relational)
+
+            self.assertTrue(met_dp.uploadData(self.metadata, mode="append"))
+            rows = met_dp.getUploadReport()["rows"]
+            changed = join(folder, "changed.csv")
+            metadata = read_csv(self.metadata, keep_default_na=False, dtype=str)
+            metadata.loc[0, "title"] = "Changed title"
+            metadata.to_csv(changed, index=False)
+            self.assertTrue(met_dp.uploadData(changed, mode="append"))
+
+            report = met_dp.getUploadReport()
+            self.assertEqual(report["inserted"], 0)
+            self.assertEqual(report["unchanged"], rows)
+            with sqlite3.connect(relational) as con:
+                self.assertEqual(con.execute("SELECT COUNT(*) FROM EntityWithMetadata").fetchone()[0], rows)
+                self.assertEqual(con.execute("SELECT COUNT(*) FROM EntityWithMetadata WHERE title = ?",
+                                             ("Changed title",)).fetchone()[0], 0)
+                self.assertEqual(con.execute("SELECT COUNT(*) FROM Creator").fetchone()[0],
+                                 con.execute("SELECT COUNT(DISTINCT entityId || name) FROM Creator").fetchone()[0])
+
+            # a later upsert of the appended rows only writes the changed one
+            self.assertTrue(met_dp.uploadData(changed))
+            self.assertEqual(met_dp.getUploadReport()["updated"], 1)
+
+    # The query processor keeps its read-only connections open between queries: rows
+    # uploaded afterwards must still be visible, also from other threads (the identifier
+    # contains a quote, which is bound as a parameter and not pasted in the query)
+    def test_pooled_connections_see_new_uploads(self):
+        with tempfile.TemporaryDirectory() as folder:
+            relational = join(folder, "relational.db")
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(relational)
+            rel_qp = RelationalQueryProcessor()
+            rel_qp.setDbPathOrUrl(relational)
+
+            self.assertTrue(ann_dp.uploadData(self.annotations))
+            self.assertEqual(len(rel_qp.getAllAnnotations()), ann_dp.getUploadReport()["rows"])
+            before = len(rel_qp.getAllImages())
+            extra = join(folder, "extra.csv")
+            with open(extra, "w") as f:
+                f.write("id,body,target,motivation\n"
+                        "https://example.org/anno/1,https://example.org/image.jpg,https://example.org/canvas/l'1,painting\n")
+            self.assertTrue(ann_dp.uploadData(extra))
+
+            with ThreadPoolExecutor(4) as executor:
+                counts = list(executor.map(lambda _: len(rel_qp.getAllImages()), range(20)))
+            self.assertEqual(counts, [before + 1] * 20)
+            self.assertEqual(len(rel_qp.getAnnotationsWithTarget("https://example.org/canvas/l'1")), 1)
+
+
+class TestUpgrade(unittest.TestCase):
+
+    # The tables written by the first version of the processors: DataFrame.to_sql appends
+    # the whole file on every upload, copying the metadata into Collection, Manifest and
+    # Canvas, without keys, indexes or a schema version
+    def legacyUpload(self, con):
+        annotations = read_csv("data" + sep + "annotations.csv", keep_default_na=False, dtype=str)
+        annotations.insert(0, "internalId", ["annotation-" + str(idx) for idx in range(len(annotations))])
+        annotations.to_sql("Annotation", con, if_exists="append", index=False)
+        image = annotations[["body"]].copy()
+        image.insert(0, "internalId", ["image-" + str(idx) for idx in range(len(image))])
+        image.to_sql("Image", con, if_exists="append", index=False)
+
+        metadata = read_csv("data" + sep + "metadata.csv", keep_default_na=False, dtype=str)
+        metadata.insert(0, "internalId", ["metadata-" + str(idx) for idx in range(len(metadata))])
+        metadata.to_sql("EntityWithMetadata", con, if_exists="append", index=False)
+        for table in ("Collection", "Manifest", "Canvas"):
+            metadata.to_sql(table, con, if_exists="append", index=False)
+        return annotations, metadata
+
+    def test_upgrade_of_a_database_loaded_twice(self):
+        with tempfile.TemporaryDirectory() as folder:
+            relational = join(folder, "relational.db")
+            with sqlite3.connect(relational) as con:
+                self.legacyUpload(con)
+                annotations, metadata = self.legacyUpload(con)
+            con.close()
+
+            self.assertEqual(upgradeRelationalDatabase(relational), 4)
+            # a second upgrade has nothing left to do
+            self.assertEqual(upgradeRelationalDatabase(relational), 4)
+
+            with sqlite3.connect(relational) as con:
+                count = lambda query: con.execute(query).fetchone()[0]
+                # duplicated rows are removed
+                self.assertEqual(count("SELECT COUNT(*) FROM Annotation"), annotations["id"].nunique())
+                self.assertEqual(count("SELECT COUNT(*) FROM Image"), annotations["body"].nunique())
+                self.assertEqual(count("SELECT COUNT(*) FROM EntityWithMetadata"), metadata["id"].nunique())
+                # V3: creators and the full-text index are filled from the existing rows
+                self.assertEqual(count("SELECT COUNT(*) FROM Creator WHERE entityId = "
+                                       "'https://dl.ficlit.unibo.it/iiif/28429/collection'"), 2)
+                self.assertEqual(count("SELECT COUNT(*) FROM Creator"),
+                                 sum(len([name for name in creator.split(";") if name.strip()])
+                                     for creator in metadata.drop_duplicates("id")["creator"]))
+                self.assertEqual(count("SELECT COUNT(*) FROM EntitySearch WHERE EntitySearch MATCH 'canzoniere'"), 1)
+                # V4: every entity gets its type, the copied tables become views
+                self.assertEqual(count("SELECT COUNT(*) FROM EntityWithMetadata WHERE type IS NULL"), 0)
+                self.assertEqual(count("SELECT COUNT(*) FROM Collection") + count("SELECT COUNT(*) FROM Manifest")
+                                 + count("SELECT COUNT(*) FROM Canvas"), metadata["id"].nunique())
+                self.assertEqual(count("SELECT type FROM sqlite_master WHERE name = 'Canvas'"), "view")
+            con.close()
+
+            # the upgraded database takes new uploads without duplicating rows
+            met_dp = MetadataProcessor()
+            met_dp.setDbPathOrUrl(relational)
+            self.assertTrue(met_dp.uploadData("data" + sep + "metadata.csv"))
+            self.assertEqual(met_dp.getUploadReport()["inserted"], 0)
+            rel_qp = RelationalQueryProcessor()
+            rel_qp.setDbPathOrUrl(relational)
+            self.assertEqual(sorted(rel_qp.getEntitiesWithCreator("alighieri, dante")["id"]),
+                             ["https://dl.ficlit.unibo.it/iiif/2/28429/manifest"])
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        metadata = join(self.folder.name, "metadata.csv")
+        DataFrame({
+            "id": ["e1", "e2", "e3", "e4"],
+            "title": ["Dante Alighieri: Opere", "Il Canzoniere", "Divina Commedia", ""],
+            "creator": ["Doe, John; Doe,  Jane", "Alighieri, Dante", "ALIGHIERI, Dante; Città, Nicolò", ""]
+        }).to_csv(metadata, index=False)
+        met_dp = MetadataProcessor()
+        met_dp.setDbPathOrUrl(join(self.folder.name, "relational.db"))
+        self.assertTrue(met_dp.uploadData(metadata))
+        self.rel_qp = RelationalQueryProcessor()
+        self.rel_qp.setDbPathOrUrl(join(self.folder.name, "relational.db"))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_creator_names_are_normalized(self):
+        self.assertEqual(_normalizeCreator("  ALIGHIERI,   Dante "), "alighieri, dante")
+        self.assertEqual(_normalizeCreator("Doe,\tJane"), "doe, jane")
+
+    # One Creator row per creator of each entity (the name as written, the normalized name
+    # for matching), entities without creators have none
+    def test_creator_table(self):
+        with sqlite3.connect(join(self.folder.name, "relational.db")) as con:
+            rows = con.execute("SELECT entityId, name, normName FROM Creator ORDER BY entityId, name").fetchall()
+        self.assertEqual(rows, [
+            ("e1", "Doe,  Jane", "doe, jane"),
+            ("e1", "Doe, John", "doe, john"),
+            ("e2", "Alighieri, Dante", "alighieri, dante"),
+            ("e3", "ALIGHIERI, Dante", "alighieri, dante"),
+            ("e3", "Città, Nicolò", "città, nicolò")])
+
+    def test_entities_with_creator(self):
+        self.assertEqual(sorted(self.rel_qp.getEntitiesWithCreator("alighieri,  DANTE")["id"]), ["e2", "e3"])
+        self.assertEqual(self.rel_qp.getEntitiesWithCreator("Doe, Jane")["id"].tolist(), ["e1"])
+        # a creator matches as a whole, not as a part of the creator field
+        self.assertEqual(len(self.rel_qp.getEntitiesWithCreator("Doe")), 0)
+
+    def test_search_tokens_and_prefixes(self):
+        ids = lambda df: sorted(df["id"])
+        # every word must match, in any field and in any case
+        self.assertEqual(ids(self.rel_qp.searchEntities("dante opere")), ["e1"])
+        self.assertEqual(ids(self.rel_qp.searchEntities("DANTE")), ["e1", "e2", "e3"])
+        # words are prefixes unless prefix is False
+        self.assertEqual(ids(self.rel_qp.searchEntities("canzon")), ["e2"])
+        self.assertEqual(len(self.rel_qp.searchEntities("canzon", prefix=False)), 0)
+        # diacritics are ignored, quotes are searched as text
+        self.assertEqual(ids(self.rel_qp.searchEntities("citta nicolo")), ["e3"])
+        self.assertEqual(len(self.rel_qp.searchEntities('"dante')), 3)
+        self.assertEqual(len(self.rel_qp.searchEntities("  ")), 0)
+
+    def test_search_fields(self):
+        ids = lambda df: sorted(df["id"])
+        self.assertEqual(ids(self.rel_qp.searchEntities("dante", field="title")), ["e1"])
+        self.assertEqual(ids(self.rel_qp.searchEntities("dante", field="creator")), ["e2", "e3"])
+        self.assertEqual(len(self.rel_qp.searchEntities("commedia", field="creator")), 0)
+        with self.assertRaises(ValueError):
+            self.rel_qp.searchEntities("dante", field="id")
+
+    def test_search_pages(self):
+        first = self.rel_qp.searchEntities("dante", limit=2, order="asc")
+        self.assertEqual(first["id"].tolist(), ["e1", "e2"])
+        rest = self.rel_qp.searchEntities("dante", limit=2, after="e2", order="asc")
+        self.assertEqual(rest["id"].tolist(), ["e3"])
+
+
+class TestQueryCache(unittest.TestCase):
+
+    annotations = "data" + sep + "annotations.csv"
+
+    def test_cache_hits_and_invalidation(self):
+        with tempfile.TemporaryDirectory() as folder:
+            relational = join(folder, "relational.db")
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(relational)
+            self.assertTrue(ann_dp.uploadData(self.annotations))
+            rel_qp = RelationalQueryProcessor()
+            rel_qp.setDbPathOrUrl(relational)
+            generic = GenericQueryProcessor()
+            generic.addQueryProcessor(rel_qp)
+            self.assertTrue(generic.enableCache(maxSize=2))
+
+            images = generic.getAllImages()
+            self.assertEqual(len(generic.getAllImages()), len(images))
+            self.assertEqual(generic.getCacheStats()["hits"], 1)
+
+            extra = join(folder, "extra.csv")
+            with open(extra, "w") as f:
+                f.write("id,body,target,motivation\n"
+                        "https://example.org/anno/1,https://example.org/image.jpg,https://example.org/canvas/1,painting\n")
+            self.assertTrue(ann_dp.uploadData(extra))
+            self.assertEqual(len(generic.getAllImages()), len(images) + 1)
+            self.assertEqual(generic.getCacheStats()["invalidations"], 1)
+
+            generic.getAnnotationsWithTarget("https://example.org/canvas/1")
+            generic.getAnnotationsWithBody("https://example.org/image.jpg")
+            stats = generic.getCacheStats()
+            self.assertEqual(stats["size"], 2)
+            self.assertEqual(stats["evictions"], 1)
+
+
+class TestIterators(unittest.TestCase):
+
+    def test_iter_methods_match_get_methods(self):
+        with tempfile.TemporaryDirectory() as folder:
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(join(folder, "relational.db"))
+            self.assertTrue(ann_dp.uploadData("data" + sep + "annotations.csv"))
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(join(folder, "graph.nt"))
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-1.json"))
+
+            rel_qp = RelationalQueryProcessor()
+            rel_qp.setDbPathOrUrl(join(folder, "relational.db"))
+            grp_qp = TriplestoreQueryProcessor()
+            grp_qp.setDbPathOrUrl(join(folder, "graph.nt"))
+            generic = GenericQueryProcessor()
+            generic.addQueryProcessor(rel_qp)
+            generic.addQueryProcessor(grp_qp)
+
+            for name in ("Annotations", "Images", "Canvas", "Manifests", "Collections"):
+                expected = sorted(entity.getId() for entity in getattr(generic, "getAll" + name)())
+                batches = getattr(generic, "iterAll" + name)(batchSize=50)
+                self.assertEqual(sorted(entity.getId() for entity in batches), expected)
+            self.assertTrue(all(len(batch) <= 50 for batch in rel_qp.iterAllAnnotations(batchSize=50)))
+
+
+class _FailingEntitiesTriplestoreQueryProcessor(TriplestoreQueryProcessor):
+    def getEntitiesByIds(self, entityIds, chunkSize=1000):
+        raise ConnectionError("graph database unavailable")
+
+
+class _RecordingTriplestoreQueryProcessor(TriplestoreQueryProcessor):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def getCanvasesInCollection(self, collectionId, **kwargs):
+        self.calls.append(("getCanvasesInCollection", collectionId, kwargs.get("variables")))
+        return super().getCanvasesInCollection(collectionId, **kwargs)
+
+    def getCanvasesInManifest(self, manifestId, **kwargs):
+        self.calls.append(("getCanvasesInManifest", manifestId, kwargs.get("variables")))
+        return super().getCanvasesInManifest(manifestId, **kwargs)
+
+
+# The sample data uploaded to a relational database and an embedded graph database in
+# folder, and a GenericQueryProcessor querying both
+def sampleGenericQueryProcessor(folder):
+    ann_dp = AnnotationProcessor()
+    ann_dp.setDbPathOrUrl(join(folder, "relational.db"))
+    met_dp = MetadataProcessor()
+    met_dp.setDbPathOrUrl(join(folder, "relational.db"))
+    col_dp = CollectionProcessor()
+    col_dp.setDbPathOrUrl(join(folder, "graph.nt"))
+    for processor, path in ((ann_dp, "annotations.csv"), (met_dp, "metadata.csv"), (col_dp, "collection-1.json")):
+        if not processor.uploadData("data" + sep + path):
+            raise AssertionError(f"Upload of {path} failed")
+    generic = GenericQueryProcessor()
+    for processor, path in ((RelationalQueryProcessor(), "relational.db"), (TriplestoreQueryProcessor(), "graph.nt")):
+        processor.setDbPathOrUrl(join(folder, path))
+        generic.addQueryProcessor(processor)
+    return generic
+
+
+class TestCrossDatabaseJoin(unittest.TestCase):
+
+    def test_entities_by_ids_merge_both_databases(self):
+        with tempfile.TemporaryDirectory() as folder:
+            generic = sampleGenericQueryProcessor(folder)
+            manifest = generic.getAllManifests()[0]
+            annotation = generic.getAllAnnotations()[0]
+            canvases = generic.getAllCanvas()
+            ids = [annotation.getId(), "https://example.org/missing", manifest.getId()] + [canvas.getId() for canvas in canvases]
+            entities = generic.getEntitiesByIds(ids)
+            self.assertEqual([entity.getId() for entity in entities], [id for id in ids if id != "https://example.org/missing"])
+            self.assertIsInstance(entities[0], Annotation)
+            self.assertEqual(entities[0].getBody(), annotation.getBody())
+            self.assertIsInstance(entities[1], Manifest)
+            self.assertEqual(entities[1].getLabel(), manifest.getLabel())
+            self.assertTrue(entities[1].getTitle())
+            self.assertTrue(all(isinstance(entity, Canvas) for entity in entities[2:]))
+
+    def test_entity_by_id_is_one_merged_object(self):
+        with tempfile.TemporaryDirectory() as folder:
+            generic = sampleGenericQueryProcessor(folder)
+            collection_id = generic.getAllCollections()[0].getId()
+            collection = generic.getEntityById(collection_id)
+            self.assertIsInstance(collection, Collection)
+            self.assertTrue(collection.getTitle())
+            self.assertTrue(collection.getLabel())
+            self.assertTrue(all(isinstance(item, Manifest) for item in collection.getItems()))
+            self.assertEqual(set(item.getId() for item in collection.getItems()),
+                             set(manifest.getId() for manifest in generic.getAllManifests()))
+            self.assertIs(generic.getEntityById(collection_id), collection)
+            self.assertIs(generic.getEntitiesByIds([collection_id])[0], collection)
+
+            # an upload to one of the databases makes the next lookup read them again
+            met_dp = MetadataProcessor()
+            met_dp.setDbPathOrUrl(join(folder, "relational.db"))
+            self.assertTrue(met_dp.uploadData("data" + sep + "metadata.csv"))
+            self.assertIsNot(generic.getEntityById(collection_id), collection)
+
+    def test_partial_entities_are_not_kept(self):
+        # the graph database fails to return the entities but answers getItemsByIds: the
+        # collection built from the relational database alone must not be kept
+        with tempfile.TemporaryDirectory() as folder:
+            generic = sampleGenericQueryProcessor(folder)
+            collection_id = generic.getAllCollections()[0].getId()
+            graph = generic.queryProcessors[1]
+            generic.queryProcessors[1] = _FailingEntitiesTriplestoreQueryProcessor()
+            generic.queryProcessors[1].setDbPathOrUrl(graph.getDbPathOrUrl())
+            generic.allowPartialResults()
+            partial = generic.getEntityById(collection_id)
+            self.assertIsNone(partial.getLabel())
+            self.assertEqual(len(generic.getFanOutErrors()), 1)
+            generic.queryProcessors[1] = graph
+            self.assertTrue(generic.getEntityById(collection_id).getLabel())
+
+    def test_annotations_to_containers_reach_their_canvases(self):
+        with tempfile.TemporaryDirectory() as folder:
+            generic = sampleGenericQueryProcessor(folder)
+
+            for manifest in generic.getAllManifests():
+                expected = set()
+                for canvas in generic.getCanvasesInManifest(manifest.getId()):
+                    expected.update(annotation.getId() for annotation in generic.getAnnotationsToCanvas(canvas.getId()))
+                found = set(annotation.getId() for annotation in generic.getAnnotationsToManifest(manifest.getId()))
+                self.assertEqual(found, expected)
+            collection = generic.getAllCollections()[0]
+            canvases = set(canvas.getId() for canvas in generic.getCanvasesInCollection(collection.getId()))
+            expected = set(annotation.getId() for annotation in generic.getAllAnnotations() if annotation.getTarget() in canvases)
+            found = set(annotation.getId() for annotation in generic.getAnnotationsToCollection(collection.getId()))
+            self.assertTrue(expected)
+            self.assertEqual(found, expected)
+
+    # The canvases are asked to each query processor, so that its own methods (and
+    # instrumentation) are used, and only their identifiers are read
+    def test_annotations_to_containers_call_the_query_processors(self):
+        with tempfile.TemporaryDirectory() as folder:
+            generic = sampleGenericQueryProcessor(folder)
+            graph = _RecordingTriplestoreQueryProcessor()
+            graph.setDbPathOrUrl(generic.queryProcessors[1].getDbPathOrUrl())
+            generic.queryProcessors[1] = graph
+
+            collection_id = generic.getAllCollections()[0].getId()
+            manifest_id = generic.getAllManifests()[0].getId()
+            graph.calls.clear()
+            generic.getAnnotationsToCollection(collection_id)
+            generic.getAnnotationsToManifest(manifest_id)
+            self.assertEqual(graph.calls, [("getCanvasesInCollection", collection_id, ["id"]),
+                                           ("getCanvasesInManifest", manifest_id, ["id"])])
+
+
+class TestContainmentIndex(unittest.TestCase):
+
+    def _rows(self, df):
+        return sorted(map(tuple, df[["id", "label"]].values.tolist()))
+
+    def test_index_answers_like_the_store(self):
+        with tempfile.TemporaryDirectory() as folder:
+            graph = join(folder, "graph.nt")
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(graph)
+            # two uploads: the second one extends the index built by the first one
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-1.json"))
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-2.json"))
+            self.assertIn("graph.nt.containment.npz", listdir(folder))
+
+            grp_qp = TriplestoreQueryProcessor()
+            grp_qp.setDbPathOrUrl(graph)
+            for collection in grp_qp.getAllCollections()["id"]:
+                for method in (grp_qp.getCanvasesInCollection, grp_qp.getManifestsInCollection):
+                    indexed = method(collection)
+                    grp_qp.setUseContainmentIndex(False)
+                    self.assertEqual(self._rows(indexed), self._rows(method(collection)))
+                    grp_qp.setUseContainmentIndex(True)
+                    self.assertTrue(len(indexed))
+            for manifest in grp_qp.getAllManifests()["id"]:
+                indexed = grp_qp.getCanvasesInManifest(manifest)
+                grp_qp.setUseContainmentIndex(False)
+                self.assertEqual(self._rows(indexed), self._rows(grp_qp.getCanvasesInManifest(manifest)))
+                grp_qp.setUseContainmentIndex(True)
+
+            # a failed upload removes the index, the store answers again
+            self.assertFalse(col_dp.uploadData(join(folder, "missing.json")))
+            self.assertNotIn("graph.nt.containment.npz", listdir(folder))
+            self.assertTrue(len(grp_qp.getCanvasesInCollection(grp_qp.getAllCollections()["id"][0])))
+            # and it is not built again from part of the store
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-1.json"))
+            self.assertNotIn("graph.nt.containment.npz", listdir(folder))
+
+    def test_index_keeps_non_ascii_labels(self):
+        with tempfile.TemporaryDirectory() as folder:
+            collection = {"id": "https://example.org/c/collection", "type": "Collection",
+                          "label": {"none": ["Opere di Niccolò"]},
+                          "items": [{"id": "https://example.org/c/m/manifest", "type": "Manifest",
+                                     "label": {"none": ["Città"]},
+                                     "items": [{"id": f"https://example.org/c/m/canvas/p{page}", "type": "Canvas",
+                                                "label": {"none": [f"c. {page} — verso"]}} for page in range(3)]}]}
+            with open(join(folder, "collection.json"), "w", encoding="utf-8") as f:
+                json.dump(collection, f, ensure_ascii=False)
+            graph = join(folder, "graph.nt")
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(graph)
+            self.assertTrue(col_dp.uploadData(join(folder, "collection.json")))
+            grp_qp = TriplestoreQueryProcessor()
+            grp_qp.setDbPathOrUrl(graph)
+            indexed = grp_qp.getCanvasesInCollection("https://example.org/c/collection")
+            grp_qp.setUseContainmentIndex(False)
+            self.assertEqual(self._rows(indexed), self._rows(grp_qp.getCanvasesInCollection("https://example.org/c/collection")))
+            self.assertIn("c. 0 — verso", indexed["label"].tolist())
+
+    def test_index_must_match_the_store(self):
+        with tempfile.TemporaryDirectory() as folder:
+            graph = join(folder, "graph.nt")
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(graph)
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-1.json"))
+            grp_qp = TriplestoreQueryProcessor()
+            grp_qp.setDbPathOrUrl(graph)
+            collection = grp_qp.getAllCollections()["id"][0]
+            self.assertIsNotNone(grp_qp._containmentIndex())
+
+            # a manifest added to the store by someone else
+            manifest = "https://example.org/iiif/added/manifest"
+            with open(graph, "a", encoding="utf-8") as f:
+                f.write(f'<{collection}> <https://schema.org/isPartOf> <{manifest}> .\n'
+                        f'<{manifest}> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <https://dbpedia.org/page/Manifest> .\n'
+                        f'<{manifest}> <https://schema.org/identifier> "{manifest}" .\n'
+                        f'<{manifest}> <https://dbpedia.org/page/label> "Added" .\n')
+            self.assertIsNone(grp_qp._containmentIndex())
+            self.assertIn(manifest, grp_qp.getManifestsInCollection(collection)["id"].tolist())
+
+    def test_index_failures_do_not_fail_the_upload(self):
+        with tempfile.TemporaryDirectory() as folder:
+            graph = join(folder, "graph.nt")
+            # the index cannot be written where its temporary file should go
+            mkdir(f"{graph}.containment.npz.{getpid()}.tmp")
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(graph)
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-1.json"))
+            self.assertNotIn("graph.nt.containment.npz", listdir(folder))
+            grp_qp = TriplestoreQueryProcessor()
+            grp_qp.setDbPathOrUrl(graph)
+            self.assertTrue(len(grp_qp.getCanvasesInCollection(grp_qp.getAllCollections()["id"][0])))
+        # an endpoint that does not answer has no index
+        grp_qp.setDbPathOrUrl("http://127.0.0.1:1/sparql")
+        self.assertIsNone(grp_qp._containmentIndex())
+
+    # An endpoint gets an index in the cache folder too. A query processor asks for the
+    # marker of the last upload once, then answers containment queries without the
+    # endpoint; an upload by another client changes the marker and retires the index.
+    def test_endpoint_index_follows_the_upload_marker(self):
+        graph = Graph()
+        lock = Lock()
+        queries = []
+
+        def respond(handler, body):
+            with lock:
+                if handler.headers.get("Content-Type") == "application/x-www-form-urlencoded":
+                    graph.update(parse_qs(body.decode("utf-8"))["update"][0])
+                    data = b""
+                else:
+                    queries.append(body.decode("utf-8"))
+                    data = graph.query(body.decode("utf-8")).serialize(format="csv")
+            handler.send_response(200)
+            handler.send_header("Content-Type", "text/csv")
+            handler.send_header("Content-Length", str(len(data)))
+            handler.end_headers()
+            handler.wfile.write(data)
+
+        with tempfile.TemporaryDirectory() as folder, stubEndpoint(respond) as endpoint, \
+                patch.dict(environ, {"XDG_CACHE_HOME": folder}):
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(endpoint)
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-1.json"))
+            self.assertEqual(len(listdir(join(folder, "iiif-containment"))), 1)
+
+            grp_qp = TriplestoreQueryProcessor()
+            grp_qp.setDbPathOrUrl(endpoint)
+            collection = grp_qp.getAllCollections()["id"][0]
+            manifest = grp_qp.getAllManifests()["id"][0]
+            queries.clear()
+            indexed = [grp_qp.getCanvasesInCollection(collection), grp_qp.getManifestsInCollection(collection),
+                       grp_qp.getCanvasesInManifest(manifest)]
+            self.assertEqual(len(queries), 1)
+            grp_qp.setUseContainmentIndex(False)
+            self.assertEqual([self._rows(df) for df in indexed],
+                             [self._rows(grp_qp.getCanvasesInCollection(collection)),
+                              self._rows(grp_qp.getManifestsInCollection(collection)),
+                              self._rows(grp_qp.getCanvasesInManifest(manifest))])
+            grp_qp.setUseContainmentIndex(True)
+
+            # a later upload from this process extends the index
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-2.json"))
+            self.assertIsNotNone(grp_qp._containmentIndex())
+            self.assertEqual(len(grp_qp._containmentIndex().positions), len(grp_qp.getAllCollections())
+                             + len(grp_qp.getAllManifests()) + len(grp_qp.getAllCanvases()))
+
+            # another client uploads: the index no longer matches the endpoint
+            _writeStoreMarker(endpoint)
+            other = TriplestoreQueryProcessor()
+            other.setDbPathOrUrl(endpoint)
+            self.assertIsNone(other._containmentIndex())
+            self.assertEqual(self._rows(other.getCanvasesInManifest(manifest)), self._rows(indexed[2]))
+
+
+class TestTypedResults(unittest.TestCase):
+
+    def test_projection_and_types(self):
+        with tempfile.TemporaryDirectory() as folder:
+            graph = join(folder, "graph.nt")
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(graph)
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-1.json"))
+
+            grp_qp = TriplestoreQueryProcessor()
+            grp_qp.setDbPathOrUrl(graph)
+            canvases = grp_qp.getAllCanvases()
+            ids = grp_qp.getAllCanvases(variables=["id"])
+            self.assertEqual(list(ids.columns), ["id"])
+            self.assertEqual(sorted(ids["id"]), sorted(canvases["id"]))
+            self.assertEqual(list(grp_qp.getAllCanvases(limit=3, variables=["label"]).columns), ["label"])
+            self.assertEqual(list(grp_qp.getManifestsInCollection(
+                grp_qp.getAllCollections()["id"][0], variables=["id"]).columns), ["id"])
+            with self.assertRaises(ValueError):
+                grp_qp.getAllCanvases(variables=["title"])
+
+            items = grp_qp.getItemsByIds(grp_qp.getAllManifests()["id"])
+            self.assertEqual(items["type"].dtype, "category")
+            self.assertEqual(set(items["type"]), {"Canvas"})
+
+    def test_values_are_not_guessed(self):
+        df = _decodeSparqlResult("text/csv", b"id,label\r\na,NA\r\nb,1999\r\nc,\r\n")
+        self.assertEqual(df["label"].tolist()[:2], ["NA", "1999"])
+        self.assertTrue(isna(df["label"][2]))
+        df = _decodeSparqlResult("application/sparql-results+json", json.dumps({
+            "head": {"vars": ["id", "label"]},
+            "results": {"bindings": [{"id": {"type": "literal", "value": "a"}}]}}).encode())
+        self.assertEqual(df["id"].tolist(), ["a"])
+        self.assertTrue(isna(df["label"][0]))
+        self.assertEqual(df["label"].dtype, "string")
+        self.assertEqual(df["label"].dropna().tolist(), [])
+
+
+class TestPagination(unittest.TestCase):
+
+    # Two relational databases sharing half of the annotations, read 50 at a time: the
+    # pages must cover every annotation once, in the order of the identifiers
+    def test_keyset_pages_across_databases(self):
+        with tempfile.TemporaryDirectory() as folder:
+            half = join(folder, "half.csv")
+            with open("data" + sep + "annotations.csv") as f:
+                lines = f.readlines()
+            with open(half, "w") as f:
+                f.writelines(lines[:1] + lines[1::2])
+
+            generic = GenericQueryProcessor()
+            for name, path in (("all.db", "data" + sep + "annotations.csv"), ("half.db", half)):
+                ann_dp = AnnotationProcessor()
+                ann_dp.setDbPathOrUrl(join(folder, name))
+                self.assertTrue(ann_dp.uploadData(path))
+                rel_qp = RelationalQueryProcessor()
+                rel_qp.setDbPathOrUrl(join(folder, name))
+                generic.addQueryProcessor(rel_qp)
+
+            expected = sorted(set(annotation.getId() for annotation in generic.getAllAnnotations()))
+            pages = []
+            after = None
+            while True:
+                page = generic.getAllAnnotations(limit=50, after=after)
+                if not page:
+                    break
+                self.assertLessEqual(len(page), 50)
+                pages.extend(annotation.getId() for annotation in page)
+                after = page[-1].getId()
+            self.assertEqual(pages, expected)
+            self.assertEqual([annotation.getId() for annotation in generic.getAllAnnotations(limit=3, order="desc")],
+                             expected[::-1][:3])
+
+    def test_pages_walk_the_unique_index(self):
+        with tempfile.TemporaryDirectory() as folder:
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(join(folder, "relational.db"))
+            self.assertTrue(ann_dp.uploadData("data" + sep + "annotations.csv"))
+            sql, params = _pageSql("SELECT internalId, id, body, target, motivation FROM Annotation WHERE target = ? OR body = ?",
+                                   ("a", "b"), "id", 50, "https://example.org", "desc")
+            self.assertIn("(target = ? OR body = ?) AND id < ?", sql)
+            with sqlite3.connect(join(folder, "relational.db")) as con:
+                sql, params = _pageSql("SELECT internalId, id, body, target, motivation FROM Annotation",
+                                       (), "id", 50, "https://example.org")
+                plan = " ".join(row[3] for row in con.execute("EXPLAIN QUERY PLAN " + sql, params))
+                self.assertIn("Annotation_id_unique", plan)
+                self.assertNotIn("TEMP B-TREE", plan)
+            con.close()
+
+    # Two annotations of the canvas share an image: every image comes once, and the pages
+    # walk the same list as the whole result
+    def test_images_of_a_canvas_page_on_unique_bodies(self):
+        with tempfile.TemporaryDirectory() as folder:
+            annotations = join(folder, "annotations.csv")
+            DataFrame({"id": ["a1", "a2", "a3", "a4"], "body": ["img/b", "img/b", "img/a", "img/c"],
+                       "target": ["canvas"] * 4, "motivation": ["painting"] * 4}).to_csv(annotations, index=False)
+            generic = GenericQueryProcessor()
+            for name in ("one.db", "two.db"):
+                ann_dp = AnnotationProcessor()
+                ann_dp.setDbPathOrUrl(join(folder, name))
+                self.assertTrue(ann_dp.uploadData(annotations))
+                rel_qp = RelationalQueryProcessor()
+                rel_qp.setDbPathOrUrl(join(folder, name))
+                generic.addQueryProcessor(rel_qp)
+
+            ids = lambda images: [image.getId() for image in images]
+            self.assertEqual(sorted(ids(generic.getImagesAnnotatingCanvas("canvas"))), ["img/a", "img/b", "img/c"])
+            pages = [ids(generic.getImagesAnnotatingCanvas("canvas", limit=2)),
+                     ids(generic.getImagesAnnotatingCanvas("canvas", limit=2, after="img/b"))]
+            self.assertEqual(pages, [["img/a", "img/b"], ["img/c"]])
+
+    # Identifiers are escaped in the SPARQL queries like the cursors
+    def test_quotes_in_sparql_identifiers(self):
+        with tempfile.TemporaryDirectory() as folder:
+            graph = join(folder, "graph.nt")
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(graph)
+            self.assertTrue(col_dp.uploadData("data" + sep + "collection-1.json"))
+            grp_qp = TriplestoreQueryProcessor()
+            grp_qp.setDbPathOrUrl(graph)
+            grp_qp.setUseContainmentIndex(False)
+            identifier = 'https://example.org/"quoted"\\collection'
+            for method in (grp_qp.getCanvasesInCollection, grp_qp.getManifestsInCollection,
+                           grp_qp.getCanvasesInManifest, grp_qp.getEntitiesWithLabel):
+                self.assertEqual(len(method(identifier)), 0)
+            self.assertEqual(len(grp_qp.getEntityById(identifier)), 0)
+
+
+class _SlowRelationalQueryProcessor(RelationalQueryProcessor):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def getAllImages(self, limit=None, after=None, order=None):
+        time.sleep(self.delay)
+        return DataFrame({"internalId": ["image-0"], "body": [f"https://example.org/{self.delay}.jpg"]})
+
+
+class _HungTriplestoreQueryProcessor(TriplestoreQueryProcessor):
+    # A graph database that does not answer until released
+    def __init__(self):
+        super().__init__()
+        self.released = Event()
+
+    def getAllCanvases(self, limit=None, after=None, order=None):
+        self.released.wait(10)
+        return DataFrame(columns=["id", "label"])
+
+
+class TestFanOut(unittest.TestCase):
+
+    def test_processors_are_queried_concurrently(self):
+        generic = GenericQueryProcessor()
+        for delay in (0.3, 0.31, 0.32):
+            generic.addQueryProcessor(_SlowRelationalQueryProcessor(delay))
+        started = time.perf_counter()
+        images = generic.getAllImages()
+        self.assertLess(time.perf_counter() - started, 0.6)
+        self.assertEqual([image.getId() for image in images],
+                         ["https://example.org/0.3.jpg", "https://example.org/0.31.jpg", "https://example.org/0.32.jpg"])
+
+    def test_timeout_and_partial_results(self):
+        generic = GenericQueryProcessor()
+        generic.addQueryProcessor(_SlowRelationalQueryProcessor(0.01))
+        generic.addQueryProcessor(_SlowRelationalQueryProcessor(1))
+        generic.setTimeouts(relational=0.3)
+        with self.assertRaises(TimeoutError):
+            generic.getAllImages()
+        generic.allowPartialResults()
+        self.assertEqual([image.getId() for image in generic.getAllImages()], ["https://example.org/0.01.jpg"])
+        self.assertEqual(len(generic.getFanOutErrors()), 1)
+
+    # Queries left running by a database that stopped answering hold only the threads of
+    # that database: the other databases still answer within their own timeout
+    def test_hung_database_does_not_starve_the_others(self):
+        hung = _HungTriplestoreQueryProcessor()
+        generic = GenericQueryProcessor()
+        generic.addQueryProcessor(_SlowRelationalQueryProcessor(0))
+        generic.addQueryProcessor(hung)
+        generic.setTimeouts(relational=0.5, triplestore=0.1)
+        generic.allowPartialResults()
+        try:
+            for _ in range(8):
+                self.assertEqual(generic.getAllCanvas(), [])
+                self.assertEqual(len(generic.getFanOutErrors()), 1)
+            self.assertEqual([image.getId() for image in generic.getAllImages()], ["https://example.org/0.jpg"])
+            self.assertEqual(generic.getFanOutErrors(), [])
+        finally:
+            hung.released.set()
+
+    def test_errors_of_every_fan_out_are_kept(self):
+        # getAnnotationsToManifest asks the graph database (unreachable here), then the
+        # relational one: the error of the first fan-out must survive the second one
+        with tempfile.TemporaryDirectory() as folder:
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(join(folder, "relational.db"))
+            self.assertTrue(ann_dp.uploadData("data" + sep + "annotations.csv"))
+            rel_qp = RelationalQueryProcessor()
+            rel_qp.setDbPathOrUrl(join(folder, "relational.db"))
+            grp_qp = TriplestoreQueryProcessor()
+            grp_qp.setDbPathOrUrl("http://127.0.0.1:1/sparql")
+            generic = GenericQueryProcessor()
+            generic.addQueryProcessor(rel_qp)
+            generic.addQueryProcessor(grp_qp)
+            generic.allowPartialResults()
+            generic.enableCache()
+            generic.getAnnotationsToManifest("https://dl.ficlit.unibo.it/iiif/2/28429/manifest")
+            self.assertEqual([type(processor) for processor, error in generic.getFanOutErrors()],
+                             [TriplestoreQueryProcessor])
+            self.assertEqual(generic.getCacheStats()["size"], 0)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_events_slow_queries_and_metrics(self):
+        with tempfile.TemporaryDirectory() as folder:
+            generic = sampleGenericQueryProcessor(folder)
+            relational = generic.queryProcessors[0]
+            # every call must reach the databases
+            generic.disableCache()
+            resetMetrics()
+            # nothing is recorded until instrumentation is enabled
+            generic.getAllAnnotations()
+            self.assertEqual(getMetrics(), {})
+
+            events = []
+            relational.addInstrumentationHook(events.append)
+            generic.enableInstrumentation(slowQueryThreshold=0.0)
+            with self.assertLogs("impl", "WARNING") as logs:
+                annotations = generic.getAllAnnotations()
+            event = events[-1]
+            self.assertEqual((event["processor"], event["method"]), ("RelationalQueryProcessor", "getAllAnnotations"))
+            self.assertEqual(event["rows"], len(annotations))
+            self.assertIn("FROM Annotation", event["queries"][0])
+            self.assertEqual(set(event["phases"]), {"backend", "decode"})
+
+            self.assertTrue(any("GenericQueryProcessor.getAllAnnotations" in line for line in logs.output))
+            slow = generic.getSlowQueries()
+            self.assertEqual(slow[-1]["method"], "getAllAnnotations")
+            self.assertEqual(set(slow[-1]["phases"]), {"backend", "materialize"})
+            self.assertLessEqual(sum(slow[-1]["phases"].values()), slow[-1]["seconds"])
+
+            relational.setDbPathOrUrl(join(folder, "missing.db"))
+            with self.assertRaises(sqlite3.Error):
+                generic.getAllAnnotations()
+            relational.setDbPathOrUrl(join(folder, "relational.db"))
+            metrics = getMetrics()
+            self.assertEqual(metrics["GenericQueryProcessor.getAllAnnotations"]["calls"], 2)
+            self.assertEqual(metrics["GenericQueryProcessor.getAllAnnotations"]["errors"], 1)
+            self.assertIn('iiif_calls_total{processor="GenericQueryProcessor",method="getAllAnnotations"} 2',
+                          getMetricsText())
+
+            generic.disableInstrumentation()
+            relational.removeInstrumentationHook(events.append)
+            relational.disableInstrumentation()
+            recorded = len(events)
+            generic.getAllAnnotations()
+            self.assertEqual(len(events), recorded)
+            self.assertEqual(generic.getSlowQueries(), [])
+
+
+    # A failed upload reports nothing, not the rows of the upload before it
+    def test_failed_upload_resets_the_report(self):
+        with tempfile.TemporaryDirectory() as folder:
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(join(folder, "relational.db"))
+            ann_dp.enableInstrumentation()
+            events = []
+            ann_dp.addInstrumentationHook(events.append)
+            self.assertTrue(ann_dp.uploadData("data" + sep + "annotations.csv"))
+            self.assertTrue(ann_dp.getUploadReport())
+            self.assertFalse(ann_dp.uploadData(join(folder, "missing.csv")))
+            self.assertEqual(ann_dp.getUploadReport(), {})
+            self.assertEqual(events[-1]["error"], "upload failed")
+            self.assertIsNone(events[-1]["rows"])
+
+
+    # A generic query processor records only its own calls: its query processors, not
+    # instrumented here, leave no phases or queries on its event, whether they run in the
+    # calling thread (a single database) or in the fan-out threads
+    def test_uninstrumented_processors_are_not_recorded(self):
+        with tempfile.TemporaryDirectory() as folder:
+            complete = sampleGenericQueryProcessor(folder)
+            generic = GenericQueryProcessor()
+            generic.addQueryProcessor(complete.queryProcessors[0])
+            generic.disableCache()
+            events = []
+            generic.addInstrumentationHook(events.append)
+            for timeout in (None, 10):
+                generic.setTimeouts(relational=timeout)
+                generic.getAllAnnotations()
+                event = events[-1]
+                self.assertEqual(set(event["phases"]), {"backend", "materialize"})
+                self.assertEqual(event["queries"], [])
+                self.assertLessEqual(sum(event["phases"].values()), event["seconds"])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_small_run_measures_every_method(self):
+        with tempfile.TemporaryDirectory() as folder:
+            document = runBenchmark(600, folder, repeat=2)
+            json.dumps(document)
+            self.assertEqual(document["counts"]["canvases"], 200)
+            results = {result["name"]: result for result in document["results"]}
+            for name in ("AnnotationProcessor.uploadData", "MetadataProcessor.uploadData", "CollectionProcessor.uploadData"):
+                self.assertGreater(results[name]["throughput"], 0)
+            for name in ("getAllAnnotations", "getCanvasesInCollection", "getEntityById", "searchEntities"):
+                self.assertEqual(results[name]["calls"], 2)
+                self.assertLessEqual(results[name]["p50Ms"], results[name]["p99Ms"])
+                self.assertGreater(results[name]["rows"], 0)
+
+
+class TestImport(unittest.TestCase):
+
+    # Importing impl must not touch any database and must not load the graph libraries:
+    # only the time spent after pandas (which the module needs anyway) is measured
+    script = ("import sys, time; import pandas; start = time.perf_counter(); import impl; "
+              "print(time.perf_counter() - start); "
+              "print(sorted(m for m in ('rdflib', 'sparql_dataframe', 'SPARQLWrapper') if m in sys.modules))")
+
+    def test_import_is_fast_and_side_effect_free(self):
+        with tempfile.TemporaryDirectory() as folder:
+            result = subprocess.run([sys.executable, "-c", self.script], cwd=folder,
+                                    env={"PYTHONPATH": dirname(abspath(__file__))},
+                                    capture_output=True, text=True, check=True)
+            seconds, loaded = result.stdout.splitlines()
+            self.assertLess(float(seconds), 0.25)
+            self.assertEqual(loaded, "[]")
+            self.assertEqual(result.stderr, "")
+            self.assertEqual(listdir(folder), [])